@@ -8,7 +8,10 @@
 #include <picojson.h>
 #include <tvm/runtime/module.h>
 
+#include <iterator>
 #include <string>
+#include <unordered_map>
+#include <unordered_set>
 #include <vector>
 
 namespace mlc {
@@ -202,7 +205,72 @@ class Conversation {
 
   void Reset() { this->messages.resize(this->offset); }
 
+  /*!
+   * \brief Get the token ids of every entry of a prompt array, each encoded on its own.
+   * The token ids of the entries are cached, so that only the entries not seen before are
+   * encoded, e.g. the new messages of a round, while the history is measured and, when
+   * CheckPromptTokenArray holds, reassembled from them when the context window shifts.
+   * \param prompts The prompt array, from GetPromptArray or GetPromptArrayLastRound.
+   * \param fencode The function encoding a string into token ids.
+   * \return The token ids of every entry of the prompt array.
+   */
+  template <typename FEncode>
+  std::vector<std::vector<int32_t>> GetPromptTokenArray(const std::vector<std::string>& prompts,
+                                                        FEncode fencode) {
+    // drop the entries of messages no longer in the conversation, e.g. after a reset
+    if (prompt_token_cache_.size() > 2 * (this->messages.size() + prompts.size()) + 4) {
+      std::vector<std::string> all_prompts = this->GetPromptArray();
+      std::unordered_set<std::string> live(all_prompts.begin(), all_prompts.end());
+      live.insert(prompts.begin(), prompts.end());
+      for (auto it = prompt_token_cache_.begin(); it != prompt_token_cache_.end();) {
+        it = live.count(it->first) ? std::next(it) : prompt_token_cache_.erase(it);
+      }
+    }
+    std::vector<std::vector<int32_t>> ret;
+    ret.reserve(prompts.size());
+    for (const std::string& prompt : prompts) {
+      auto it = prompt_token_cache_.find(prompt);
+      if (it == prompt_token_cache_.end()) {
+        it = prompt_token_cache_.emplace(prompt, fencode(prompt)).first;
+      }
+      ret.push_back(it->second);
+    }
+    return ret;
+  }
+
+  /*!
+   * \brief Check that the entries of a prompt array, encoded one by one, concatenate to the
+   *  token ids of the whole prompt text, which are the ids actually prefilled.
+   * It fails for good once a prompt differs, e.g. with tokenizers adding a prefix space to
+   * every input or merging tokens across the entries, and the prompts are then always
+   * encoded as whole texts.
+   * \param prompts The prompt array.
+   * \param encoded The token ids of the concatenated prompt array.
+   * \param fencode The function encoding a string into token ids.
+   * \return Whether prompts can be assembled from the token ids of their entries.
+   */
+  template <typename FEncode>
+  bool CheckPromptTokenArray(const std::vector<std::string>& prompts,
+                             const std::vector<int32_t>& encoded, FEncode fencode) {
+    if (!prompt_tokens_concatenable_) return false;
+    std::vector<int32_t> concat;
+    concat.reserve(encoded.size());
+    for (const std::vector<int32_t>& entry_tokens : this->GetPromptTokenArray(prompts, fencode)) {
+      concat.insert(concat.end(), entry_tokens.begin(), entry_tokens.end());
+    }
+    prompt_tokens_concatenable_ = concat == encoded;
+    return prompt_tokens_concatenable_;
+  }
+
+  /*! \brief Whether CheckPromptTokenArray has held for every prompt so far. */
+  bool PromptTokensConcatenable() const { return prompt_tokens_concatenable_; }
+
  private:
+  /*! \brief The token ids of the prompt array entries, keyed by the entries. */
+  std::unordered_map<std::string, std::vector<int32_t>> prompt_token_cache_;
+  /*! \brief Whether the entries of every prompt so far tokenize the same as the whole prompt. */
+  bool prompt_tokens_concatenable_{true};
+
   // Identity function
   static std::string Identity(std::string msg) { return msg; }
   /**
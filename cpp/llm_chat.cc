@@ -16,20 +16,28 @@
 #include <tvm/runtime/registry.h>
 #include <tvm/runtime/relax_vm/memory_manager.h>
 
+#include <algorithm>
 #include <cctype>
+#include <cmath>
 #include <chrono>
+#include <cstring>
 #include <filesystem>
+#include <functional>
 #include <fstream>
 #include <iomanip>
+#include <limits>
 #include <list>
 #include <memory>
+#include <numeric>
 #include <optional>
 #include <random>
 #include <string>
+#include <unordered_map>
 #include <unordered_set>
 #include <vector>
 
 #include "conversation.h"
+#include "prefix_cache.h"
 
 namespace mlc {
 namespace llm {
@@ -239,9 +247,16 @@ struct FunctionTable {
   void _InitFunctions() {
     this->prefill_func_ = mod_get_func("prefill");
     this->embed_func_ = mod_get_func("embed");
+    this->embed_batch_func_ = mod_get_func("embed_batch");
+    this->embed_pooled_func_ = mod_get_func("embed_pooled");
     this->prefill_with_embed_func_ = mod_get_func("prefill_with_embed");
     this->decode_func_ = mod_get_func("decode");
+    this->verify_func_ = mod_get_func("verify");
+    this->decode_n_func_ = mod_get_func("decode_n");
     this->softmax_func_ = mod_get_func("softmax_with_temperature");
+    // sampling on device is not supported in distributed inference yet
+    this->sample_func_ =
+        this->use_disco ? PackedFunc(nullptr) : mod_get_func("sample_top_p_top_k");
     this->encoding_without_cache_func_ = mod_get_func("encoding_without_cache");
     this->create_kv_cache_func_ = mod_get_func("create_kv_cache");
     this->reset_kv_cache_func_ = mod_get_func("reset_kv_cache");
@@ -252,6 +267,51 @@ struct FunctionTable {
       support_backtracking_kv_ = false;
     }
     this->fkvcache_array_popn_ = get_global_func("vm.builtin.attention_kv_cache_array_popn");
+    // a model built with attention sinks keeps the keys before the rotary embedding in the KV
+    // cache, and tells the shape of the KV entry of a token in its metadata
+    PackedFunc get_metadata_func = mod_get_func("get_metadata");
+    if (!this->use_disco && get_metadata_func != nullptr) {
+      std::string metadata_str = get_metadata_func();
+      picojson::value metadata_info;
+      picojson::parse(metadata_info, metadata_str);
+      auto metadata = metadata_info.get<picojson::object>();
+      if (metadata.count("attention_sink_kv_shape")) {
+        for (const picojson::value& dim :
+             metadata["attention_sink_kv_shape"].get<picojson::array>()) {
+          this->attention_sink_kv_shape_.push_back(dim.get<int64_t>());
+        }
+        this->fkvcache_view_ = get_global_func("vm.builtin.attention_kv_cache_view");
+        this->fkvcache_append_ = get_global_func("vm.builtin.attention_kv_cache_append");
+      }
+      if (metadata.count("decode_n_steps")) {
+        this->decode_n_steps_ = metadata["decode_n_steps"].get<int64_t>();
+      }
+    }
+    support_attention_sink_ = !this->attention_sink_kv_shape_.empty() &&
+                              this->support_backtracking_kv_;
+    this->batch_prefill_func_ = mod_get_func("batch_prefill");
+    this->batch_decode_func_ = mod_get_func("batch_decode");
+    this->create_paged_kv_cache_func_ = mod_get_func("create_paged_kv_cache");
+    // batched inference is not supported in distributed inference yet
+    support_batching_ = !this->use_disco && this->batch_prefill_func_ != nullptr &&
+                        this->batch_decode_func_ != nullptr &&
+                        this->create_paged_kv_cache_func_ != nullptr;
+    if (support_batching_) {
+      this->fpaged_kv_cache_add_sequence_ = get_global_func("mlc.paged_kv_cache.add_sequence");
+      this->fpaged_kv_cache_remove_sequence_ =
+          get_global_func("mlc.paged_kv_cache.remove_sequence");
+      this->fpaged_kv_cache_reset_sequence_ = get_global_func("mlc.paged_kv_cache.reset_sequence");
+      this->fpaged_kv_cache_popn_ = get_global_func("mlc.paged_kv_cache.popn");
+      this->fpaged_kv_cache_begin_forward_ = get_global_func("mlc.paged_kv_cache.begin_forward");
+      this->fpaged_kv_cache_block_size_ = get_global_func("mlc.paged_kv_cache.block_size");
+      this->fpaged_kv_cache_num_free_blocks_ =
+          get_global_func("mlc.paged_kv_cache.num_free_blocks");
+      this->fpaged_kv_cache_get_blocks_ = get_global_func("mlc.paged_kv_cache.get_blocks");
+      this->fpaged_kv_cache_retain_blocks_ = get_global_func("mlc.paged_kv_cache.retain_blocks");
+      this->fpaged_kv_cache_release_blocks_ = get_global_func("mlc.paged_kv_cache.release_blocks");
+      this->fpaged_kv_cache_attach_prefix_ = get_global_func("mlc.paged_kv_cache.attach_prefix");
+      this->fpaged_kv_cache_fork_sequence_ = get_global_func("mlc.paged_kv_cache.fork_sequence");
+    }
   }
 
   ObjectRef Empty(ShapeTuple shape, DataType dtype, Device device) const {
@@ -286,14 +346,42 @@ struct FunctionTable {
 
   PackedFunc prefill_func_;
   PackedFunc embed_func_;
+  PackedFunc embed_batch_func_;
+  PackedFunc embed_pooled_func_;
   PackedFunc prefill_with_embed_func_;
   PackedFunc decode_func_;
+  PackedFunc verify_func_;
+  PackedFunc decode_n_func_;
+  // the number of greedy decode steps run by one call of decode_n_func_
+  int64_t decode_n_steps_ = 0;
   PackedFunc encoding_without_cache_func_;
   PackedFunc softmax_func_;
+  PackedFunc sample_func_;
   PackedFunc create_kv_cache_func_;
   PackedFunc reset_kv_cache_func_;
   bool support_backtracking_kv_;
   PackedFunc fkvcache_array_popn_;
+  bool support_attention_sink_;
+  // shape of the KV entry of one token in each KV cache, e.g. (num_kv_heads, head_dim)
+  std::vector<int64_t> attention_sink_kv_shape_;
+  PackedFunc fkvcache_view_;
+  PackedFunc fkvcache_append_;
+  PackedFunc batch_prefill_func_;
+  PackedFunc batch_decode_func_;
+  PackedFunc create_paged_kv_cache_func_;
+  bool support_batching_;
+  PackedFunc fpaged_kv_cache_add_sequence_;
+  PackedFunc fpaged_kv_cache_remove_sequence_;
+  PackedFunc fpaged_kv_cache_reset_sequence_;
+  PackedFunc fpaged_kv_cache_popn_;
+  PackedFunc fpaged_kv_cache_begin_forward_;
+  PackedFunc fpaged_kv_cache_block_size_;
+  PackedFunc fpaged_kv_cache_num_free_blocks_;
+  PackedFunc fpaged_kv_cache_get_blocks_;
+  PackedFunc fpaged_kv_cache_retain_blocks_;
+  PackedFunc fpaged_kv_cache_release_blocks_;
+  PackedFunc fpaged_kv_cache_attach_prefix_;
+  PackedFunc fpaged_kv_cache_fork_sequence_;
 };
 
 class RandomGenerator {
@@ -396,6 +484,10 @@ class LLMChat {
     } else {
       CHECK(partial_update) << "Key \"top_p\" not found.";
     }
+    if (config.count("top_k")) {
+      CHECK(config["top_k"].is<int64_t>());
+      this->top_k_ = config["top_k"].get<int64_t>();
+    }
     if (config.count("mean_gen_len")) {
       CHECK(config["mean_gen_len"].is<int64_t>());
       this->mean_gen_len_ = config["mean_gen_len"].get<int64_t>();
@@ -408,6 +500,40 @@ class LLMChat {
       CHECK(config["max_gen_len"].is<int64_t>());
       this->max_gen_len_ = config["max_gen_len"].get<int64_t>();
     }
+    if (config.count("max_batch_size")) {
+      CHECK(config["max_batch_size"].is<int64_t>());
+      this->max_batch_size_ = config["max_batch_size"].get<int64_t>();
+      CHECK_GT(this->max_batch_size_, 0) << "max_batch_size must be a positive number!";
+    }
+    if (config.count("kv_cache_capacity")) {
+      CHECK(config["kv_cache_capacity"].is<int64_t>());
+      this->kv_cache_capacity_ = config["kv_cache_capacity"].get<int64_t>();
+    }
+    if (config.count("prefix_cache_capacity")) {
+      CHECK(config["prefix_cache_capacity"].is<int64_t>());
+      this->prefix_cache_capacity_ = config["prefix_cache_capacity"].get<int64_t>();
+    }
+    if (config.count("prompt_lookup_num_tokens")) {
+      CHECK(config["prompt_lookup_num_tokens"].is<int64_t>());
+      this->prompt_lookup_num_tokens_ = config["prompt_lookup_num_tokens"].get<int64_t>();
+    }
+    if (config.count("draft_num_tokens")) {
+      CHECK(config["draft_num_tokens"].is<int64_t>());
+      this->draft_num_tokens_ = config["draft_num_tokens"].get<int64_t>();
+    }
+    if (config.count("prefill_chunk_size")) {
+      CHECK(config["prefill_chunk_size"].is<int64_t>());
+      this->prefill_chunk_size_ = config["prefill_chunk_size"].get<int64_t>();
+    }
+    if (config.count("pipeline_decode")) {
+      CHECK(config["pipeline_decode"].is<bool>());
+      this->pipeline_decode_ = config["pipeline_decode"].get<bool>();
+    }
+    if (config.count("attention_sink_size")) {
+      CHECK(config["attention_sink_size"].is<int64_t>());
+      this->attention_sink_size_ = config["attention_sink_size"].get<int64_t>();
+      CHECK_GE(this->attention_sink_size_, 0) << "attention_sink_size must be non-negative!";
+    }
     if (config.count("shift_fill_factor")) {
       CHECK(config["shift_fill_factor"].is<double>());
       this->shift_fill_factor_ = config["shift_fill_factor"].get<double>();
@@ -494,6 +620,35 @@ class LLMChat {
     this->ResetChat();
   }
 
+  /*!
+   * \brief Load a draft model for speculative decoding. It must share the tokenizer of
+   *  the model, and is typically a much smaller model of the same family.
+   * \param lib_path The library of the draft model.
+   * \param model_path The path of the draft model.
+   */
+  void LoadDraftModel(String lib_path, String model_path) {
+    {
+      std::ifstream config_istream((model_path + "/mlc-chat-config.json").c_str());
+      std::ostringstream config_ostream;
+      ICHECK(config_istream);
+      config_ostream << config_istream.rdbuf();
+      picojson::value config_json;
+      std::string err = picojson::parse(config_json, config_ostream.str());
+      CHECK(err.empty()) << err;
+      picojson::object config = config_json.get<picojson::object>();
+      CHECK(config.count("vocab_size") && config["vocab_size"].is<int64_t>())
+          << "Key \"vocab_size\" not found.";
+      CHECK_EQ(config["vocab_size"].get<int64_t>(), this->vocab_size_)
+          << "The draft model must have the same vocabulary as the model";
+    }
+    this->draft_ft_.Init(lib_path, device_, /*num_shards=*/1);
+    CHECK(this->draft_ft_.support_backtracking_kv_)
+        << "The draft model must support popping tokens from its KV cache";
+    this->draft_params_ = draft_ft_.LoadParams(model_path, device_);
+    this->draft_kv_cache_ = draft_ft_.create_kv_cache_func_();
+    this->draft_kv_len_ = 0;
+  }
+
   void ResetChat() {
     // TODO(mlc-team): add conversation_.Reset to preserve system prompt
     // and initial message.
@@ -504,6 +659,127 @@ class LLMChat {
     this->total_seq_len_ = 0;
   }
 
+  /*!
+   * \brief Add a new sequence with a fresh conversation and its own KV cache.
+   * \param seq_id The id of the new sequence.
+   * \note The new sequence is not activated. Use SwitchSequence to run it.
+   * \note When the model supports batching, the KV cache of the sequence lives in
+   *  the paged KV cache, so that it can be decoded together with other sequences.
+   */
+  void AddSequence(int64_t seq_id) {
+    CHECK(seq_id != current_seq_id_ && !sequences_.count(seq_id))
+        << "Sequence " << seq_id << " already exists";
+    SequenceState state;
+    state.conversation = this->conversation_;
+    state.conversation.Reset();
+    if (ft_.support_batching_) {
+      int64_t num_batched_sequences = std::count_if(
+          sequences_.begin(), sequences_.end(),
+          [](const auto& kv) { return kv.second.kv_slot >= 0; });
+      CHECK_LT(num_batched_sequences, max_batch_size_)
+          << "The number of batched sequences exceeds max_batch_size " << max_batch_size_;
+      if (!paged_kv_cache_.defined()) {
+        // created on demand, by default it holds max_batch_size full-length sequences
+        int64_t capacity = kv_cache_capacity_ > 0 ? kv_cache_capacity_
+                                                  : max_batch_size_ * max_window_size_;
+        paged_kv_cache_ = ft_.create_paged_kv_cache_func_(ShapeTuple({capacity}));
+      }
+      int64_t kv_slot = ft_.fpaged_kv_cache_add_sequence_(paged_kv_cache_);
+      state.kv_slot = kv_slot;
+    } else {
+      state.kv_cache = ft_.create_kv_cache_func_();
+    }
+    sequences_.emplace(seq_id, std::move(state));
+  }
+
+  /*!
+   * \brief Add a new sequence as a copy of the active one, which shares the KV cache
+   *  blocks of the active sequence until either of them writes into a shared block.
+   * \param seq_id The id of the new sequence.
+   * \note The new sequence is not activated. Use SwitchSequence to run it.
+   */
+  void ForkSequence(int64_t seq_id) {
+    CHECK(seq_id != current_seq_id_ && !sequences_.count(seq_id))
+        << "Sequence " << seq_id << " already exists";
+    CHECK_GE(kv_slot_, 0) << "Only the sequences in the paged KV cache can be forked";
+    CHECK(!draft_kv_cache_.defined()) << "Cannot fork a sequence that uses a draft model";
+    int64_t num_batched_sequences = 1 + std::count_if(
+        sequences_.begin(), sequences_.end(),
+        [](const auto& kv) { return kv.second.kv_slot >= 0; });
+    CHECK_LT(num_batched_sequences, max_batch_size_)
+        << "The number of batched sequences exceeds max_batch_size " << max_batch_size_;
+    // swap the active state out to copy it as a whole
+    SequenceState active;
+    this->SwapSequenceState(&active);
+    SequenceState state = active;
+    this->SwapSequenceState(&active);
+    state.kv_slot = ft_.fpaged_kv_cache_fork_sequence_(paged_kv_cache_, kv_slot_);
+    sequences_.emplace(seq_id, std::move(state));
+  }
+
+  /*!
+   * \brief Fill the conversation of the active sequence with a chat history, which is
+   *  prefilled together with the next input.
+   * \param history_json The JSON array of [role, content] pairs, where role is one of
+   *  "system", "user" and "assistant". A system message replaces the system prompt.
+   */
+  void LoadConversationHistory(const std::string& history_json) {
+    CHECK_EQ(total_seq_len_, 0) << "The history can only be loaded before the first prefill";
+    picojson::value history;
+    std::string err = picojson::parse(history, history_json);
+    if (!err.empty()) {
+      LOG(FATAL) << err;
+      return;
+    }
+    CHECK(history.is<picojson::array>()) << "The chat history is expected to be an array";
+    for (const picojson::value& item : history.get<picojson::array>()) {
+      CHECK(item.is<picojson::array>() && item.get<picojson::array>().size() == 2 &&
+            item.get(0).is<std::string>() && item.get(1).is<std::string>())
+          << "Each message in the chat history is expected to be a [role, content] pair";
+      const std::string& role = item.get(0).get<std::string>();
+      const std::string& content = item.get(1).get<std::string>();
+      if (role == "system") {
+        conversation_.system = content;
+      } else if (role == "user") {
+        conversation_.AppendMessage(conversation_.roles[0], content);
+      } else if (role == "assistant") {
+        conversation_.AppendMessage(conversation_.roles[1], content);
+      } else {
+        LOG(FATAL) << "Unknown role \"" << role << "\" in the chat history";
+      }
+    }
+  }
+
+  /*!
+   * \brief Make the given sequence the active one. The state of the previously
+   *  active sequence is kept so that it can be resumed at token boundaries.
+   * \param seq_id The id of the sequence to activate.
+   */
+  void SwitchSequence(int64_t seq_id) {
+    if (seq_id == current_seq_id_) return;
+    auto it = sequences_.find(seq_id);
+    CHECK(it != sequences_.end()) << "Sequence " << seq_id << " does not exist";
+    SequenceState state = std::move(it->second);
+    sequences_.erase(it);
+    this->SwapSequenceState(&state);
+    sequences_.emplace(current_seq_id_, std::move(state));
+    current_seq_id_ = seq_id;
+  }
+
+  /*!
+   * \brief Remove an inactive sequence and release its KV cache.
+   * \param seq_id The id of the sequence to remove.
+   */
+  void RemoveSequence(int64_t seq_id) {
+    CHECK(seq_id != current_seq_id_) << "Cannot remove the active sequence " << seq_id;
+    auto it = sequences_.find(seq_id);
+    CHECK(it != sequences_.end()) << "Sequence " << seq_id << " does not exist";
+    if (it->second.kv_slot >= 0) {
+      ft_.fpaged_kv_cache_remove_sequence_(paged_kv_cache_, it->second.kv_slot);
+    }
+    sequences_.erase(it);
+  }
+
   /*! \brief reset the runtime stats. */
   void ResetRuntimeStats() {
     this->prefill_total_tokens = 0;
@@ -526,13 +802,29 @@ class LLMChat {
     return os.str();
   }
 
+  static void ConcatPromptTokens(const std::vector<std::vector<int32_t>>& prompt_tokens,
+                                 size_t prefix_end, size_t suffix_start,
+                                 std::vector<int32_t>* tokens) {
+    for (size_t i = 0; i < prefix_end; ++i) {
+      tokens->insert(tokens->end(), prompt_tokens[i].begin(), prompt_tokens[i].end());
+    }
+    for (size_t i = suffix_start; i < prompt_tokens.size(); ++i) {
+      tokens->insert(tokens->end(), prompt_tokens[i].begin(), prompt_tokens[i].end());
+    }
+  }
+
   /**
    * \brief Get input tokens based on history
    * \param place_in_prompt The place of the input message in the prompt.
+   * \note The prompt is encoded as a whole text. The token ids of every entry of the prompt
+   *  array are cached in the conversation, which measure the history when the window shifts,
+   *  and reassemble it without encoding it again when the entries are checked to tokenize the
+   *  same as the whole prompts.
    */
   std::vector<int32_t> GetInputTokens(PlaceInPrompt place_in_prompt = PlaceInPrompt::kAll) {
     std::vector<int32_t> tokens;
     std::vector<std::string> prompts;
+    auto fencode = [this](const std::string& text) { return this->tokenizer_->Encode(text); };
 
     if (this->total_seq_len_ == 0) {
       prompts = this->conversation_.GetPromptArray(place_in_prompt);
@@ -550,9 +842,20 @@ class LLMChat {
     std::string all_prompt = GetConcatPrompt(prompts, 0, 0);
     std::vector<int32_t> encoded = this->tokenizer_->Encode(all_prompt);
     tokens.insert(tokens.end(), encoded.begin(), encoded.end());
+    this->conversation_.CheckPromptTokenArray(prompts, encoded, fencode);
     if (this->total_seq_len_ + tokens.size() + this->mean_gen_len_ < this->max_window_size_) {
       return tokens;
     }
+    if (this->total_seq_len_ > 0 && this->UseAttentionSink()) {
+      // evict the KV entries after the sinks, keeping the recent ones, instead of re-prefilling
+      int64_t num_keep = std::min<int64_t>(
+          this->max_window_size_ - tokens.size() - this->mean_gen_len_ - 1,
+          static_cast<int64_t>(this->shift_fill_factor_ * this->max_window_size_));
+      if (num_keep >= this->attention_sink_size_) {
+        this->EvictKVCache(num_keep);
+        return tokens;
+      }
+    }
     // need shift window and re-encode
     this->total_seq_len_ = 0;
     this->ResetKVCache();
@@ -565,25 +868,28 @@ class LLMChat {
                     this->conversation_.prefix_tokens.end());
     }
     std::vector<std::string> all_prompts = this->conversation_.GetPromptArray();
+    std::vector<std::vector<int32_t>> all_prompt_tokens =
+        this->conversation_.GetPromptTokenArray(all_prompts, fencode);
     // get estimate of the fragment
-    size_t ctx_length = this->tokenizer_->Encode(all_prompts[0]).size();
+    size_t ctx_length = all_prompt_tokens[0].size();
     size_t start_re_encode_pos = 0;
-    for (int i = all_prompts.size() - 1; i > 0; --i) {
-      ctx_length += this->tokenizer_->Encode(all_prompts[i]).size();
+    for (int i = all_prompt_tokens.size() - 1; i > 0; --i) {
+      ctx_length += all_prompt_tokens[i].size();
       if (ctx_length >= this->shift_fill_factor_ * this->max_window_size_ &&
-          i + 2 < all_prompts.size()) {
+          i + 2 < all_prompt_tokens.size()) {
         start_re_encode_pos = i;
         break;
       }
     }
     // keep system
-    if (this->conversation_.system.empty()) {
-      all_prompt = GetConcatPrompt(all_prompts, 0, start_re_encode_pos);
+    size_t prefix_end = this->conversation_.system.empty() ? 0 : 1;
+    if (this->conversation_.PromptTokensConcatenable()) {
+      ConcatPromptTokens(all_prompt_tokens, prefix_end, start_re_encode_pos, &tokens);
     } else {
-      all_prompt = GetConcatPrompt(all_prompts, 1, start_re_encode_pos);
+      encoded = this->tokenizer_->Encode(
+          GetConcatPrompt(all_prompts, prefix_end, start_re_encode_pos));
+      tokens.insert(tokens.end(), encoded.begin(), encoded.end());
     }
-    encoded = this->tokenizer_->Encode(all_prompt);
-    tokens.insert(tokens.end(), encoded.begin(), encoded.end());
     if (tokens.size() >= this->max_window_size_) {
       LOG(WARNING)
           << "The prompt tokens are more than `max_window_size`, the input will be truncated.";
@@ -628,6 +934,7 @@ class LLMChat {
 
   std::vector<int32_t> PrepareBeforeEmbedding(std::string inp, bool append_conversation = true,
                                               PlaceInPrompt place_in_prompt = PlaceInPrompt::kAll) {
+    this->DropPipelinedForward();
     if (conversation_.separator_style == SeparatorStyle::kLM ||
         conversation_.separator_style == SeparatorStyle::kCodeCompletion) {
       this->ResetChat();
@@ -637,8 +944,15 @@ class LLMChat {
     }
     output_ids_.clear();
     appeared_token_ids_.clear();
+    output_logprob_ = 0;
+    output_sample_time_ = 0;
     output_message_.clear();
+    output_token_text_end_.clear();
+    detok_prefix_offset_ = 0;
+    detok_read_offset_ = 0;
+    delta_message_pos_ = 0;
     stop_triggered_ = false;
+    stopped_by_length_ = false;
     if (append_conversation) {
       conversation_.AppendMessage(conversation_.roles[0], inp);
       conversation_.AppendReplyHeader(conversation_.roles[1]);
@@ -681,6 +995,130 @@ class LLMChat {
     return embedding;
   }
 
+  /*!
+   * \brief Get the token embeddings of a batch of texts, each embedded as a standalone
+   *  prompt. The conversation and the KV cache are left untouched.
+   * \param inputs The token ids of the input texts.
+   * \return The embeddings right-padded to the longest input, in shape (batch_size, n, hidden),
+   *  and the number of valid tokens of each input.
+   */
+  Array<ObjectRef> EmbedBatch(const std::vector<std::vector<int32_t>>& inputs) {
+    CHECK(!ft_.use_disco) << "NotImplementedError: Distributed inference is not supported for "
+                             "batched embedding";
+    CHECK(ft_.embed_func_.defined())
+        << "In order to use the embedding functionality, make sure you "
+           "build the model in MLC-LLM with `sep_embed` option on.";
+    auto tstart = std::chrono::high_resolution_clock::now();
+
+    int64_t batch_size = inputs.size();
+    std::vector<std::vector<int32_t>> input_tokens;
+    std::vector<int64_t> input_lens;
+    int64_t max_input_len = 1;
+    for (const std::vector<int32_t>& inp : inputs) {
+      input_tokens.push_back(this->GetEmbeddingInputTokens(inp));
+      input_lens.push_back(input_tokens.back().size());
+      max_input_len = std::max(max_input_len, input_lens.back());
+    }
+
+    NDArray embeddings{nullptr};
+    if (ft_.embed_batch_func_.defined()) {
+      // embed all the inputs in one call
+      NDArray input_data = this->GetPaddedEmbeddingInput(input_tokens, max_input_len);
+      embeddings = ft_.embed_batch_func_(input_data, params_);
+    } else {
+      // the model library predates embed_batch, gather the embeddings one by one on CPU
+      for (int64_t i = 0; i < batch_size; ++i) {
+        NDArray embedding = ft_.embed_func_(this->GetInputTokenNDArray(input_tokens[i]), params_);
+        int64_t hidden_size = embedding->shape[2];
+        size_t token_bytes =
+            hidden_size * ((embedding->dtype.bits * embedding->dtype.lanes + 7) / 8);
+        if (!embeddings.defined()) {
+          embeddings = NDArray::Empty({batch_size, max_input_len, hidden_size}, embedding->dtype,
+                                      DLDevice{kDLCPU, 0});
+          std::memset(embeddings->data, 0, batch_size * max_input_len * token_bytes);
+        }
+        NDArray embedding_on_cpu = embedding.CopyTo(DLDevice{kDLCPU, 0});
+        TVMSynchronize(device_.device_type, device_.device_id, nullptr);
+        std::memcpy(static_cast<char*>(embeddings->data) + i * max_input_len * token_bytes,
+                    embedding_on_cpu->data, input_lens[i] * token_bytes);
+      }
+    }
+    TVMSynchronize(device_.device_type, device_.device_id, nullptr);
+
+    auto tend = std::chrono::high_resolution_clock::now();
+    this->embed_total_time += static_cast<double>((tend - tstart).count()) / 1e9;
+    return {embeddings, ShapeTuple(input_lens)};
+  }
+
+  /*!
+   * \brief Embed a batch of texts like EmbedBatch, and pool the embeddings of each text into
+   *  one vector on device, so that only the pooled vectors need to be copied to the host.
+   * \param inputs The token ids of the input texts.
+   * \param last_token Whether to take the embedding of the last token instead of the mean.
+   * \param normalize Whether to L2-normalize the pooled vectors.
+   * \return The pooled float32 vectors in shape (batch_size, hidden), or nothing when the
+   *  model does not provide the embed_pooled function.
+   */
+  Optional<NDArray> EmbedPooled(const std::vector<std::vector<int32_t>>& inputs,
+                                bool last_token, bool normalize) {
+    if (!ft_.embed_pooled_func_.defined() || ft_.use_disco) {
+      return NullOpt;
+    }
+    auto tstart = std::chrono::high_resolution_clock::now();
+
+    int64_t batch_size = inputs.size();
+    std::vector<std::vector<int32_t>> input_tokens;
+    std::vector<int32_t> input_lens;
+    int64_t max_input_len = 1;
+    for (const std::vector<int32_t>& inp : inputs) {
+      input_tokens.push_back(this->GetEmbeddingInputTokens(inp));
+      input_lens.push_back(input_tokens.back().size());
+      max_input_len = std::max(max_input_len, static_cast<int64_t>(input_lens.back()));
+    }
+    NDArray input_data = this->GetPaddedEmbeddingInput(input_tokens, max_input_len);
+    NDArray input_lens_data =
+        this->CopyToDeviceBuffer(input_lens, ShapeTuple({batch_size}), &embed_batch_input_lens_);
+    NDArray pooling_params_data = this->CopyToDeviceBuffer(
+        {last_token ? 1 : 0, normalize ? 1 : 0}, ShapeTuple({2}), &embed_pooling_params_);
+    NDArray pooled =
+        ft_.embed_pooled_func_(input_data, input_lens_data, pooling_params_data, params_);
+    TVMSynchronize(device_.device_type, device_.device_id, nullptr);
+
+    auto tend = std::chrono::high_resolution_clock::now();
+    this->embed_total_time += static_cast<double>((tend - tstart).count()) / 1e9;
+    return pooled;
+  }
+
+  /*!
+   * \brief Tokenize a text without any prompt around it.
+   * \param text The text.
+   * \return The token ids.
+   */
+  std::vector<int32_t> Tokenize(const std::string& text) { return tokenizer_->Encode(text); }
+
+  // the tokens of a text embedded as a standalone prompt, the same as EmbedStep with kMiddle
+  std::vector<int32_t> GetEmbeddingInputTokens(const std::vector<int32_t>& text_tokens) {
+    std::vector<int32_t> tokens = conversation_.prefix_tokens;
+    if (conversation_.add_bos) {
+      tokens.push_back(bos_token_id_);
+    }
+    tokens.insert(tokens.end(), text_tokens.begin(), text_tokens.end());
+    return tokens;
+  }
+
+  // right-pad the token ids to the given length, and copy them to device
+  NDArray GetPaddedEmbeddingInput(const std::vector<std::vector<int32_t>>& input_tokens,
+                                  int64_t max_input_len) {
+    int64_t batch_size = input_tokens.size();
+    std::vector<int32_t> padded_tokens(batch_size * max_input_len, 0);
+    for (int64_t i = 0; i < batch_size; ++i) {
+      std::copy(input_tokens[i].begin(), input_tokens[i].end(),
+                padded_tokens.begin() + i * max_input_len);
+    }
+    return this->CopyToDeviceBuffer(padded_tokens, ShapeTuple({batch_size, max_input_len}),
+                                    &embed_batch_input_ids_);
+  }
+
   /*!
    * \brief Prefill given embeddings. Can optionally decode the output next token.
    * \param embedding The embedding to prefill with.
@@ -697,6 +1135,7 @@ class LLMChat {
     auto tstart = std::chrono::high_resolution_clock::now();
     int64_t token_len = embedding.Shape()[1];
     NDArray logits_on_device = this->ForwardEmbeddings(embedding, total_seq_len_);
+    prompt_len_ = total_seq_len_;
 
     if (!decode_next_token) {
       auto tend = std::chrono::high_resolution_clock::now();
@@ -720,10 +1159,15 @@ class LLMChat {
    * \param append_conversation Whether to append the input message to conversation.
    * \param decode_next_token Whether to decode next token.
    * \param place_in_prompt The place of the input message in the prompt.
+   * \param fork_seq_ids The ids of the new sequences forked from the active one after the
+   *  prompt is prefilled, which share its KV cache and sample their own next tokens.
    */
   void PrefillStep(std::string inp, bool append_conversation = true, bool decode_next_token = true,
-                   PlaceInPrompt place_in_prompt = PlaceInPrompt::kAll) {
-    if (ft_.embed_func_.defined() && ft_.prefill_with_embed_func_.defined()) {
+                   PlaceInPrompt place_in_prompt = PlaceInPrompt::kAll,
+                   const std::vector<int64_t>& fork_seq_ids = {}) {
+    CHECK(fork_seq_ids.empty() || (kv_slot_ >= 0 && decode_next_token))
+        << "Only the sequences in the paged KV cache can be forked after prefill";
+    if (ft_.embed_func_.defined() && ft_.prefill_with_embed_func_.defined() && kv_slot_ < 0) {
       // Temporarily placed inside `PrefillStep` for compatibility in transition.
       // Will be separated out in the future.
       if (ft_.use_disco) {
@@ -734,34 +1178,192 @@ class LLMChat {
       return;
     }
 
+    int64_t num_pending = this->BeginPrefill(inp, append_conversation, place_in_prompt);
+    // long prompts are prefilled in chunks, which bounds the activation memory
+    while (num_pending > 0) {
+      int64_t chunk_size = prefill_chunk_size_ > 0 ? prefill_chunk_size_ : num_pending;
+      num_pending = this->ContinuePrefill(chunk_size, decode_next_token, fork_seq_ids);
+    }
+  }
+
+  /*!
+   * \brief Start prefilling the input into the active sequence, whose prompt tokens are
+   *  prefilled by ContinuePrefill, in chunks when it is called with a chunk size.
+   * \param inp The input text string.
+   * \param append_conversation Whether to append the input message to conversation.
+   * \param place_in_prompt The place of the input message in the prompt.
+   * \return The number of prompt tokens to prefill.
+   */
+  int64_t BeginPrefill(std::string inp, bool append_conversation = true,
+                       PlaceInPrompt place_in_prompt = PlaceInPrompt::kAll) {
+    CHECK(!(ft_.embed_func_.defined() && ft_.prefill_with_embed_func_.defined() && kv_slot_ < 0))
+        << "Prefill in chunks is not supported with the separate embedding";
     std::vector<int32_t> prompt_tokens =
         this->PrepareBeforeEmbedding(inp, append_conversation, place_in_prompt);
-    int64_t token_len = static_cast<int64_t>(prompt_tokens.size());
-    if (token_len == 0) return;
+    pending_prefill_tokens_.clear();
+    prefill_prompt_tokens_.clear();
+    if (prompt_tokens.empty()) return 0;
+    prefill_from_start_ = total_seq_len_ == 0;
+    int64_t num_cached = this->AttachCachedPrefix(prompt_tokens);
+    pending_prefill_tokens_.assign(prompt_tokens.begin() + num_cached, prompt_tokens.end());
+    prefill_prompt_tokens_ = std::move(prompt_tokens);
+    return pending_prefill_tokens_.size();
+  }
 
+  /*!
+   * \brief Prefill the next chunk of the prompt tokens of the active sequence, and sample the
+   *  first output token after the last chunk.
+   * \param max_tokens The maximum number of prompt tokens prefilled.
+   * \param decode_next_token Whether to decode the next token after the last chunk.
+   * \param fork_seq_ids The ids of the new sequences forked from the active sequence after the
+   *  last chunk, which sample their own first tokens.
+   * \return The number of prompt tokens still to prefill.
+   */
+  int64_t ContinuePrefill(int64_t max_tokens, bool decode_next_token = true,
+                          const std::vector<int64_t>& fork_seq_ids = {}) {
+    CHECK(!pending_prefill_tokens_.empty()) << "The active sequence has no prompt to prefill";
+    CHECK_GT(max_tokens, 0) << "The chunk size of prefill must be positive";
     auto tstart = std::chrono::high_resolution_clock::now();
 
+    int64_t token_len =
+        std::min<int64_t>(max_tokens, static_cast<int64_t>(pending_prefill_tokens_.size()));
+    std::vector<int32_t> new_tokens(pending_prefill_tokens_.begin(),
+                                    pending_prefill_tokens_.begin() + token_len);
+    pending_prefill_tokens_.erase(pending_prefill_tokens_.begin(),
+                                  pending_prefill_tokens_.begin() + token_len);
     int32_t new_seq_len = total_seq_len_ + token_len;
-    NDArray logits_on_device = this->ForwardTokens(prompt_tokens, new_seq_len);
+    NDArray logits_on_device = this->ForwardTokens(new_tokens, new_seq_len);
     total_seq_len_ = new_seq_len;
+    this->prefill_total_tokens += token_len;
 
-    if (!decode_next_token) {
+    if (!pending_prefill_tokens_.empty() || !decode_next_token) {
+      if (pending_prefill_tokens_.empty()) {
+        this->FinishPrefill();
+      }
       auto tend = std::chrono::high_resolution_clock::now();
       this->prefill_total_time += static_cast<double>((tend - tstart).count()) / 1e9;
-      this->prefill_total_tokens += token_len;
-      return;
+      return pending_prefill_tokens_.size();
     }
+    this->FinishPrefill();
 
+    // the forks are taken before sampling, so that every sequence samples from the logits
+    for (int64_t fork_seq_id : fork_seq_ids) {
+      this->ForkSequence(fork_seq_id);
+    }
     int32_t next_token = this->SampleTokenFromLogits(logits_on_device, temperature_, top_p_);
 
     auto tend = std::chrono::high_resolution_clock::now();
 
     this->prefill_total_time += static_cast<double>((tend - tstart).count()) / 1e9;
-    this->prefill_total_tokens += token_len;
     this->ProcessNextToken(next_token);
+
+    int64_t seq_id = current_seq_id_;
+    for (int64_t fork_seq_id : fork_seq_ids) {
+      this->SwitchSequence(fork_seq_id);
+      this->ProcessNextToken(this->SampleTokenFromLogits(logits_on_device, temperature_, top_p_));
+    }
+    this->SwitchSequence(seq_id);
+    return 0;
+  }
+
+  /*! \brief Record the prompt of the active sequence after its last chunk is prefilled. */
+  void FinishPrefill() {
+    prompt_len_ = total_seq_len_;
+    if (prefill_from_start_) {
+      this->InsertPrefixCache(prefill_prompt_tokens_);
+    }
+    prefill_prompt_tokens_.clear();
+  }
+
+  /*! \return Whether the prompts of the active sequence are cached for reuse. */
+  bool UsePrefixCache() const {
+    int64_t capacity = prefix_cache_capacity_ < 0 ? max_window_size_ : prefix_cache_capacity_;
+    return kv_slot_ >= 0 && capacity > 0;
+  }
+
+  /*!
+   * \brief Start the empty active sequence with the longest cached prefix of the prompt.
+   * \param prompt_tokens The prompt of the sequence.
+   * \return The number of leading prompt tokens whose KV is reused.
+   */
+  int64_t AttachCachedPrefix(const std::vector<int32_t>& prompt_tokens) {
+    if (!this->UsePrefixCache() || total_seq_len_ != 0) return 0;
+    PrefixCache::MatchResult match = prefix_cache_.Match(prompt_tokens);
+    if (!match.snapshot.defined()) return 0;
+    int64_t block_size = ft_.fpaged_kv_cache_block_size_(paged_kv_cache_);
+    // only full blocks are shared, and the last prompt token is always computed for its logits
+    int64_t num_blocks =
+        std::min<int64_t>(match.length, prompt_tokens.size() - 1) / block_size;
+    if (num_blocks == 0) return 0;
+    ShapeTuple blocks = Downcast<ShapeTuple>(match.snapshot);
+    ft_.fpaged_kv_cache_attach_prefix_(paged_kv_cache_, kv_slot_,
+                                       ShapeTuple(blocks.begin(), blocks.begin() + num_blocks));
+    total_seq_len_ = num_blocks * block_size;
+    return total_seq_len_;
+  }
+
+  /*!
+   * \brief Cache the full blocks of the prompt just prefilled into the active sequence.
+   * \param prompt_tokens The prompt of the sequence.
+   */
+  void InsertPrefixCache(const std::vector<int32_t>& prompt_tokens) {
+    if (!this->UsePrefixCache()) return;
+    int64_t block_size = ft_.fpaged_kv_cache_block_size_(paged_kv_cache_);
+    int64_t num_blocks = prompt_tokens.size() / block_size;
+    if (num_blocks == 0) return;
+    ShapeTuple seq_blocks = ft_.fpaged_kv_cache_get_blocks_(paged_kv_cache_, kv_slot_);
+    ShapeTuple blocks(seq_blocks.begin(), seq_blocks.begin() + num_blocks);
+    std::vector<int32_t> tokens(prompt_tokens.begin(),
+                                prompt_tokens.begin() + num_blocks * block_size);
+    ft_.fpaged_kv_cache_retain_blocks_(paged_kv_cache_, blocks);
+    if (!prefix_cache_.Insert(tokens, blocks)) {
+      ft_.fpaged_kv_cache_release_blocks_(paged_kv_cache_, blocks);
+      return;
+    }
+    int64_t capacity = prefix_cache_capacity_ < 0 ? max_window_size_ : prefix_cache_capacity_;
+    while (prefix_cache_.NumCachedTokens() > capacity && this->EvictPrefixCache()) {
+    }
+  }
+
+  /*!
+   * \brief Drop the least recently used prompt from the prefix cache.
+   * \return Whether a prompt is dropped.
+   */
+  bool EvictPrefixCache() {
+    ObjectRef blocks = prefix_cache_.EvictOne();
+    if (!blocks.defined()) return false;
+    ft_.fpaged_kv_cache_release_blocks_(paged_kv_cache_, Downcast<ShapeTuple>(blocks));
+    return true;
   }
 
   void DecodeStep() {
+    if (pipelined_logits_.defined()) {
+      this->PipelinedDecodeStep();
+      return;
+    }
+    if (total_seq_len_ + 1 > max_window_size_ && this->UseAttentionSink()) {
+      this->EvictKVCache(std::max<int64_t>(
+          attention_sink_size_ + 1, static_cast<int64_t>(shift_fill_factor_ * max_window_size_)));
+    }
+    if (this->CanVerify()) {
+      if (draft_params_.defined()) {
+        if (this->DraftModelDecodeStep()) return;
+      } else if (prompt_lookup_num_tokens_ > 0) {
+        std::vector<int32_t> draft_tokens = this->ProposeDraftTokens();
+        if (!draft_tokens.empty()) {
+          this->SpeculativeDecodeStep(draft_tokens);
+          return;
+        }
+      }
+    }
+    if (this->CanDecodeMultiStep()) {
+      this->MultiStepDecodeStep();
+      return;
+    }
+    if (this->CanPipelineDecode()) {
+      this->PipelinedDecodeStep();
+      return;
+    }
     ICHECK(!output_ids_.empty());
     int32_t last_token = output_ids_.back();
     tvm::runtime::NDArray input_data = GetInputTokenNDArray({last_token});
@@ -780,8 +1382,535 @@ class LLMChat {
     this->ProcessNextToken(next_token);
   }
 
+  /*!
+   * \brief Whether the next decode steps of the active sequence can run in one call of
+   *  decode_n, which takes the argmax of every step on device. It requires greedy decoding
+   *  without repetition penalty, KV cache pop-back, and room for all the steps in the window.
+   */
+  bool CanDecodeMultiStep() const {
+    return ft_.decode_n_func_ != nullptr && ft_.decode_n_steps_ > 1 && !ft_.use_disco &&
+           ft_.support_backtracking_kv_ && kv_slot_ < 0 && temperature_ < 1e-6f &&
+           repetition_penalty_ == 1.0f && total_seq_len_ + ft_.decode_n_steps_ < max_window_size_;
+  }
+
+  /*!
+   * \brief Run decode_n_steps greedy decode steps in one call, and process the tokens
+   *  afterwards. When the generation stops early, the inputs of the steps after the stop
+   *  are popped from the KV cache.
+   */
+  void MultiStepDecodeStep() {
+    ICHECK(!output_ids_.empty());
+    int64_t num_steps = ft_.decode_n_steps_;
+    int32_t last_token = output_ids_.back();
+    NDArray input_data = this->GetInputTokenNDArray({last_token});
+
+    auto tstart = std::chrono::high_resolution_clock::now();
+
+    Array<ObjectRef> ret =
+        ft_.decode_n_func_(input_data, ShapeTuple({total_seq_len_ + 1}), kv_cache_, params_);
+    NDArray token_ids = Downcast<NDArray>(ret[0]).CopyTo(DLDevice{kDLCPU, 0});
+    TVMSynchronize(device_.device_type, device_.device_id, nullptr);
+    const int32_t* next_tokens = static_cast<const int32_t*>(token_ids->data);
+    // every step has run its input, the last token and all the next tokens but the last one
+    kv_token_ids_.push_back(last_token);
+    kv_token_ids_.insert(kv_token_ids_.end(), next_tokens, next_tokens + num_steps - 1);
+    total_seq_len_ += num_steps;
+
+    auto tend = std::chrono::high_resolution_clock::now();
+
+    int64_t num_processed = 0;
+    while (num_processed < num_steps && !stop_triggered_) {
+      this->ProcessNextToken(next_tokens[num_processed++]);
+    }
+    this->PopKVCache(num_steps - num_processed);
+
+    this->decode_total_time += static_cast<double>((tend - tstart).count()) / 1e9;
+    this->decode_total_tokens += num_processed;
+  }
+
+  /*!
+   * \brief Whether the forward of the next output token can run before the token is
+   *  processed, which requires KV cache pop-back to drop the forward when a stop string ends
+   *  the generation, and room for the token in the window.
+   */
+  bool CanPipelineDecode() const {
+    return pipeline_decode_ && !ft_.use_disco && ft_.support_backtracking_kv_ && kv_slot_ < 0 &&
+           !draft_params_.defined() && prompt_lookup_num_tokens_ <= 0 &&
+           !this->CanDecodeMultiStep() && total_seq_len_ + 1 < max_window_size_;
+  }
+
+  /*!
+   * \brief Decode a token, and enqueue the forward of it before it is detokenized and checked
+   *  for stop strings, so that the device runs the forward while the host processes the token.
+   *  The logits of the forward are kept for the next step, which waits for them when it
+   *  samples. When a stop string ends the generation, the forward is popped from the KV cache.
+   */
+  void PipelinedDecodeStep() {
+    auto tstart = std::chrono::high_resolution_clock::now();
+
+    NDArray logits_on_device = pipelined_logits_;
+    pipelined_logits_ = NDArray();
+    if (!logits_on_device.defined()) {
+      logits_on_device = this->ForwardTokens({output_ids_.back()}, total_seq_len_ + 1);
+      total_seq_len_ += 1;
+    }
+    int32_t next_token = this->SampleTokenFromLogits(logits_on_device, temperature_, top_p_);
+
+    // no forward is run ahead for the tokens known to end the generation
+    if (!this->CanPipelineDecode() || this->IsStopToken(next_token) ||
+        static_cast<int64_t>(output_ids_.size()) + 1 >= max_gen_len_) {
+      auto tend = std::chrono::high_resolution_clock::now();
+      this->decode_total_time += static_cast<double>((tend - tstart).count()) / 1e9;
+      this->decode_total_tokens += 1;
+      this->ProcessNextToken(next_token);
+      return;
+    }
+    // the forward is asynchronous on the device, the token is processed while it runs
+    NDArray next_logits = this->ForwardTokens({next_token}, total_seq_len_ + 1);
+    int64_t num_popped = this->AppendNextToken(next_token);
+    total_seq_len_ += 1;
+
+    auto tend = std::chrono::high_resolution_clock::now();
+    this->decode_total_time += static_cast<double>((tend - tstart).count()) / 1e9;
+    this->decode_total_tokens += 1;
+
+    if (stop_triggered_) {
+      // a stop string ends the generation, the token run ahead is not part of the output
+      this->PopKVCache(num_popped + 1);
+    } else {
+      pipelined_logits_ = next_logits;
+    }
+  }
+
+  /*!
+   * \brief Remove the forward run ahead by pipelined decoding, when the generation of the
+   *  active sequence is left before it stops, so that the KV cache ends before the last
+   *  output token as in other decode steps.
+   */
+  void DropPipelinedForward() {
+    if (!pipelined_logits_.defined()) return;
+    pipelined_logits_ = NDArray();
+    this->PopKVCache(1);
+  }
+
+  /*!
+   * \brief Whether drafted tokens of the active sequence can be verified together, which
+   *  requires the verify function, KV cache pop-back and the token ids of the whole KV cache.
+   */
+  bool CanVerify() const {
+    return ft_.verify_func_ != nullptr && !ft_.use_disco && ft_.support_backtracking_kv_ &&
+           kv_slot_ < 0 && static_cast<int64_t>(kv_token_ids_.size()) == total_seq_len_;
+  }
+
+  /*! \brief The maximum number of tokens that can be drafted in the next decode step. */
+  int64_t MaxNumDraftTokens(int64_t num_draft) const {
+    // leave room for the verified tokens plus one token sampled after them
+    return std::min<int64_t>({num_draft, max_window_size_ - total_seq_len_ - 2,
+                              max_gen_len_ - static_cast<int64_t>(output_ids_.size()) - 1});
+  }
+
+  /*!
+   * \brief Draft the tokens following the output by prompt lookup: find the latest earlier
+   *  occurrence of the trailing n-gram in the tokens seen so far, and copy what followed it.
+   *  Longer n-grams are tried first.
+   * \return The drafted tokens, empty when no n-gram matches.
+   */
+  std::vector<int32_t> ProposeDraftTokens() const {
+    ICHECK(!output_ids_.empty());
+    // the KV cache holds the prompt and the output, except the last output token
+    std::vector<int32_t> tokens = kv_token_ids_;
+    tokens.push_back(output_ids_.back());
+    int64_t num_draft = this->MaxNumDraftTokens(prompt_lookup_num_tokens_);
+    if (num_draft <= 0) return {};
+
+    int64_t num_tokens = tokens.size();
+    for (int64_t ngram_size = std::min<int64_t>(kMaxPromptLookupNgramSize, num_tokens - 1);
+         ngram_size > 0; --ngram_size) {
+      auto ngram_begin = tokens.end() - ngram_size;
+      for (int64_t start = num_tokens - ngram_size - 1; start >= 0; --start) {
+        if (!std::equal(ngram_begin, tokens.end(), tokens.begin() + start)) continue;
+        int64_t draft_begin = start + ngram_size;
+        int64_t draft_end = std::min(draft_begin + num_draft, num_tokens);
+        return std::vector<int32_t>(tokens.begin() + draft_begin, tokens.begin() + draft_end);
+      }
+    }
+    return {};
+  }
+
+  /*!
+   * \brief Verify the drafted tokens in one forward pass and accept the longest prefix that
+   *  agrees with the tokens sampled from the model, plus the sampled token that follows it.
+   *  As each accepted token is exactly the token sampled at its position, and each position
+   *  is penalized for the drafted tokens before it, the output follows the same distribution
+   *  as decoding one token at a time.
+   * \param draft_tokens The drafted tokens.
+   */
+  void SpeculativeDecodeStep(const std::vector<int32_t>& draft_tokens) {
+    auto tstart = std::chrono::high_resolution_clock::now();
+
+    std::vector<int32_t> input_tokens = {output_ids_.back()};
+    input_tokens.insert(input_tokens.end(), draft_tokens.begin(), draft_tokens.end());
+    int64_t num_input = input_tokens.size();
+    // (1, n, vocab) -> (n, 1, vocab), so that every position is a row to sample from
+    NDArray logits_on_device = this->VerifyTokens(input_tokens);
+    int64_t vocab_size = logits_on_device->shape[2];
+    std::vector<int32_t> sampled_tokens = this->SampleTokensFromRows(
+        logits_on_device.CreateView({num_input, 1, vocab_size}, logits_on_device->dtype),
+        draft_tokens);
+
+    size_t num_accepted = 0;
+    while (num_accepted < draft_tokens.size() &&
+           sampled_tokens[num_accepted] == draft_tokens[num_accepted]) {
+      ++num_accepted;
+    }
+    sampled_tokens.resize(num_accepted + 1);
+    int64_t num_processed = this->CommitVerifiedTokens(sampled_tokens, num_input);
+
+    auto tend = std::chrono::high_resolution_clock::now();
+    this->decode_total_time += static_cast<double>((tend - tstart).count()) / 1e9;
+    this->decode_total_tokens += num_processed;
+  }
+
+  /*!
+   * \brief Run the last output token and the drafted tokens after it in one forward pass.
+   * \param input_tokens The last output token followed by the drafted tokens.
+   * \return The logits of every input position, in shape (1, num_input, vocab_size).
+   */
+  NDArray VerifyTokens(const std::vector<int32_t>& input_tokens) {
+    int64_t num_input = input_tokens.size();
+    NDArray input_data = this->GetInputTokenNDArray(input_tokens);
+    Array<ObjectRef> ret =
+        ft_.verify_func_(input_data, ShapeTuple({total_seq_len_ + num_input}), kv_cache_, params_);
+    kv_token_ids_.insert(kv_token_ids_.end(), input_tokens.begin(), input_tokens.end());
+    total_seq_len_ += num_input;
+    return Downcast<NDArray>(ret[0]);
+  }
+
+  /*!
+   * \brief Drop the rejected drafts from the KV cache and add the verified tokens to the output.
+   * \param next_tokens The accepted drafts followed by the token sampled after them.
+   * \param num_input The number of tokens run by VerifyTokens.
+   * \return The number of tokens added to the output, less than the number of verified
+   *  tokens when the generation stops early.
+   */
+  int64_t CommitVerifiedTokens(const std::vector<int32_t>& next_tokens, int64_t num_input) {
+    int64_t num_accepted = next_tokens.size() - 1;
+    // drop the rejected drafts, the KV cache ends with the last accepted draft
+    this->PopKVCache(num_input - 1 - num_accepted);
+    int64_t num_processed = 0;
+    while (num_processed <= num_accepted && !stop_triggered_) {
+      this->ProcessNextToken(next_tokens[num_processed++]);
+    }
+    // the accepted drafts after an early stop are not part of the output
+    this->PopKVCache(num_accepted + 1 - num_processed);
+    return num_processed;
+  }
+
+  /*!
+   * \brief Decode with the draft model: the draft model proposes tokens one by one, the
+   *  target model verifies them in one forward pass, and the drafts are accepted by
+   *  rejection sampling, so that the output follows the distribution of the target model.
+   * \return Whether the step is done, false if no token can be drafted.
+   */
+  bool DraftModelDecodeStep() {
+    int64_t num_draft = this->MaxNumDraftTokens(draft_num_tokens_);
+    if (num_draft <= 0) return false;
+    auto tstart = std::chrono::high_resolution_clock::now();
+
+    if (!draft_kv_cache_.defined()) {
+      draft_kv_cache_ = draft_ft_.create_kv_cache_func_();
+      draft_kv_len_ = 0;
+    }
+    // feed the draft model the tokens it has not seen, including the last output token
+    std::vector<int32_t> draft_input(kv_token_ids_.begin() + draft_kv_len_, kv_token_ids_.end());
+    draft_input.push_back(output_ids_.back());
+    std::vector<int32_t> draft_tokens;
+    std::vector<std::vector<float>> draft_probs;
+    for (int64_t i = 0; i < num_draft; ++i) {
+      NDArray draft_logits = this->DraftForwardTokens(draft_input);
+      NDArray draft_logits_on_cpu = draft_logits.CopyTo(DLDevice{kDLCPU, 0});
+      TVMSynchronize(device_.device_type, device_.device_id, nullptr);
+      draft_probs.push_back(this->ComputeProbsOnCPU(draft_logits_on_cpu, 0, draft_tokens));
+      draft_tokens.push_back(SampleFromProbVector(draft_probs.back(), GetRandomNumber()));
+      draft_input = {draft_tokens.back()};
+    }
+
+    std::vector<int32_t> input_tokens = {output_ids_.back()};
+    input_tokens.insert(input_tokens.end(), draft_tokens.begin(), draft_tokens.end());
+    NDArray logits_on_cpu = this->VerifyTokens(input_tokens).CopyTo(DLDevice{kDLCPU, 0});
+    TVMSynchronize(device_.device_type, device_.device_id, nullptr);
+    std::vector<int32_t> next_tokens;
+    for (int64_t i = 0; i <= num_draft; ++i) {
+      std::vector<float> probs = this->ComputeProbsOnCPU(
+          logits_on_cpu, i, std::vector<int32_t>(draft_tokens.begin(), draft_tokens.begin() + i));
+      if (i == num_draft) {
+        // all drafts are accepted, sample one more token
+        next_tokens.push_back(SampleFromProbVector(probs, GetRandomNumber()));
+        break;
+      }
+      int32_t draft_token = draft_tokens[i];
+      // accept the draft with probability min(1, p / q)
+      if (GetRandomNumber() * draft_probs[i][draft_token] < probs[draft_token]) {
+        next_tokens.push_back(draft_token);
+        continue;
+      }
+      // otherwise sample from the normalized max(0, p - q)
+      for (size_t j = 0; j < probs.size(); ++j) {
+        probs[j] = std::max(probs[j] - draft_probs[i][j], 0.0f);
+      }
+      next_tokens.push_back(SampleFromProbVector(probs, GetRandomNumber()));
+      break;
+    }
+    int64_t num_processed = this->CommitVerifiedTokens(next_tokens, input_tokens.size());
+
+    auto tend = std::chrono::high_resolution_clock::now();
+    this->decode_total_time += static_cast<double>((tend - tstart).count()) / 1e9;
+    this->decode_total_tokens += num_processed;
+    return true;
+  }
+
+  /*!
+   * \brief Run forward compute of the draft model on the tokens following its KV cache.
+   * \return The logits of the last input token.
+   */
+  NDArray DraftForwardTokens(const std::vector<int32_t>& input_tokens) {
+    draft_kv_len_ += input_tokens.size();
+    ShapeTuple cur_pos_shape = ShapeTuple({draft_kv_len_});
+    Array<ObjectRef> ret;
+    if (input_tokens.size() > 1 && draft_ft_.prefill_func_.defined()) {
+      ret = draft_ft_.prefill_func_(this->GetInputTokenNDArray(input_tokens), cur_pos_shape,
+                                    draft_kv_cache_, draft_params_);
+    } else {
+      for (size_t i = 0; i < input_tokens.size(); ++i) {
+        int64_t pos = draft_kv_len_ + 1 + i - static_cast<int64_t>(input_tokens.size());
+        ShapeTuple pos_shape = ShapeTuple({pos});
+        ret = draft_ft_.decode_func_(this->GetInputTokenNDArray({input_tokens[i]}), pos_shape,
+                                     draft_kv_cache_, draft_params_);
+      }
+    }
+    return Downcast<NDArray>(ret[0]);
+  }
+
+  /*!
+   * \brief Compute the distribution that a token is sampled from, given one row of logits.
+   *  It applies the same repetition penalty, temperature, top-k and top-p as the sampling
+   *  functions. Greedy decoding gives the one-hot distribution of the most likely token.
+   * \param logits_on_cpu The logits of shape (num_rows, 1, vocab_size).
+   * \param row The row of logits.
+   * \param drafted_tokens The drafted tokens before the row, penalized as if appeared.
+   */
+  std::vector<float> ComputeProbsOnCPU(const NDArray& logits_on_cpu, int64_t row,
+                                       const std::vector<int32_t>& drafted_tokens = {}) {
+    this->LoadCPULogitsRow(logits_on_cpu, row);
+    if (repetition_penalty_ != 1.0f) {
+      this->ApplyRepetitionPenaltyOnCPU(drafted_tokens);
+    }
+    int64_t vocab_size = logits_on_cpu_->shape[2];
+    const float* data = static_cast<const float*>(logits_on_cpu_->data);
+    std::vector<float> probs(vocab_size, 0.0f);
+    if (temperature_ < 1e-6f) {
+      probs[std::max_element(data, data + vocab_size) - data] = 1.0f;
+      return probs;
+    }
+    this->ApplyTopKOnCPU();
+    this->ApplySoftmaxWithTemperatureOnCPU();
+    // keep the smallest set of most likely tokens whose probabilities add up to top_p
+    std::vector<int32_t> order(vocab_size);
+    std::iota(order.begin(), order.end(), 0);
+    std::sort(order.begin(), order.end(),
+              [data](int32_t a, int32_t b) { return data[a] > data[b]; });
+    float cumsum = 0.0f;
+    for (int32_t token : order) {
+      probs[token] = data[token];
+      cumsum += data[token];
+      if (cumsum >= top_p_) break;
+    }
+    return probs;
+  }
+
+  /*!
+   * \brief Sample from an unnormalized distribution.
+   * \param probs The unnormalized probabilities.
+   * \param uniform_sample A random number in [0, 1).
+   */
+  static int32_t SampleFromProbVector(const std::vector<float>& probs, double uniform_sample) {
+    double threshold = uniform_sample * std::accumulate(probs.begin(), probs.end(), 0.0);
+    double cumsum = 0.0;
+    int32_t last_nonzero = 0;
+    for (size_t i = 0; i < probs.size(); ++i) {
+      if (probs[i] <= 0.0f) continue;
+      cumsum += probs[i];
+      last_nonzero = i;
+      if (cumsum > threshold) return i;
+    }
+    return last_nonzero;
+  }
+
+  /*!
+   * \brief Sample one token from each row of the logits of the active sequence.
+   *  Row i follows the first i drafted tokens, which are penalized as if they had
+   *  appeared in the output.
+   * \param logits_on_device The logits of shape (num_rows, 1, vocab_size).
+   * \param drafted_tokens The drafted tokens the rows follow.
+   * \return The sampled token ids.
+   */
+  std::vector<int32_t> SampleTokensFromRows(NDArray logits_on_device,
+                                            const std::vector<int32_t>& drafted_tokens) {
+    auto tstart = std::chrono::high_resolution_clock::now();
+    int64_t num_rows = logits_on_device->shape[0];
+    std::vector<int32_t> next_tokens;
+    if (ft_.sample_func_ != nullptr) {
+      std::vector<std::vector<int32_t>> penalty_token_ids;
+      if (repetition_penalty_ != 1.0f) {
+        std::unordered_set<int32_t> appeared = appeared_token_ids_;
+        for (int64_t i = 0; i < num_rows; ++i) {
+          if (i > 0) appeared.insert(drafted_tokens[i - 1]);
+          penalty_token_ids.emplace_back(appeared.begin(), appeared.end());
+        }
+      }
+      next_tokens = this->SampleTokensOnDevice(logits_on_device, penalty_token_ids);
+    } else {
+      NDArray logits_on_cpu = logits_on_device.CopyTo(DLDevice{kDLCPU, 0});
+      TVMSynchronize(device_.device_type, device_.device_id, nullptr);
+      for (int64_t i = 0; i < num_rows; ++i) {
+        next_tokens.push_back(this->SampleTokenFromCPULogitsRow(
+            logits_on_cpu, i,
+            std::vector<int32_t>(drafted_tokens.begin(), drafted_tokens.begin() + i)));
+      }
+    }
+    auto tend = std::chrono::high_resolution_clock::now();
+    this->sample_total_time += static_cast<double>((tend - tstart).count()) / 1e9;
+    return next_tokens;
+  }
+
+  /*! \brief Copy one row of logits of shape (num_rows, 1, vocab_size) to logits_on_cpu_. */
+  void LoadCPULogitsRow(const NDArray& logits_on_cpu, int64_t row) {
+    int64_t vocab_size = logits_on_cpu->shape[2];
+    if (!logits_on_cpu_.defined() || logits_on_cpu_->shape[2] != vocab_size) {
+      logits_on_cpu_ =
+          NDArray::Empty({1, 1, vocab_size}, DataType::Float(32), DLDevice{kDLCPU, 0});
+    }
+    std::memcpy(logits_on_cpu_->data,
+                static_cast<const float*>(logits_on_cpu->data) + row * vocab_size,
+                vocab_size * sizeof(float));
+  }
+
+  /*!
+   * \brief Sample a token from one row of logits on CPU, in the same way as
+   *  SampleTokenFromLogits, with the repetition penalty of the active sequence.
+   * \param logits_on_cpu The logits of shape (num_rows, 1, vocab_size).
+   * \param row The row to sample from.
+   * \param drafted_tokens The drafted tokens before the row, penalized as if appeared.
+   */
+  int32_t SampleTokenFromCPULogitsRow(const NDArray& logits_on_cpu, int64_t row,
+                                      const std::vector<int32_t>& drafted_tokens = {}) {
+    this->LoadCPULogitsRow(logits_on_cpu, row);
+    if (repetition_penalty_ != 1.0f) {
+      this->ApplyRepetitionPenaltyOnCPU(drafted_tokens);
+    }
+    if (temperature_ < 1e-6f) {
+      return this->SampleFromLogitsOnCPU();
+    }
+    this->ApplyTopKOnCPU();
+    this->ApplySoftmaxWithTemperatureOnCPU();
+    int32_t next_token = this->SampleFromProbOnCPU();
+    sampled_logprob_ = this->ProbOnCPULog(next_token);
+    return next_token;
+  }
+
+  /*!
+   * \brief Decode the next token of each of the given sequences. The sequences in
+   *  the paged KV cache are decoded together in a single forward pass, the others
+   *  are decoded one after another.
+   * \param seq_ids The ids of the sequences to decode.
+   */
+  void BatchDecodeStep(const std::vector<int64_t>& seq_ids) {
+    int64_t restore_seq_id = current_seq_id_;
+    std::vector<int64_t> batch_seq_ids;
+    std::vector<int64_t> kv_slots;
+    std::vector<std::vector<int32_t>> input_tokens;
+    std::vector<std::vector<int32_t>> penalty_token_ids;
+    for (int64_t seq_id : seq_ids) {
+      this->SwitchSequence(seq_id);
+      if (kv_slot_ < 0) {
+        this->DecodeStep();
+        continue;
+      }
+      ICHECK(!output_ids_.empty());
+      batch_seq_ids.push_back(seq_id);
+      kv_slots.push_back(kv_slot_);
+      input_tokens.push_back({output_ids_.back()});
+      if (ft_.sample_func_ != nullptr && repetition_penalty_ != 1.0f) {
+        penalty_token_ids.emplace_back(appeared_token_ids_.begin(), appeared_token_ids_.end());
+      }
+    }
+
+    if (!batch_seq_ids.empty()) {
+      auto tstart = std::chrono::high_resolution_clock::now();
+
+      NDArray logits_on_device = this->BatchForwardTokens(kv_slots, input_tokens);
+      if (ft_.sample_func_ != nullptr) {
+        // only the sampled token ids are copied back
+        auto sample_tstart = std::chrono::high_resolution_clock::now();
+        std::vector<double> logprobs;
+        std::vector<int32_t> next_tokens =
+            this->SampleTokensOnDevice(logits_on_device, penalty_token_ids, &logprobs);
+        auto sample_tend = std::chrono::high_resolution_clock::now();
+        double sample_time = static_cast<double>((sample_tend - sample_tstart).count()) / 1e9;
+        this->sample_total_time += sample_time;
+        for (size_t i = 0; i < batch_seq_ids.size(); ++i) {
+          this->SwitchSequence(batch_seq_ids[i]);
+          total_seq_len_ += 1;
+          // the batch is sampled together, every sequence takes an equal share
+          output_sample_time_ += sample_time / batch_seq_ids.size();
+          sampled_logprob_ = logprobs[i];
+          this->ProcessNextToken(next_tokens[i]);
+        }
+        auto tend = std::chrono::high_resolution_clock::now();
+        this->decode_total_time += static_cast<double>((tend - tstart).count()) / 1e9;
+        this->decode_total_tokens += batch_seq_ids.size();
+        this->SwitchSequence(restore_seq_id);
+        return;
+      }
+      NDArray batch_logits_on_cpu = logits_on_device.CopyTo(DLDevice{kDLCPU, 0});
+      TVMSynchronize(device_.device_type, device_.device_id, nullptr);
+      for (size_t i = 0; i < batch_seq_ids.size(); ++i) {
+        this->SwitchSequence(batch_seq_ids[i]);
+        total_seq_len_ += 1;
+        auto sample_tstart = std::chrono::high_resolution_clock::now();
+        int32_t next_token = this->SampleTokenFromCPULogitsRow(batch_logits_on_cpu, i);
+        auto sample_tend = std::chrono::high_resolution_clock::now();
+        double sample_time = static_cast<double>((sample_tend - sample_tstart).count()) / 1e9;
+        this->sample_total_time += sample_time;
+        output_sample_time_ += sample_time;
+        this->ProcessNextToken(next_token);
+      }
+
+      auto tend = std::chrono::high_resolution_clock::now();
+      this->decode_total_time += static_cast<double>((tend - tstart).count()) / 1e9;
+      this->decode_total_tokens += batch_seq_ids.size();
+    }
+    this->SwitchSequence(restore_seq_id);
+  }
+
   bool Stopped() { return stop_triggered_; }
 
+  /*!
+   * \brief The usage and timing of the current round of the active sequence.
+   * \return The JSON object with "prompt_tokens", the tokens in the KV cache after the
+   *  prefill, "completion_tokens", the output tokens, "sample_time", the seconds spent on
+   *  sampling the output, and "finish_reason", "length" when the output reaches the length
+   *  limit, or "stop" otherwise.
+   */
+  std::string GetSequenceStatsJSON() {
+    picojson::object stats;
+    stats["prompt_tokens"] = picojson::value(prompt_len_);
+    stats["completion_tokens"] = picojson::value(static_cast<int64_t>(output_ids_.size()));
+    stats["sample_time"] = picojson::value(output_sample_time_);
+    stats["finish_reason"] = picojson::value(stopped_by_length_ ? "length" : "stop");
+    return picojson::value(stats).serialize();
+  }
+
   std::string GetMessage() {
     // remove non-utf8 characters
     size_t effective_end = FindEffectiveUTF8Pos(output_message_);
@@ -797,6 +1926,32 @@ class LLMChat {
     return cropped_message;
   }
 
+  /*!
+   * \brief Get the text appended to the message since the last call.
+   *
+   * The deltas add up to the message returned by GetMessage when the generation stops.
+   * Text that may still be cropped is held back until it is settled: trailing newlines,
+   * and a trailing partial match of the stop string.
+   */
+  std::string GetMessageDelta() {
+    size_t end = output_message_.size();
+    if (!stop_triggered_) {
+      end -= this->StopStrPartialMatchLength();
+    }
+    while (end > delta_message_pos_ && output_message_[end - 1] == '\n') {
+      --end;
+    }
+    if (delta_message_pos_ == 0) {
+      while (delta_message_pos_ < end && output_message_[delta_message_pos_] == ' ') {
+        ++delta_message_pos_;
+      }
+    }
+    if (end <= delta_message_pos_) return "";
+    std::string delta = output_message_.substr(delta_message_pos_, end - delta_message_pos_);
+    delta_message_pos_ = end;
+    return delta;
+  }
+
   // do some quick evaluation of the pipeline
   void Evaluate(int64_t token_len, int64_t generate_len) {
     this->ResetKVCache();
@@ -874,14 +2029,80 @@ class LLMChat {
   }
 
  private:
+  /*!
+   * \brief The state of a sequence that is swapped in and out of the chat
+   *  when multiple sequences share the same model.
+   */
+  struct SequenceState {
+    Conversation conversation;
+    ObjectRef kv_cache{nullptr};
+    int64_t kv_slot{-1};
+    std::vector<int32_t> kv_token_ids;
+    std::vector<int32_t> pending_prefill_tokens;
+    std::vector<int32_t> prefill_prompt_tokens;
+    bool prefill_from_start{false};
+    NDArray pipelined_logits{nullptr};
+    ObjectRef draft_kv_cache{nullptr};
+    int64_t draft_kv_len{0};
+    int64_t total_seq_len{0};
+    std::vector<int32_t> output_ids;
+    std::unordered_set<int32_t> appeared_token_ids;
+    double output_logprob{0};
+    int64_t prompt_len{0};
+    double output_sample_time{0};
+    std::string output_message;
+    std::vector<size_t> output_token_text_end;
+    size_t detok_prefix_offset{0};
+    size_t detok_read_offset{0};
+    size_t delta_message_pos{0};
+    bool stop_triggered{false};
+    bool stopped_by_length{false};
+  };
+
+  /*! \brief Exchange the active sequence state with the given one. */
+  void SwapSequenceState(SequenceState* state) {
+    std::swap(this->conversation_, state->conversation);
+    std::swap(this->kv_cache_, state->kv_cache);
+    std::swap(this->kv_slot_, state->kv_slot);
+    std::swap(this->kv_token_ids_, state->kv_token_ids);
+    std::swap(this->pending_prefill_tokens_, state->pending_prefill_tokens);
+    std::swap(this->prefill_prompt_tokens_, state->prefill_prompt_tokens);
+    std::swap(this->prefill_from_start_, state->prefill_from_start);
+    std::swap(this->pipelined_logits_, state->pipelined_logits);
+    std::swap(this->draft_kv_cache_, state->draft_kv_cache);
+    std::swap(this->draft_kv_len_, state->draft_kv_len);
+    std::swap(this->total_seq_len_, state->total_seq_len);
+    std::swap(this->output_ids_, state->output_ids);
+    std::swap(this->appeared_token_ids_, state->appeared_token_ids);
+    std::swap(this->output_logprob_, state->output_logprob);
+    std::swap(this->prompt_len_, state->prompt_len);
+    std::swap(this->output_sample_time_, state->output_sample_time);
+    std::swap(this->output_message_, state->output_message);
+    std::swap(this->output_token_text_end_, state->output_token_text_end);
+    std::swap(this->detok_prefix_offset_, state->detok_prefix_offset);
+    std::swap(this->detok_read_offset_, state->detok_read_offset);
+    std::swap(this->delta_message_pos_, state->delta_message_pos);
+    std::swap(this->stop_triggered_, state->stop_triggered);
+    std::swap(this->stopped_by_length_, state->stopped_by_length);
+  }
+
   picojson::value SerializeConfigToJSONValue() const {
     picojson::object config;
     config["temperature"] = picojson::value(this->temperature_);
     config["repetition_penalty"] = picojson::value(this->repetition_penalty_);
     config["top_p"] = picojson::value(this->top_p_);
+    config["top_k"] = picojson::value(this->top_k_);
     config["mean_gen_len"] = picojson::value(this->mean_gen_len_);
     config["max_gen_len"] = picojson::value(this->max_gen_len_);
+    config["max_batch_size"] = picojson::value(this->max_batch_size_);
+    config["kv_cache_capacity"] = picojson::value(this->kv_cache_capacity_);
+    config["prefix_cache_capacity"] = picojson::value(this->prefix_cache_capacity_);
+    config["prompt_lookup_num_tokens"] = picojson::value(this->prompt_lookup_num_tokens_);
+    config["draft_num_tokens"] = picojson::value(this->draft_num_tokens_);
     config["shift_fill_factor"] = picojson::value(this->shift_fill_factor_);
+    config["attention_sink_size"] = picojson::value(this->attention_sink_size_);
+    config["prefill_chunk_size"] = picojson::value(this->prefill_chunk_size_);
+    config["pipeline_decode"] = picojson::value(this->pipeline_decode_);
     config["conv_config"] = this->conversation_.SerializeToJSON();
     return picojson::value(config);
   }
@@ -889,7 +2110,23 @@ class LLMChat {
    * \brief Sample output token from logits on device
    */
   int32_t SampleTokenFromLogits(NDArray logits_on_device, float temperature, float top_p) {
-    if (repetition_penalty_ == 1.0f) {
+    if (ft_.sample_func_ != nullptr) {
+      auto tstart = std::chrono::high_resolution_clock::now();
+      std::vector<std::vector<int32_t>> penalty_token_ids;
+      if (repetition_penalty_ != 1.0f) {
+        penalty_token_ids.emplace_back(appeared_token_ids_.begin(), appeared_token_ids_.end());
+      }
+      std::vector<double> logprobs;
+      int32_t next_token =
+          this->SampleTokensOnDevice(logits_on_device, penalty_token_ids, &logprobs)[0];
+      sampled_logprob_ = logprobs[0];
+      auto tend = std::chrono::high_resolution_clock::now();
+      double sample_time = static_cast<double>((tend - tstart).count()) / 1e9;
+      this->sample_total_time += sample_time;
+      this->output_sample_time_ += sample_time;
+      return next_token;
+    }
+    if (repetition_penalty_ == 1.0f && top_k_ <= 0) {
       if (temperature_ < 1e-6f) {
         this->UpdateLogitsOrProbOnCPUSync(logits_on_device);
       } else {
@@ -897,8 +2134,11 @@ class LLMChat {
       }
     } else {
       this->UpdateLogitsOrProbOnCPUSync(logits_on_device);
-      this->ApplyRepetitionPenaltyOnCPU();
+      if (repetition_penalty_ != 1.0f) {
+        this->ApplyRepetitionPenaltyOnCPU();
+      }
       if (temperature_ >= 1e-6f) {
+        this->ApplyTopKOnCPU();
         this->ApplySoftmaxWithTemperatureOnCPU();
       }
     }
@@ -908,62 +2148,229 @@ class LLMChat {
       next_token = this->SampleFromLogitsOnCPU();
     } else {
       next_token = this->SampleFromProbOnCPU();
+      sampled_logprob_ = this->ProbOnCPULog(next_token);
     }
     auto tend = std::chrono::high_resolution_clock::now();
-    this->sample_total_time += static_cast<double>((tend - tstart).count()) / 1e9;
+    double sample_time = static_cast<double>((tend - tstart).count()) / 1e9;
+    this->sample_total_time += sample_time;
+    this->output_sample_time_ += sample_time;
     return next_token;
   }
 
+  /*!
+   * \brief Decode the output tokens that are not in the message yet.
+   *
+   * Only the pending tokens are decoded, together with the tokens of the previous step
+   * as context, so that the cost of each step does not grow with the output length.
+   * The new text is appended once it ends with a complete UTF-8 character.
+   * \param flush Whether to append the pending text even if it is incomplete.
+   */
+  void DetokenizeIncrementally(bool flush) {
+    if (detok_read_offset_ == output_ids_.size()) return;
+    std::string prefix_text = tokenizer_->Decode(std::vector<int32_t>(
+        output_ids_.begin() + detok_prefix_offset_, output_ids_.begin() + detok_read_offset_));
+    std::string window_text = tokenizer_->Decode(
+        std::vector<int32_t>(output_ids_.begin() + detok_prefix_offset_, output_ids_.end()));
+    if (!flush) {
+      // wait for more tokens when the last character is incomplete, which byte-level
+      // tokenizers decode as the replacement character U+FFFD
+      static const std::string kReplacementChar = "\xEF\xBF\xBD";
+      if (window_text.size() <= prefix_text.size() ||
+          FindEffectiveUTF8Pos(window_text) != window_text.size() ||
+          (window_text.size() >= kReplacementChar.size() &&
+           window_text.compare(window_text.size() - kReplacementChar.size(),
+                               kReplacementChar.size(), kReplacementChar) == 0)) {
+        return;
+      }
+    }
+    if (window_text.size() > prefix_text.size()) {
+      output_message_.append(window_text, prefix_text.size(), std::string::npos);
+    }
+    output_token_text_end_.resize(output_ids_.size(), output_message_.size());
+    detok_prefix_offset_ = detok_read_offset_;
+    detok_read_offset_ = output_ids_.size();
+  }
+
+  /*!
+   * \brief The length of the longest suffix of the message that is a proper prefix of the
+   *  stop string, i.e., the text that may turn out to be part of the stop string.
+   */
+  size_t StopStrPartialMatchLength() const {
+    const std::string& stop_str = conversation_.stop_str;
+    if (stop_str.empty()) return 0;
+    size_t max_len = std::min(output_message_.size(), stop_str.size() - 1);
+    for (size_t len = max_len; len > 0; --len) {
+      if (output_message_.compare(output_message_.size() - len, len, stop_str, 0, len) == 0) {
+        return len;
+      }
+    }
+    return 0;
+  }
+
   /*!
    * \brief Add a generated token and check for stop condition.
    * \param next_token The next token.
    */
   void ProcessNextToken(int32_t next_token) {
+    this->PopKVCache(this->AppendNextToken(next_token));
+  }
+
+  /*! \brief Whether the token is one of the stop tokens of the conversation. */
+  bool IsStopToken(int32_t token) const {
+    return std::any_of(this->conversation_.stop_tokens.begin(),
+                       this->conversation_.stop_tokens.end(),
+                       [token](int32_t stop_token) { return stop_token == token; });
+  }
+
+  /*!
+   * \brief Add a generated token and check for stop condition, without changing the KV cache.
+   * \param next_token The next token.
+   * \return The number of tokens to remove from the end of the KV cache, which are the output
+   *  tokens after the stop string. The caller pops them, e.g. after the forward run ahead of
+   *  the token by pipelined decoding.
+   */
+  int64_t AppendNextToken(int32_t next_token) {
     ICHECK(!stop_triggered_) << "Cannot call process when it is stopped";
 
-    stop_triggered_ =
-        std::any_of(this->conversation_.stop_tokens.begin(), this->conversation_.stop_tokens.end(),
-                    [next_token](int32_t token) { return token == next_token; });
+    stop_triggered_ = this->IsStopToken(next_token);
+    int64_t backoff = 0;
 
+    // the output tokens before the next token have all been fed into the KV cache
+    size_t num_output_in_kv = output_ids_.size();
     if (!stop_triggered_) {
       output_ids_.push_back(next_token);
       appeared_token_ids_.insert(next_token);
+      output_logprob_ += sampled_logprob_;
     }
-
-    output_message_ = tokenizer_->Decode(output_ids_);
-
-    if (!conversation_.stop_str.empty()) {
-      size_t stop_pos = output_message_.rfind(conversation_.stop_str);
+    sampled_logprob_ = 0;
+
+    // with attention sinks, the window shifts in the next decode step instead
+    bool reach_limit = static_cast<int64_t>(output_ids_.size()) >= max_gen_len_ ||
+                       (total_seq_len_ >= max_window_size_ && !this->UseAttentionSink());
+    size_t prev_message_size = output_message_.size();
+    this->DetokenizeIncrementally(/*flush=*/stop_triggered_ || reach_limit);
+
+    if (!conversation_.stop_str.empty() && output_message_.size() > prev_message_size) {
+      // earlier text has been checked in previous steps, only look at the new text
+      // and the part of the stop string that can overlap with it
+      size_t search_begin = prev_message_size - std::min(prev_message_size,
+                                                         conversation_.stop_str.size() - 1);
+      size_t stop_pos = output_message_.find(conversation_.stop_str, search_begin);
       if (stop_pos != std::string::npos) {
         stop_triggered_ = true;
         if (ft_.support_backtracking_kv_) {
-          // back tracking, find the first set of token that is smaller
-          // than the length
-          size_t backoff = 0;
-          for (; backoff < output_ids_.size(); ++backoff) {
-            output_ids_.pop_back();
-            output_message_ = tokenizer_->Decode(output_ids_);
-            if (output_message_.length() <= stop_pos) break;
-          }
-          // resize kv to remove the context
-          ft_.fkvcache_array_popn_(kv_cache_, backoff);
-          total_seq_len_ -= backoff;
+          // back tracking, keep the longest run of tokens whose text ends before the stop str
+          size_t num_kept = std::upper_bound(output_token_text_end_.begin(),
+                                             output_token_text_end_.end(), stop_pos) -
+                            output_token_text_end_.begin();
+          backoff = num_output_in_kv - std::min(num_kept, num_output_in_kv);
+          output_ids_.resize(num_kept);
+          output_token_text_end_.resize(num_kept);
+          output_message_.resize(num_kept == 0 ? 0 : output_token_text_end_.back());
+          detok_prefix_offset_ = detok_read_offset_ = num_kept;
+          delta_message_pos_ = std::min(delta_message_pos_, output_message_.size());
         }
       }
     }
 
-    if (static_cast<int64_t>(output_ids_.size()) >= max_gen_len_) {
-      stop_triggered_ = true;
-    } else if (total_seq_len_ >= max_window_size_) {
+    if (reach_limit) {
+      stopped_by_length_ = !stop_triggered_;
       stop_triggered_ = true;
     }
     if (stop_triggered_) {
       conversation_.FinishReply(output_message_);
     }
+    return backoff;
+  }
+
+  /*!
+   * \brief Whether the window of the active sequence shifts by evicting the KV entries after
+   *  the attention sinks, which requires a model built with attention sinks and the KV cache
+   *  of a single sequence.
+   */
+  bool UseAttentionSink() const {
+    return attention_sink_size_ > 0 && ft_.support_attention_sink_ && kv_slot_ < 0 &&
+           !draft_kv_cache_.defined();
+  }
+
+  /*!
+   * \brief Evict the KV entries between the attention sinks and the most recent tokens of the
+   *  active sequence. The keys are kept before the rotary embedding, which the model applies by
+   *  the index in the KV cache, so the positions of the kept tokens are re-based.
+   * \param num_keep The number of tokens kept, the attention sinks included.
+   */
+  void EvictKVCache(int64_t num_keep) {
+    ICHECK_GE(num_keep, attention_sink_size_);
+    int64_t num_evict = total_seq_len_ - num_keep;
+    if (num_evict <= 0) return;
+    int64_t num_recent = num_keep - attention_sink_size_;
+    std::vector<int64_t> view_shape = {total_seq_len_};
+    std::vector<int64_t> recent_shape = {num_recent};
+    view_shape.insert(view_shape.end(), ft_.attention_sink_kv_shape_.begin(),
+                      ft_.attention_sink_kv_shape_.end());
+    recent_shape.insert(recent_shape.end(), ft_.attention_sink_kv_shape_.begin(),
+                        ft_.attention_sink_kv_shape_.end());
+    int64_t entry_size = 1;
+    for (int64_t dim : ft_.attention_sink_kv_shape_) {
+      entry_size *= dim;
+    }
+    // copy out the recent entries of every cache, pop all but the sinks, and append them back
+    Array<ObjectRef> caches = Downcast<Array<ObjectRef>>(kv_cache_);
+    std::vector<NDArray> recents;
+    recents.reserve(caches.size());
+    for (const ObjectRef& cache : caches) {
+      NDArray view = ft_.fkvcache_view_(cache, ShapeTuple(view_shape));
+      NDArray recent = NDArray::Empty(ShapeTuple(recent_shape), view->dtype, device_);
+      if (num_recent > 0) {
+        int64_t entry_bytes = entry_size * ((view->dtype.bits * view->dtype.lanes + 7) / 8);
+        DLTensor src = *view.operator->();
+        src.shape = const_cast<int64_t*>(recent->shape);
+        src.byte_offset += (total_seq_len_ - num_recent) * entry_bytes;
+        recent.CopyFrom(&src);
+      }
+      recents.push_back(recent);
+    }
+    ft_.fkvcache_array_popn_(kv_cache_, total_seq_len_ - attention_sink_size_);
+    Array<ObjectRef> new_caches;
+    for (size_t i = 0; i < caches.size(); ++i) {
+      new_caches.push_back(ft_.fkvcache_append_(caches[i], recents[i]));
+    }
+    kv_cache_ = new_caches;
+    if (static_cast<int64_t>(kv_token_ids_.size()) == total_seq_len_) {
+      kv_token_ids_.erase(kv_token_ids_.begin() + attention_sink_size_,
+                          kv_token_ids_.begin() + attention_sink_size_ + num_evict);
+    } else {
+      kv_token_ids_.clear();
+    }
+    total_seq_len_ = num_keep;
+  }
+
+  /*!
+   * \brief Remove the last n tokens from the KV cache of the active sequence.
+   * \param n The number of tokens to remove.
+   */
+  void PopKVCache(int64_t n) {
+    if (n == 0) return;
+    if (kv_slot_ >= 0) {
+      ft_.fpaged_kv_cache_popn_(paged_kv_cache_, kv_slot_, n);
+    } else {
+      ft_.fkvcache_array_popn_(kv_cache_, n);
+    }
+    total_seq_len_ -= n;
+    kv_token_ids_.resize(kv_token_ids_.size() - std::min<size_t>(n, kv_token_ids_.size()));
+    // the draft KV cache holds a prefix of the tokens in the KV cache
+    if (draft_kv_cache_.defined() && draft_kv_len_ > static_cast<int64_t>(kv_token_ids_.size())) {
+      draft_ft_.fkvcache_array_popn_(draft_kv_cache_, draft_kv_len_ - kv_token_ids_.size());
+      draft_kv_len_ = kv_token_ids_.size();
+    }
   }
 
   // run forward compute
   NDArray ForwardTokens(std::vector<int32_t> input_tokens, int64_t cur_pos) {
+    if (kv_slot_ >= 0) {
+      return this->BatchForwardTokens({kv_slot_}, {input_tokens});
+    }
+    kv_token_ids_.insert(kv_token_ids_.end(), input_tokens.begin(), input_tokens.end());
     ObjectRef ret{nullptr};
     if (input_tokens.size() > 1 && ft_.prefill_func_.defined()) {
       ObjectRef input_data = ft_.CopyToWorker0(this->GetInputTokenNDArray(input_tokens));
@@ -986,6 +2393,84 @@ class LLMChat {
     }
   }
 
+  /*!
+   * \brief Run forward compute of a batch of sequences in the paged KV cache.
+   * \param kv_slots The KV cache slot of each sequence.
+   * \param input_tokens The input tokens of each sequence.
+   * \return The logits of the last input token of each sequence, in shape (batch_size, 1, vocab).
+   */
+  NDArray BatchForwardTokens(const std::vector<int64_t>& kv_slots,
+                             const std::vector<std::vector<int32_t>>& input_tokens) {
+    int64_t batch_size = kv_slots.size();
+    std::vector<int64_t> input_lens;
+    int64_t max_input_len = 0;
+    for (const std::vector<int32_t>& tokens : input_tokens) {
+      input_lens.push_back(tokens.size());
+      max_input_len = std::max(max_input_len, static_cast<int64_t>(tokens.size()));
+    }
+    if (prefix_cache_capacity_ != 0) {
+      // the blocks only held by the prefix cache are given back to the running sequences,
+      // with one more block per sequence in case its last block is copied on write
+      int64_t block_size = ft_.fpaged_kv_cache_block_size_(paged_kv_cache_);
+      int64_t num_blocks_needed = 0;
+      for (int64_t len : input_lens) {
+        num_blocks_needed += (len + block_size - 1) / block_size + 1;
+      }
+      while (true) {
+        int64_t num_free_blocks = ft_.fpaged_kv_cache_num_free_blocks_(paged_kv_cache_);
+        if (num_free_blocks >= num_blocks_needed || !this->EvictPrefixCache()) break;
+      }
+    }
+    ShapeTuple past_lens = ft_.fpaged_kv_cache_begin_forward_(
+        paged_kv_cache_, ShapeTuple(kv_slots), ShapeTuple(input_lens));
+    int64_t max_total_len = 0;
+    for (int64_t i = 0; i < batch_size; ++i) {
+      max_total_len = std::max(max_total_len, past_lens[i] + input_lens[i]);
+    }
+    // right-pad the inputs to the longest one
+    std::vector<int32_t> padded_tokens(batch_size * max_input_len, 0);
+    for (int64_t i = 0; i < batch_size; ++i) {
+      std::copy(input_tokens[i].begin(), input_tokens[i].end(),
+                padded_tokens.begin() + i * max_input_len);
+    }
+    NDArray input_data = this->CopyToDeviceBuffer(
+        padded_tokens, ShapeTuple({batch_size, max_input_len}), &batch_input_token_ids_);
+    NDArray past_lens_data = this->CopyToDeviceBuffer(
+        std::vector<int32_t>(past_lens.begin(), past_lens.end()), ShapeTuple({batch_size}),
+        &batch_past_lens_);
+
+    Array<ObjectRef> ret;
+    if (max_input_len == 1) {
+      ret = ft_.batch_decode_func_(input_data, past_lens_data, ShapeTuple({max_total_len}),
+                                   paged_kv_cache_, params_);
+    } else {
+      NDArray input_lens_data = this->CopyToDeviceBuffer(
+          std::vector<int32_t>(input_lens.begin(), input_lens.end()), ShapeTuple({batch_size}),
+          &batch_input_lens_);
+      ret = ft_.batch_prefill_func_(input_data, past_lens_data, input_lens_data,
+                                    ShapeTuple({max_total_len}), paged_kv_cache_, params_);
+    }
+    return Downcast<NDArray>(ret[0]);
+  }
+
+  // copy int32 data to a statically allocated device buffer, return a view with the given shape
+  NDArray CopyToDeviceBuffer(const std::vector<int32_t>& data, ShapeTuple shape,
+                             NDArray* buffer) {
+    int64_t size = static_cast<int64_t>(data.size());
+    if (!buffer->defined() || (*buffer)->shape[0] < size) {
+      int64_t init_size = 64;
+      while (init_size < size) {
+        init_size *= 2;
+      }
+      *buffer = NDArray::Empty({init_size}, DataType::Int(32), device_);
+    }
+    NDArray view = buffer->CreateView(shape, DataType::Int(32));
+    if (size > 0) {
+      view.CopyFromBytes(data.data(), size * sizeof(int32_t));
+    }
+    return view;
+  }
+
   // run forward compute with embeddings
   NDArray ForwardEmbeddings(NDArray embeddings, int64_t cur_pos) {
     if (ft_.use_disco) {
@@ -1006,16 +2491,43 @@ class LLMChat {
     return ret;
   }
 
-  void ApplyRepetitionPenaltyOnCPU() {
+  /*!
+   * \brief Penalize the logits of the tokens that appeared in the output.
+   * \param drafted_tokens The drafted tokens not in the output yet, penalized as well.
+   */
+  void ApplyRepetitionPenaltyOnCPU(const std::vector<int32_t>& drafted_tokens = {}) {
     CHECK(logits_on_cpu_.defined()) << "Logits on CPU not defined!";
     CHECK(logits_on_cpu_.DataType() == DataType::Float(32)) << "Logits data type is not float32!";
     float* logits_raw_data = static_cast<float*>(logits_on_cpu_->data);
-    for (const int32_t& token_id : this->appeared_token_ids_) {
+    auto penalize = [this, logits_raw_data](int32_t token_id) {
       if (logits_raw_data[token_id] <= 0) {
         logits_raw_data[token_id] *= this->repetition_penalty_;
       } else {  // logits > 0
         logits_raw_data[token_id] /= this->repetition_penalty_;
       }
+    };
+    for (const int32_t& token_id : this->appeared_token_ids_) {
+      penalize(token_id);
+    }
+    std::unordered_set<int32_t> drafted(drafted_tokens.begin(), drafted_tokens.end());
+    for (int32_t token_id : drafted) {
+      if (!this->appeared_token_ids_.count(token_id)) penalize(token_id);
+    }
+  }
+
+  void ApplyTopKOnCPU() {
+    CHECK(logits_on_cpu_.defined()) << "Logits on CPU not defined!";
+    int64_t vocab_size = logits_on_cpu_->shape[logits_on_cpu_->ndim - 1];
+    if (top_k_ <= 0 || top_k_ >= vocab_size) return;
+    float* logits_raw_data = static_cast<float*>(logits_on_cpu_->data);
+    std::vector<float> values(logits_raw_data, logits_raw_data + vocab_size);
+    std::nth_element(values.begin(), values.begin() + top_k_ - 1, values.end(),
+                     std::greater<float>());
+    float threshold = values[top_k_ - 1];
+    for (int64_t i = 0; i < vocab_size; ++i) {
+      if (logits_raw_data[i] < threshold) {
+        logits_raw_data[i] = -std::numeric_limits<float>::infinity();
+      }
     }
   }
 
@@ -1050,8 +2562,88 @@ class LLMChat {
     TVMSynchronize(device_.device_type, device_.device_id, nullptr);
   }
 
+  /*!
+   * \brief Sample the next token of each row of the logits with the compiled sampling
+   *  function, so that only the token ids are copied back to CPU.
+   * \param logits_on_device The logits of shape (batch_size, 1, vocab_size).
+   * \param penalty_token_ids The appeared token ids of each row, which are penalized by
+   *  the repetition penalty. It can be empty when there is no repetition penalty.
+   * \param logprobs If given, it is set to the log-probability of every sampled token, which
+   *  is NaN when sampled by a model library not returning it, unless decoding greedily.
+   * \return The sampled token ids.
+   */
+  std::vector<int32_t> SampleTokensOnDevice(
+      NDArray logits_on_device, const std::vector<std::vector<int32_t>>& penalty_token_ids,
+      std::vector<double>* logprobs = nullptr) {
+    int64_t batch_size = logits_on_device->shape[0];
+    int64_t num_penalty_tokens = 0;
+    for (const std::vector<int32_t>& token_ids : penalty_token_ids) {
+      num_penalty_tokens = std::max(num_penalty_tokens, static_cast<int64_t>(token_ids.size()));
+    }
+    // pad with -1, which is skipped by the repetition penalty
+    std::vector<int32_t> padded_token_ids(batch_size * num_penalty_tokens, -1);
+    for (size_t i = 0; i < penalty_token_ids.size(); ++i) {
+      std::copy(penalty_token_ids[i].begin(), penalty_token_ids[i].end(),
+                padded_token_ids.begin() + i * num_penalty_tokens);
+    }
+    NDArray penalty_data =
+        this->CopyToDeviceBuffer(padded_token_ids, ShapeTuple({batch_size, num_penalty_tokens}),
+                                 &penalty_token_ids_buffer_);
+    if (!sampling_params_.defined()) {
+      sampling_params_ = NDArray::Empty({4}, DataType::Float(32), device_);
+    }
+    float params[4] = {static_cast<float>(temperature_), static_cast<float>(top_p_),
+                       static_cast<float>(repetition_penalty_), static_cast<float>(top_k_)};
+    sampling_params_.CopyFromBytes(params, sizeof(params));
+    int64_t seed = static_cast<int64_t>(GetRandomNumber() * std::numeric_limits<int32_t>::max());
+
+    ObjectRef ret = ft_.sample_func_(logits_on_device, penalty_data, sampling_params_,
+                                     ShapeTuple({seed}));
+    NDArray token_ids;
+    NDArray token_logprobs;
+    if (ret->IsInstance<ArrayNode>()) {
+      Array<ObjectRef> ret_array = Downcast<Array<ObjectRef>>(ret);
+      token_ids = Downcast<NDArray>(ret_array[0]);
+      token_logprobs = Downcast<NDArray>(ret_array[1]);
+    } else {
+      // model libraries built before the sampler returned the log-probabilities
+      token_ids = Downcast<NDArray>(ret);
+    }
+    NDArray token_ids_on_cpu = token_ids.CopyTo(DLDevice{kDLCPU, 0});
+    NDArray token_logprobs_on_cpu;
+    if (logprobs != nullptr && token_logprobs.defined()) {
+      token_logprobs_on_cpu = token_logprobs.CopyTo(DLDevice{kDLCPU, 0});
+    }
+    TVMSynchronize(device_.device_type, device_.device_id, nullptr);
+    if (logprobs != nullptr) {
+      if (token_logprobs_on_cpu.defined()) {
+        const float* logprob_data = static_cast<const float*>(token_logprobs_on_cpu->data);
+        logprobs->assign(logprob_data, logprob_data + batch_size);
+      } else {
+        // greedy decoding is deterministic, as with sampling on CPU its log-probability is 0
+        logprobs->assign(batch_size, temperature_ < 1e-6f
+                                         ? 0.0
+                                         : std::numeric_limits<double>::quiet_NaN());
+      }
+    }
+    const int32_t* data = static_cast<const int32_t*>(token_ids_on_cpu->data);
+    return std::vector<int32_t>(data, data + batch_size);
+  }
+
   // Clear kv cache
-  void ResetKVCache() { ft_.reset_kv_cache_func_(kv_cache_); }
+  void ResetKVCache() {
+    kv_token_ids_.clear();
+    pipelined_logits_ = NDArray();
+    if (draft_kv_cache_.defined()) {
+      draft_ft_.reset_kv_cache_func_(draft_kv_cache_);
+      draft_kv_len_ = 0;
+    }
+    if (kv_slot_ >= 0) {
+      ft_.fpaged_kv_cache_reset_sequence_(paged_kv_cache_, kv_slot_);
+    } else {
+      ft_.reset_kv_cache_func_(kv_cache_);
+    }
+  }
 
   void ProcessSystemPrompts() {
     this->PrefillStep(/*inp=*/"", /*append_conversation=*/false, /*decode_next_token=*/false);
@@ -1078,6 +2670,12 @@ class LLMChat {
     return fsample_topp_from_prob_(logits_on_cpu_, top_p_, GetRandomNumber());
   }
 
+  /*! \brief The log of the probability of a token in logits_on_cpu_ after softmax. */
+  double ProbOnCPULog(int32_t token) const {
+    float prob = static_cast<const float*>(logits_on_cpu_->data)[token];
+    return std::log(std::max(prob, std::numeric_limits<float>::min()));
+  }
+
   //----------------------------
   // Statistics
   //----------------------------
@@ -1099,26 +2697,81 @@ class LLMChat {
   int64_t total_seq_len_{0};
   // max window size, mean generation length
   int64_t max_window_size_{768}, mean_gen_len_{128}, max_gen_len_{512};
+  // max number of sequences in the paged KV cache
+  int64_t max_batch_size_{4};
+  // number of tokens the paged KV cache holds, 0 for max_batch_size * max_window_size
+  int64_t kv_cache_capacity_{0};
+  // number of prompt tokens kept in the prefix cache, negative for max_window_size, 0 disables it
+  int64_t prefix_cache_capacity_{-1};
   // size of the vocab table
   int64_t vocab_size_;
   // number of shards in distributed inference
   int64_t num_shards_;
   // shift window fill factor
   double shift_fill_factor_{0.3};
+  // number of initial tokens kept as attention sinks when the window shifts, 0 disables it
+  int64_t attention_sink_size_{0};
+  // maximum number of prompt tokens prefilled in one forward, non-positive for the whole prompt
+  int64_t prefill_chunk_size_{0};
+  // whether to enqueue the forward of an output token before the token is processed on the host
+  bool pipeline_decode_{false};
   // temperature
   double temperature_{0.8};
   // repetition penalty
   double repetition_penalty_{1.0};
   // top_p
   double top_p_{0.95};
+  // top_k, non-positive values keep the whole vocabulary
+  int64_t top_k_{0};
+  // maximum number of tokens drafted by prompt lookup per decode step, 0 disables it
+  int64_t prompt_lookup_num_tokens_{0};
+  // number of tokens proposed by the draft model per decode step
+  int64_t draft_num_tokens_{4};
+  // longest n-gram matched by prompt lookup
+  static constexpr int64_t kMaxPromptLookupNgramSize = 3;
   // output ids till now (refresh after encoding step)
   std::vector<int32_t> output_ids_;
   // appeared token ids till now (refresh after encoding step)
   std::unordered_set<int32_t> appeared_token_ids_;
+  // sum of the log-probabilities of output_ids_, NaN when a token is sampled on device by a
+  // model library not returning the log-probabilities
+  double output_logprob_{0};
+  // number of tokens in the KV cache after the last prefill, the history included
+  int64_t prompt_len_{0};
+  // seconds spent on sampling output_ids_
+  double output_sample_time_{0};
+  // log-probability of the token sampled last, consumed by ProcessNextToken
+  double sampled_logprob_{0};
   // output message till now (refresh after encoding step)
   std::string output_message_;
+  // token ids in the KV cache, the prompt lookup source
+  std::vector<int32_t> kv_token_ids_;
+  // prompt tokens of the active sequence not prefilled yet, and the whole prompt
+  std::vector<int32_t> pending_prefill_tokens_;
+  std::vector<int32_t> prefill_prompt_tokens_;
+  // whether the prompt being prefilled starts from an empty KV cache
+  bool prefill_from_start_{false};
+  // logits of the forward of the last output token, run ahead by pipelined decoding
+  NDArray pipelined_logits_{nullptr};
+  // KV cache of the draft model, holding the first draft_kv_len_ tokens of kv_token_ids_
+  ObjectRef draft_kv_cache_{nullptr};
+  int64_t draft_kv_len_{0};
+  // the length of output_message_ after the text of each decoded output token
+  std::vector<size_t> output_token_text_end_;
+  // start of the output tokens decoded as context of the pending tokens
+  size_t detok_prefix_offset_{0};
+  // number of output tokens whose text is in output_message_
+  size_t detok_read_offset_{0};
+  // position in output_message_ up to which the text is returned by GetMessageDelta
+  size_t delta_message_pos_{0};
   // Whether encounter stop str
   bool stop_triggered_{false};
+  // Whether the generation stops at the length limit rather than a stop token or string
+  bool stopped_by_length_{false};
+  // id of the active sequence
+  int64_t current_seq_id_{0};
+  // inactive sequences that are multiplexed over the model
+  std::unordered_map<int64_t, SequenceState> sequences_;
   //----------------------------
   // Tokenizer
   //----------------------------
@@ -1143,8 +2796,29 @@ class LLMChat {
   NDArray input_token_ids_{nullptr};
   // local params
   ObjectRef params_;
+  // functions and params of the draft model for speculative decoding, if loaded
+  FunctionTable draft_ft_;
+  ObjectRef draft_params_{nullptr};
   // KV cache
   ObjectRef kv_cache_;
+  // the slot of the active sequence in the paged KV cache, -1 if it uses kv_cache_
+  int64_t kv_slot_{-1};
+  // paged KV cache shared by the batched sequences, created by the first batched sequence
+  ObjectRef paged_kv_cache_{nullptr};
+  // cached prompts, each mapped to the blocks of the paged KV cache holding it
+  PrefixCache prefix_cache_;
+  // statically allocated inputs of the batched embedding functions
+  NDArray embed_batch_input_ids_{nullptr};
+  NDArray embed_batch_input_lens_{nullptr};
+  NDArray embed_pooling_params_{nullptr};
+  // statically allocated inputs of the batched functions
+  NDArray batch_input_token_ids_{nullptr};
+  NDArray batch_past_lens_{nullptr};
+  NDArray batch_input_lens_{nullptr};
+  // the padded token ids penalized by the compiled sampling function
+  NDArray penalty_token_ids_buffer_{nullptr};
+  // (temperature, top_p, repetition_penalty, top_k) of the compiled sampling function
+  NDArray sampling_params_{nullptr};
   // Temp logits on cpu
   NDArray logits_on_cpu_{nullptr};
 };
@@ -1183,6 +2857,12 @@ class LLMChatModule : public ModuleNode {
           chat_->Reload(args[0], args[1], args[2]);
         }
       });
+    } else if (name == "load_draft_model") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        ICHECK_EQ(args.size(), 2);
+        // args: lib_path, model_path
+        GetChat()->LoadDraftModel(args[0], args[1]);
+      });
     } else if (name == "unload") {
       return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
         chat_ = nullptr;
@@ -1214,6 +2894,32 @@ class LLMChatModule : public ModuleNode {
           GetChat()->PrefillStep(args[0], true, args[1], place_in_prompt);
         }
       });
+    } else if (name == "prefill_fork") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        // args: inp, fork_seq_id_0, fork_seq_id_1, ...
+        ICHECK_GE(args.size(), 1);
+        std::vector<int64_t> fork_seq_ids;
+        for (int i = 1; i < args.size(); ++i) {
+          fork_seq_ids.push_back(args[i]);
+        }
+        GetChat()->PrefillStep(args[0], true, true, PlaceInPrompt::kAll, fork_seq_ids);
+      });
+    } else if (name == "begin_prefill") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        // args: inp
+        ICHECK_EQ(args.size(), 1);
+        *rv = GetChat()->BeginPrefill(args[0]);
+      });
+    } else if (name == "prefill_chunk") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        // args: max_tokens, fork_seq_id_0, fork_seq_id_1, ...
+        ICHECK_GE(args.size(), 1);
+        std::vector<int64_t> fork_seq_ids;
+        for (int i = 1; i < args.size(); ++i) {
+          fork_seq_ids.push_back(args[i]);
+        }
+        *rv = GetChat()->ContinuePrefill(args[0], true, fork_seq_ids);
+      });
     } else if (name == "embed") {
       return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
         ICHECK(1 <= args.size() && args.size() <= 2);
@@ -1226,6 +2932,27 @@ class LLMChatModule : public ModuleNode {
           *rv = GetChat()->EmbedStep(args[0], true, place_in_prompt);
         }
       });
+    } else if (name == "embed_batch") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        // args: inp_0, inp_1, ...
+        *rv = GetChat()->EmbedBatch(GetEmbeddingInputs(args, 0));
+      });
+    } else if (name == "embed_pooled") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        // args: last_token, normalize, inp_0, inp_1, ...
+        ICHECK_GE(args.size(), 2);
+        Optional<NDArray> pooled =
+            GetChat()->EmbedPooled(GetEmbeddingInputs(args, 2), args[0], args[1]);
+        if (pooled.defined()) {
+          *rv = pooled.value();
+        }
+      });
+    } else if (name == "tokenize") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        ICHECK_EQ(args.size(), 1);
+        std::vector<int32_t> token_ids = GetChat()->Tokenize(args[0]);
+        *rv = ShapeTuple(token_ids.begin(), token_ids.end());
+      });
     } else if (name == "prefill_with_embed") {
       return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
         ICHECK(1 <= args.size() && args.size() <= 2);
@@ -1266,6 +2993,18 @@ class LLMChatModule : public ModuleNode {
     } else if (name == "get_message") {
       return PackedFunc(
           [this, sptr_to_self](TVMArgs args, TVMRetValue* rv) { *rv = GetChat()->GetMessage(); });
+    } else if (name == "get_sequence_stats_json") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        *rv = GetChat()->GetSequenceStatsJSON();
+      });
+    } else if (name == "get_output_logprob") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        *rv = GetChat()->output_logprob_;
+      });
+    } else if (name == "get_message_delta") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        *rv = GetChat()->GetMessageDelta();
+      });
     } else if (name == "runtime_stats_text") {
       return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
         *rv = GetChat()->RuntimeStatsText();
@@ -1281,6 +3020,35 @@ class LLMChatModule : public ModuleNode {
       return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
         GetChat()->ProcessSystemPrompts();
       });
+    } else if (name == "add_sequence") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        ICHECK_EQ(args.size(), 1);
+        GetChat()->AddSequence(args[0]);
+      });
+    } else if (name == "switch_sequence") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        ICHECK_EQ(args.size(), 1);
+        GetChat()->SwitchSequence(args[0]);
+      });
+    } else if (name == "load_conversation_history") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        ICHECK_EQ(args.size(), 1);
+        GetChat()->LoadConversationHistory(args[0]);
+      });
+    } else if (name == "remove_sequence") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        ICHECK_EQ(args.size(), 1);
+        GetChat()->RemoveSequence(args[0]);
+      });
+    } else if (name == "batch_decode") {
+      return PackedFunc([this, sptr_to_self](TVMArgs args, TVMRetValue* rv) {
+        // args: seq_id_0, seq_id_1, ...
+        std::vector<int64_t> seq_ids;
+        for (int i = 0; i < args.size(); ++i) {
+          seq_ids.push_back(args[i]);
+        }
+        GetChat()->BatchDecodeStep(seq_ids);
+      });
     } else {
       return PackedFunc(nullptr);
     }
@@ -1293,6 +3061,20 @@ class LLMChatModule : public ModuleNode {
     return chat_.get();
   }
 
+  // the inputs of the embedding functions, each is a text or its token ids in a ShapeTuple
+  std::vector<std::vector<int32_t>> GetEmbeddingInputs(const TVMArgs& args, int begin) {
+    std::vector<std::vector<int32_t>> inputs;
+    for (int i = begin; i < args.size(); ++i) {
+      if (args[i].type_code() == kTVMStr) {
+        inputs.push_back(GetChat()->Tokenize(args[i]));
+      } else {
+        ShapeTuple token_ids = args[i];
+        inputs.emplace_back(token_ids.begin(), token_ids.end());
+      }
+    }
+    return inputs;
+  }
+
   const char* type_key() const final { return "mlc.llm_chat"; }
 
  private:
@@ -0,0 +1,377 @@
+/*!
+ *  Copyright (c) 2023 by Contributors
+ * \file paged_kv_cache.cc
+ * \brief The paged KV cache shared by the sequences of "batch_prefill" and "batch_decode".
+ */
+#include <tvm/runtime/container/array.h>
+#include <tvm/runtime/container/shape_tuple.h>
+#include <tvm/runtime/ndarray.h>
+#include <tvm/runtime/object.h>
+#include <tvm/runtime/packed_func.h>
+#include <tvm/runtime/registry.h>
+
+#include <algorithm>
+#include <vector>
+
+namespace mlc {
+namespace llm {
+
+using namespace tvm::runtime;
+
+/*!
+ * \brief The paged KV cache of a batch of sequences.
+ *
+ * The keys/values of each layer live in a pool of fixed-size blocks, whose shape is
+ * (num_blocks, block_size, num_heads, head_dim). Blocks are taken from the shared pool
+ * as a sequence grows and returned when it shrinks or is removed, so every sequence
+ * only takes memory proportional to its length. The blocks of each sequence are listed
+ * in its block table.
+ *
+ * Before calling a model function, "mlc.paged_kv_cache.begin_forward" sets the sequences
+ * taking part in the forward pass and the number of tokens appended to each of them, and
+ * uploads their block tables and the position map, i.e., the row in the pools of every
+ * new token. The model functions then append the new keys/values of each layer through
+ * "mlc.paged_kv_cache.append", which scatters them into their blocks with the compiled
+ * kernel given at creation, and read the cached keys/values from the pools returned by
+ * "mlc.paged_kv_cache.get_pool" through the table returned by
+ * "mlc.paged_kv_cache.get_block_table".
+ *
+ * Blocks are reference counted, so that full blocks can be shared by sequences with a
+ * common prefix, and by the prefix cache through "mlc.paged_kv_cache.retain_blocks".
+ * "mlc.paged_kv_cache.fork_sequence" shares all the blocks of a sequence with a new one.
+ * A shared block is copied before a sequence writes into it.
+ */
+class PagedKVCacheObj : public Object {
+ public:
+  /*! \brief The sequence state. */
+  struct Sequence {
+    /*! \brief Whether the sequence slot is in use. */
+    bool in_use{false};
+    /*! \brief The number of tokens in the cache. */
+    int64_t length{0};
+    /*! \brief The block table of the sequence. */
+    std::vector<int32_t> blocks;
+  };
+
+  /*! \brief The key and value pools of all layers, in the order of (k0, v0, k1, v1, ...). */
+  Array<NDArray> pools;
+  /*!
+   * \brief The kernel writing the new keys/values of a layer into their rows, called with
+   * (k_pool, v_pool, k_data, v_data, position_map).
+   */
+  PackedFunc f_append;
+  /*! \brief The ids of the free blocks. */
+  std::vector<int32_t> free_blocks;
+  /*! \brief The number of references to each block. */
+  std::vector<int32_t> block_ref_counts;
+  /*! \brief The sequences, indexed by their slots. */
+  std::vector<Sequence> sequences;
+  /*! \brief The slots of the sequences in the current forward pass. */
+  std::vector<int64_t> cur_slots;
+  /*! \brief The length of each sequence before the current forward pass. */
+  std::vector<int64_t> cur_past_lens;
+  /*! \brief The number of tokens appended to each sequence in the current forward pass. */
+  std::vector<int64_t> cur_append_lens;
+  /*! \brief The block tables of the current forward pass on device. */
+  NDArray block_table_buffer{nullptr};
+  /*! \brief The view of block_table_buffer for the current forward pass. */
+  NDArray cur_block_table{nullptr};
+  /*! \brief The position maps of the current forward pass on device. */
+  NDArray position_map_buffer{nullptr};
+  /*!
+   * \brief The view of position_map_buffer for the current forward pass, in shape
+   * (batch_size, max_append_len), which holds the row in the pools of every new token,
+   * and -1 for the padding.
+   */
+  NDArray cur_position_map{nullptr};
+
+  int64_t BlockSize() const { return pools[0]->shape[1]; }
+
+  Sequence& GetSequence(int64_t slot) {
+    CHECK(0 <= slot && slot < static_cast<int64_t>(sequences.size()) && sequences[slot].in_use)
+        << "Slot " << slot << " is not in use";
+    return sequences[slot];
+  }
+
+  int32_t AllocateBlock() {
+    CHECK(!free_blocks.empty()) << "The paged KV cache runs out of blocks, please increase "
+                                   "the KV cache capacity or reduce concurrent sequences";
+    int32_t block = free_blocks.back();
+    free_blocks.pop_back();
+    block_ref_counts[block] = 1;
+    return block;
+  }
+
+  void RetainBlock(int32_t block) {
+    CHECK_GT(block_ref_counts[block], 0) << "Block " << block << " is not in use";
+    ++block_ref_counts[block];
+  }
+
+  void ReleaseBlock(int32_t block) {
+    CHECK_GT(block_ref_counts[block], 0) << "Block " << block << " is not in use";
+    if (--block_ref_counts[block] == 0) {
+      free_blocks.push_back(block);
+    }
+  }
+
+  /*! \brief Grow or shrink the blocks of a sequence to hold the given number of tokens. */
+  void ResizeSequence(Sequence* seq, int64_t length) {
+    size_t num_blocks = (length + BlockSize() - 1) / BlockSize();
+    while (seq->blocks.size() > num_blocks) {
+      ReleaseBlock(seq->blocks.back());
+      seq->blocks.pop_back();
+    }
+    while (seq->blocks.size() < num_blocks) {
+      seq->blocks.push_back(AllocateBlock());
+    }
+    seq->length = length;
+  }
+
+  /*! \brief Copy the partially filled last block of a sequence if it is shared. */
+  void EnsureLastBlockWritable(Sequence* seq);
+
+  static constexpr const char* _type_key = "mlc.PagedKVCache";
+  TVM_DECLARE_FINAL_OBJECT_INFO(PagedKVCacheObj, Object);
+};
+
+class PagedKVCache : public ObjectRef {
+ public:
+  explicit PagedKVCache(Array<NDArray> pools, PackedFunc f_append) {
+    CHECK(!pools.empty());
+    ObjectPtr<PagedKVCacheObj> n = make_object<PagedKVCacheObj>();
+    int32_t num_blocks = pools[0]->shape[0];
+    n->block_ref_counts.resize(num_blocks, 0);
+    // pop from the back, so that blocks are handed out in increasing order
+    for (int32_t block = num_blocks - 1; block >= 0; --block) {
+      n->free_blocks.push_back(block);
+    }
+    n->pools = std::move(pools);
+    n->f_append = std::move(f_append);
+    data_ = std::move(n);
+  }
+
+  TVM_DEFINE_MUTABLE_OBJECT_REF_METHODS(PagedKVCache, ObjectRef, PagedKVCacheObj);
+};
+
+TVM_REGISTER_OBJECT_TYPE(PagedKVCacheObj);
+
+namespace {
+
+/*!
+ * \brief Copy rows between two arrays whose trailing two dimensions are (num_heads, head_dim).
+ */
+void CopyKVRows(const NDArray& src, int64_t src_row, const NDArray& dst, int64_t dst_row,
+                int64_t num_rows) {
+  if (num_rows == 0) return;
+  int64_t row_numel = src->shape[src->ndim - 2] * src->shape[src->ndim - 1];
+  int64_t row_bytes = row_numel * ((src->dtype.bits * src->dtype.lanes + 7) / 8);
+  int64_t shape[2] = {num_rows, row_numel};
+  DLTensor from = *src.operator->();
+  from.ndim = 2;
+  from.shape = shape;
+  from.strides = nullptr;
+  from.byte_offset += src_row * row_bytes;
+  DLTensor to = *dst.operator->();
+  to.ndim = 2;
+  to.shape = shape;
+  to.strides = nullptr;
+  to.byte_offset += dst_row * row_bytes;
+  NDArray::CopyFromTo(&from, &to);
+}
+
+/*!
+ * \brief Copy int32 data to a device buffer, which grows when it is too small, and return
+ * a view of the buffer with the given shape.
+ */
+NDArray UploadToBuffer(const std::vector<int32_t>& data, ShapeTuple shape, Device device,
+                       NDArray* buffer) {
+  int64_t size = static_cast<int64_t>(data.size());
+  if (!buffer->defined() || (*buffer)->shape[0] < size) {
+    int64_t init_size = 256;
+    while (init_size < size) {
+      init_size *= 2;
+    }
+    *buffer = NDArray::Empty({init_size}, DataType::Int(32), device);
+  }
+  NDArray view = buffer->CreateView(shape, DataType::Int(32));
+  if (size > 0) {
+    view.CopyFromBytes(data.data(), size * sizeof(int32_t));
+  }
+  return view;
+}
+
+}  // namespace
+
+void PagedKVCacheObj::EnsureLastBlockWritable(Sequence* seq) {
+  int64_t offset = seq->length % BlockSize();
+  if (offset == 0) return;
+  int32_t& block = seq->blocks[seq->length / BlockSize()];
+  if (block_ref_counts[block] == 1) return;
+  int32_t new_block = AllocateBlock();
+  for (const NDArray& pool : pools) {
+    CopyKVRows(pool, block * BlockSize(), pool, new_block * BlockSize(), offset);
+  }
+  ReleaseBlock(block);
+  block = new_block;
+}
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.create")
+    .set_body_typed([](Array<NDArray> pools, PackedFunc f_append) {
+      return PagedKVCache(pools, f_append);
+    });
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.add_sequence").set_body_typed([](PagedKVCache cache) {
+  auto it = std::find_if(cache->sequences.begin(), cache->sequences.end(),
+                         [](const PagedKVCacheObj::Sequence& seq) { return !seq.in_use; });
+  if (it == cache->sequences.end()) {
+    it = cache->sequences.emplace(cache->sequences.end());
+  }
+  it->in_use = true;
+  it->length = 0;
+  return static_cast<int64_t>(it - cache->sequences.begin());
+});
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.remove_sequence")
+    .set_body_typed([](PagedKVCache cache, int64_t slot) {
+      PagedKVCacheObj::Sequence& seq = cache->GetSequence(slot);
+      cache->ResizeSequence(&seq, 0);
+      seq.in_use = false;
+    });
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.reset_sequence")
+    .set_body_typed([](PagedKVCache cache, int64_t slot) {
+      cache->ResizeSequence(&cache->GetSequence(slot), 0);
+    });
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.popn")
+    .set_body_typed([](PagedKVCache cache, int64_t slot, int64_t n) {
+      PagedKVCacheObj::Sequence& seq = cache->GetSequence(slot);
+      CHECK(0 <= n && n <= seq.length) << "Cannot pop " << n << " tokens";
+      cache->ResizeSequence(&seq, seq.length - n);
+    });
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.begin_forward")
+    .set_body_typed([](PagedKVCache cache, ShapeTuple slots, ShapeTuple append_lens) {
+      CHECK_EQ(slots.size(), append_lens.size());
+      int64_t batch_size = slots.size();
+      cache->cur_slots.assign(slots.begin(), slots.end());
+      cache->cur_append_lens.assign(append_lens.begin(), append_lens.end());
+      cache->cur_past_lens.clear();
+      size_t max_num_blocks = 1;
+      int64_t max_append_len = 0;
+      for (int64_t i = 0; i < batch_size; ++i) {
+        PagedKVCacheObj::Sequence& seq = cache->GetSequence(slots[i]);
+        cache->cur_past_lens.push_back(seq.length);
+        if (append_lens[i] > 0) {
+          cache->EnsureLastBlockWritable(&seq);
+        }
+        cache->ResizeSequence(&seq, seq.length + append_lens[i]);
+        max_num_blocks = std::max(max_num_blocks, seq.blocks.size());
+        max_append_len = std::max(max_append_len, append_lens[i]);
+      }
+      // upload the block tables, padded with block 0 which is never read unmasked
+      std::vector<int32_t> block_table(batch_size * max_num_blocks, 0);
+      // and the rows of the new tokens, in the layout of the right-padded inputs
+      std::vector<int32_t> position_map(batch_size * max_append_len, -1);
+      int64_t block_size = cache->BlockSize();
+      for (int64_t i = 0; i < batch_size; ++i) {
+        const std::vector<int32_t>& blocks = cache->sequences[slots[i]].blocks;
+        std::copy(blocks.begin(), blocks.end(), block_table.begin() + i * max_num_blocks);
+        for (int64_t j = 0; j < append_lens[i]; ++j) {
+          int64_t pos = cache->cur_past_lens[i] + j;
+          position_map[i * max_append_len + j] =
+              blocks[pos / block_size] * block_size + pos % block_size;
+        }
+      }
+      Device device = cache->pools[0]->device;
+      cache->cur_block_table =
+          UploadToBuffer(block_table, {batch_size, static_cast<int64_t>(max_num_blocks)}, device,
+                         &cache->block_table_buffer);
+      cache->cur_position_map = UploadToBuffer(position_map, {batch_size, max_append_len},
+                                               device, &cache->position_map_buffer);
+      // the lengths before this forward pass, i.e., the position offsets of the new tokens
+      return ShapeTuple(cache->cur_past_lens);
+    });
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.append")
+    .set_body_typed([](PagedKVCache cache, NDArray k_data, NDArray v_data, int64_t layer) {
+      // data: (batch_size, seq_len, num_heads, head_dim), right-padded
+      CHECK(cache->cur_position_map.defined()) << "begin_forward is not called";
+      CHECK_EQ(k_data->shape[0], cache->cur_position_map->shape[0]);
+      CHECK_EQ(k_data->shape[1], cache->cur_position_map->shape[1]);
+      // a single kernel scatters the keys and values of all sequences into their blocks
+      cache->f_append(cache->pools[layer * 2], cache->pools[layer * 2 + 1], k_data, v_data,
+                      cache->cur_position_map);
+      return cache;
+    });
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.block_size").set_body_typed([](PagedKVCache cache) {
+  return cache->BlockSize();
+});
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.num_free_blocks").set_body_typed([](PagedKVCache cache) {
+  return static_cast<int64_t>(cache->free_blocks.size());
+});
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.get_blocks")
+    .set_body_typed([](PagedKVCache cache, int64_t slot) {
+      const std::vector<int32_t>& blocks = cache->GetSequence(slot).blocks;
+      return ShapeTuple(blocks.begin(), blocks.end());
+    });
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.retain_blocks")
+    .set_body_typed([](PagedKVCache cache, ShapeTuple blocks) {
+      for (int64_t block : blocks) {
+        cache->RetainBlock(block);
+      }
+    });
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.release_blocks")
+    .set_body_typed([](PagedKVCache cache, ShapeTuple blocks) {
+      for (int64_t block : blocks) {
+        cache->ReleaseBlock(block);
+      }
+    });
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.attach_prefix")
+    .set_body_typed([](PagedKVCache cache, int64_t slot, ShapeTuple blocks) {
+      // the empty sequence starts with the given full blocks, which are shared
+      PagedKVCacheObj::Sequence& seq = cache->GetSequence(slot);
+      CHECK_EQ(seq.length, 0) << "Can only attach a prefix to an empty sequence";
+      for (int64_t block : blocks) {
+        cache->RetainBlock(block);
+        seq.blocks.push_back(block);
+      }
+      seq.length = blocks.size() * cache->BlockSize();
+    });
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.fork_sequence")
+    .set_body_typed([](PagedKVCache cache, int64_t slot) {
+      // the new sequence shares all the blocks, the partially filled last block included,
+      // which is copied by whichever sequence writes into it first
+      std::vector<int32_t> blocks = cache->GetSequence(slot).blocks;
+      int64_t length = cache->GetSequence(slot).length;
+      auto it = std::find_if(cache->sequences.begin(), cache->sequences.end(),
+                             [](const PagedKVCacheObj::Sequence& seq) { return !seq.in_use; });
+      if (it == cache->sequences.end()) {
+        it = cache->sequences.emplace(cache->sequences.end());
+      }
+      for (int32_t block : blocks) {
+        cache->RetainBlock(block);
+      }
+      it->in_use = true;
+      it->length = length;
+      it->blocks = std::move(blocks);
+      return static_cast<int64_t>(it - cache->sequences.begin());
+    });
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.get_pool")
+    .set_body_typed([](PagedKVCache cache, int64_t layer) { return cache->pools[layer]; });
+
+TVM_REGISTER_GLOBAL("mlc.paged_kv_cache.get_block_table").set_body_typed([](PagedKVCache cache) {
+  CHECK(cache->cur_block_table.defined()) << "begin_forward is not called";
+  return cache->cur_block_table;
+});
+
+}  // namespace llm
+}  // namespace mlc
@@ -0,0 +1,124 @@
+/*!
+ *  Copyright (c) 2023 by Contributors
+ * \file prefix_cache.cc
+ * \brief Implementation of the cache of KV states of prompt prefixes in MLC-LLM.
+ */
+#include "prefix_cache.h"
+
+#include <algorithm>
+#include <utility>
+
+namespace mlc {
+namespace llm {
+
+namespace {
+
+/*! \brief The length of the common prefix of edge and tokens[pos:]. */
+size_t CommonPrefixLength(const std::vector<int32_t>& edge, const std::vector<int32_t>& tokens,
+                          size_t pos) {
+  size_t n = 0;
+  while (n < edge.size() && pos + n < tokens.size() && edge[n] == tokens[pos + n]) {
+    ++n;
+  }
+  return n;
+}
+
+}  // namespace
+
+PrefixCache::PrefixCache() : root_(std::make_unique<Node>()) {}
+
+PrefixCache::Node* PrefixCache::FindSnapshotNode(Node* node) {
+  // every leaf holds a snapshot, as empty leaves are pruned on eviction
+  while (!node->snapshot.defined()) {
+    if (node->children.empty()) return nullptr;
+    node = node->children.begin()->second.get();
+  }
+  return node;
+}
+
+void PrefixCache::Touch(Node* node) { lru_.splice(lru_.end(), lru_, node->lru_pos); }
+
+PrefixCache::MatchResult PrefixCache::Match(const std::vector<int32_t>& tokens) {
+  Node* node = root_.get();
+  size_t pos = 0;
+  while (pos < tokens.size()) {
+    auto it = node->children.find(tokens[pos]);
+    if (it == node->children.end()) break;
+    Node* child = it->second.get();
+    size_t n = CommonPrefixLength(child->tokens, tokens, pos);
+    pos += n;
+    // the sequences below the child also start with the matched tokens
+    node = child;
+    if (n < child->tokens.size()) break;
+  }
+  MatchResult result;
+  if (pos == 0) return result;
+  Node* snapshot_node = FindSnapshotNode(node);
+  if (snapshot_node == nullptr) return result;
+  this->Touch(snapshot_node);
+  result.length = pos;
+  result.snapshot = snapshot_node->snapshot;
+  return result;
+}
+
+bool PrefixCache::Insert(const std::vector<int32_t>& tokens, ObjectRef snapshot) {
+  if (tokens.empty()) return false;
+  Node* node = root_.get();
+  size_t pos = 0;
+  while (pos < tokens.size()) {
+    auto it = node->children.find(tokens[pos]);
+    if (it == node->children.end()) {
+      auto child = std::make_unique<Node>();
+      child->tokens.assign(tokens.begin() + pos, tokens.end());
+      child->depth = tokens.size();
+      child->parent = node;
+      node = (node->children[tokens[pos]] = std::move(child)).get();
+      pos = tokens.size();
+      break;
+    }
+    Node* child = it->second.get();
+    size_t n = CommonPrefixLength(child->tokens, tokens, pos);
+    if (n < child->tokens.size()) {
+      // split the edge at the first mismatch
+      auto middle = std::make_unique<Node>();
+      middle->tokens.assign(child->tokens.begin(), child->tokens.begin() + n);
+      middle->depth = node->depth + n;
+      middle->parent = node;
+      child->tokens.erase(child->tokens.begin(), child->tokens.begin() + n);
+      child->parent = middle.get();
+      middle->children[child->tokens[0]] = std::move(it->second);
+      it->second = std::move(middle);
+      child = it->second.get();
+    }
+    node = child;
+    pos += n;
+  }
+  if (node->snapshot.defined()) {
+    this->Touch(node);
+    return false;
+  }
+  node->snapshot = std::move(snapshot);
+  node->lru_pos = lru_.insert(lru_.end(), node);
+  num_cached_tokens_ += node->depth;
+  return true;
+}
+
+ObjectRef PrefixCache::EvictOne() {
+  if (lru_.empty()) return ObjectRef(nullptr);
+  Node* victim = lru_.front();
+  lru_.pop_front();
+  ObjectRef snapshot = std::move(victim->snapshot);
+  victim->snapshot = ObjectRef(nullptr);
+  num_cached_tokens_ -= victim->depth;
+  // prune the nodes that no longer lead to any snapshot
+  Node* node = victim;
+  while (node != root_.get() && !node->snapshot.defined() && node->children.empty()) {
+    Node* parent = node->parent;
+    parent->children.erase(node->tokens[0]);
+    node = parent;
+  }
+  return snapshot;
+}
+
+}  // namespace llm
+}  // namespace mlc
@@ -0,0 +1,97 @@
+/*!
+ *  Copyright (c) 2023 by Contributors
+ * \file prefix_cache.h
+ * \brief Header of the cache of KV states of prompt prefixes in MLC-LLM.
+ */
+#ifndef MLC_LLM_CPP_PREFIX_CACHE_H_
+#define MLC_LLM_CPP_PREFIX_CACHE_H_
+
+#include <tvm/runtime/object.h>
+
+#include <list>
+#include <memory>
+#include <unordered_map>
+#include <vector>
+
+namespace mlc {
+namespace llm {
+
+using tvm::runtime::ObjectRef;
+
+/*!
+ * \brief A radix tree over token id sequences, which maps cached sequences to the
+ *  snapshots of their KV states.
+ *
+ * As the KV state of a prefix is a prefix of the KV state, a lookup returns the longest
+ * prefix shared with any cached sequence, together with the snapshot of that sequence.
+ * Snapshots are evicted in least recently used order by the owner of the cache, which
+ * also releases the resources they hold. The nodes holding snapshots are kept in a list
+ * in that order, so that an eviction takes constant time besides pruning the tree.
+ */
+class PrefixCache {
+ public:
+  /*! \brief The result of a lookup. */
+  struct MatchResult {
+    /*! \brief The number of leading tokens shared with a cached sequence. */
+    int64_t length{0};
+    /*! \brief The snapshot of the cached sequence, undefined if nothing matches. */
+    ObjectRef snapshot{nullptr};
+  };
+
+  PrefixCache();
+
+  /*!
+   * \brief Find the longest prefix of the tokens that a cached sequence starts with.
+   * \param tokens The token ids to look up.
+   * \return The length of the prefix and the snapshot of the cached sequence.
+   */
+  MatchResult Match(const std::vector<int32_t>& tokens);
+
+  /*!
+   * \brief Cache the snapshot of a token sequence.
+   * \param tokens The token ids.
+   * \param snapshot The snapshot of the KV state of the tokens.
+   * \return Whether the snapshot is added, false if the sequence is already cached.
+   */
+  bool Insert(const std::vector<int32_t>& tokens, ObjectRef snapshot);
+
+  /*!
+   * \brief Remove the least recently used snapshot.
+   * \return The removed snapshot, undefined if the cache is empty.
+   */
+  ObjectRef EvictOne();
+
+  /*! \return The total number of tokens of the cached sequences. */
+  int64_t NumCachedTokens() const { return num_cached_tokens_; }
+
+ private:
+  struct Node {
+    /*! \brief The token ids on the edge from the parent. */
+    std::vector<int32_t> tokens;
+    /*! \brief The number of token ids from the root to the end of this node. */
+    int64_t depth{0};
+    Node* parent{nullptr};
+    /*! \brief The children, keyed by the first token id on their edges. */
+    std::unordered_map<int32_t, std::unique_ptr<Node>> children;
+    /*! \brief The snapshot of the sequence ending at this node, if it is cached. */
+    ObjectRef snapshot{nullptr};
+    /*! \brief The position of the node in lru_, valid when it holds a snapshot. */
+    std::list<Node*>::iterator lru_pos;
+  };
+
+  /*! \brief Find a node holding a snapshot in the subtree. */
+  static Node* FindSnapshotNode(Node* node);
+
+  /*! \brief Mark the snapshot of a node as the most recently used one. */
+  void Touch(Node* node);
+
+  std::unique_ptr<Node> root_;
+  /*! \brief The nodes holding snapshots, from the least to the most recently used. */
+  std::list<Node*> lru_;
+  int64_t num_cached_tokens_{0};
+};
+
+}  // namespace llm
+}  // namespace mlc
+
+#endif  // MLC_LLM_CPP_PREFIX_CACHE_H_
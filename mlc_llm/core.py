@@ -81,6 +81,10 @@ class BuildArgs:
         relax.build的参数。
     sep_embed: bool
         仅适用于LlaMa,使用分离的嵌入层构建。该功能处于测试阶段,后续将进行嵌入层功能的全面升级。
+    attention_sink: bool
+        仅适用于LlaMa,KV cache 中保存旋转位置编码之前的 key,使运行时可以保留 attention sink 并滑动窗口。
+    decode_n_steps: int
+        仅适用于LlaMa,大于 1 时额外构建 decode_n 函数,在模型内部连续贪心解码多步。
     """
     model: str = field(
         default="auto",
@@ -229,6 +233,33 @@ class BuildArgs:
             "action": "store_true",
         },
     )
+    # KV cache 中保存旋转位置编码之前的 key,每次计算注意力时按 cache 中的下标施加旋转位置编码,
+    # 这样运行时可以驱逐 attention sink 之后的 token 而不需要重新 prefill。
+    attention_sink: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Keep the keys before the rotary embedding in the KV cache, and apply the "
+                "rotary embedding by the position in the cache, only applicable to LlaMa. "
+                "It lets the runtime shift the context window by evicting the tokens after "
+                "the attention sinks, see `attention_sink_size` of the chat config."
+            ),
+            "action": "store_true",
+        },
+    )
+    # 在一个函数中展开多步解码,每一步在设备上取 argmax 作为下一步的输入,
+    # 贪心解码时运行时每 decode_n_steps 个 token 才回到主机一次。
+    decode_n_steps: int = field(
+        default=0,
+        metadata={
+            "help": (
+                "Build a `decode_n` function running this number of greedy decode steps on "
+                "device, only applicable to LlaMa. The runtime uses it when the temperature "
+                "is 0, so that the host is visited once every this number of tokens. "
+                "It is not built when the number is below 2."
+            ),
+        },
+    )
     # 在张量并行多GPU推理中将模型划分的分片数量。
     num_shards: int = field(
         default=1,
@@ -397,6 +428,27 @@ def mod_transform_before_build(
             model_names = ["embed", "prefill_with_embed"] + model_names[1:]
         if args.model.lower().startswith("rwkv-"):
             model_names += ["reset_kv_cache"]
+        # 支持批量推理的模型额外提供 batch_prefill / batch_decode 函数,
+        # 支持设备端采样的模型额外提供 sample_top_p_top_k 函数,
+        # 支持投机解码的模型额外提供返回所有位置 logits 的 verify 函数,
+        # 指定 --decode-n-steps 的模型额外提供在设备上连续解码多步的 decode_n 函数,
+        # 分离 embedding 的模型额外提供批量计算 embedding 的 embed_batch 函数,
+        # 以及在设备上完成池化与归一化的 embed_pooled 函数
+        func_names = [gv.name_hint for gv in mod.get_global_vars()]
+        model_names += [
+            name
+            for name in [
+                "embed_batch",
+                "embed_pooled",
+                "verify",
+                "decode_n",
+                "batch_prefill",
+                "batch_decode",
+                "create_paged_kv_cache",
+                "sample_top_p_top_k",
+            ]
+            if name in func_names
+        ]
 
     # 调用 param_manager.transform_dequantize 函数反量化
     mod = param_manager.transform_dequantize(mod)
@@ -487,6 +539,15 @@ def mod_transform_before_build(
     mod = mlc_llm.transform.FuseDecodeTake()(mod)
     # 调用DeadCodeElimination消除死代码
     mod = relax.transform.DeadCodeElimination(model_names)(mod)
+    # 检查构建选项要求的入口函数没有被消除,否则运行时会静默地回退
+    deployed_names = [gv.name_hint for gv in mod.get_global_vars()]
+    required_names = ["decode_n"] if args.decode_n_steps > 1 else []
+    missing_names = [name for name in required_names if name not in deployed_names]
+    if missing_names:
+        raise RuntimeError(
+            f"The functions {missing_names} required by the build options are missing after "
+            "the transformations, check the entry functions of `mod_transform_before_build`"
+        )
     # 调用CleanUpTIRAttrs清理TIR特定属性
     mod = mlc_llm.transform.CleanUpTIRAttrs()(mod)
     # 保存中间结果mod_deploy
@@ -533,6 +594,9 @@ def dump_mlc_chat_config(
     config["max_window_size"] = max_window_size
     config["num_shards"] = args.num_shards
     config["shift_fill_factor"] = shift_fill_factor
+    if args.attention_sink:
+        # 模型支持 attention sink 时默认保留前 4 个 token
+        config["attention_sink_size"] = 4
     config["tokenizer_files"] = utils.get_tokenizer_files(args.params_path)
     config["model_category"] = args.model_category
     config["model_name"] = args.model
@@ -595,6 +659,8 @@ def build(mod_deploy: tvm.IRModule, args: argparse.Namespace) -> None:
         # The num_input attribute is needed to capture transformed weights passed as input
         # into a cuda graph.
         mod_deploy["decode"] = mod_deploy["decode"].with_attr({"num_input": 3})
+        if "batch_decode" in [gv.name_hint for gv in mod_deploy.get_global_vars()]:
+            mod_deploy["batch_decode"] = mod_deploy["batch_decode"].with_attr({"num_input": 4})
         ex = relax.build(mod_deploy, args.target, system_lib=args.system_lib)
 
     output_filename = f"{args.model}-{args.quantization.name}-{target_kind}.{args.lib_format}"
@@ -647,6 +713,10 @@ def build_model_from_args(args: argparse.Namespace):
     use_cache = args.use_cache and os.path.isfile(cache_path)
     if args.sep_embed and args.model_category != "llama":
         raise ValueError(f"separate embedding not supported on {args.model}")
+    if args.attention_sink and args.model_category != "llama":
+        raise ValueError(f"attention sink not supported on {args.model}")
+    if args.decode_n_steps > 1 and args.model_category != "llama":
+        raise ValueError(f"multi-step decoding not supported on {args.model}")
     if args.model_category != "minigpt":
         with open(os.path.join(args.model_path, "config.json"), encoding="utf-8") as i_f:
             config = json.load(i_f)
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 
 import json
 from tvm import relax
@@ -10,14 +10,22 @@ def create_metadata_func(
     max_window_size: int,
     stop_tokens: List[int],
     add_prefix_space: bool,
+    attention_sink_kv_shape: Optional[List[int]] = None,
+    decode_n_steps: int = 0,
 ):
-    metadata = json.dumps(
-        {
-            "model_name": model_name,
-            "max_window_size": max_window_size,
-            "stop_tokens": stop_tokens,
-            "add_prefix_space": add_prefix_space,
-        }
-    )
+    metadata = {
+        "model_name": model_name,
+        "max_window_size": max_window_size,
+        "stop_tokens": stop_tokens,
+        "add_prefix_space": add_prefix_space,
+    }
+    if attention_sink_kv_shape is not None:
+        # the KV cache keeps the keys before the rotary embedding, so the runtime can evict
+        # the entries of any tokens, which are of this shape per token
+        metadata["attention_sink_kv_shape"] = attention_sink_kv_shape
+    if decode_n_steps > 1:
+        # the number of tokens returned by "decode_n"
+        metadata["decode_n_steps"] = decode_n_steps
+    metadata = json.dumps(metadata)
     with bb.function("get_metadata", params=[]):
         bb.emit_func_output(relax.StringImm(metadata))
@@ -36,6 +36,8 @@ class LlamaConfig:
         tie_word_embeddings=False,
         position_embedding_base=10000,
         combine_matmul=True,
+        kv_cache_block_size=16,
+        attention_sink=False,
         num_shards=1,
         build_model_only=False,
         convert_weight_only=False,
@@ -58,6 +60,8 @@ class LlamaConfig:
         self.tie_word_embeddings = tie_word_embeddings
         self.position_embedding_base = position_embedding_base
         self.combine_matmul = combine_matmul
+        self.kv_cache_block_size = kv_cache_block_size
+        self.attention_sink = attention_sink
         if build_model_only and num_shards > 1:
             self.num_shards = num_shards
         else:
@@ -184,7 +188,11 @@ class LlamaMLP(nn.Module):
         return result
 
 
-def apply_rotary_pos_emb(q, k, position_embedding_base, offset: int = 0):
+def apply_rotary_pos_emb(q, k, position_embedding_base, offset: int = 0, k_offset=None):
+    """Apply the rotary embedding to q and k, whose i-th rows sit at positions ``offset + i``
+    and ``k_offset + i`` respectively. ``k_offset`` defaults to ``offset``, and differs when
+    k is the whole KV cache rather than the keys of the new tokens."""
+
     def f_rotary_embedding(tensor, offset):
         dtype = tensor.dtype
         head_dim = tensor.shape[-1]
@@ -192,7 +200,11 @@ def apply_rotary_pos_emb(q, k, position_embedding_base, offset: int = 0):
 
         def rotary_compute(*idx):
             i, j = idx[-3], idx[-1]
-            pos = (offset + i).astype("float32")
+            if isinstance(offset, te.Tensor):
+                # per-sequence offsets in batched mode
+                pos = (offset[idx[0]].astype("int64") + i).astype("float32")
+            else:
+                pos = (offset + i).astype("float32")
             inv_freq = te.const(1, "float32") / (
                 te.power(
                     te.const(position_embedding_base, "float32"),
@@ -211,7 +223,9 @@ def apply_rotary_pos_emb(q, k, position_embedding_base, offset: int = 0):
         return tvm.te.compute(tensor.shape, rotary_compute, name="rotary")
 
     q_embed = nn.emit_te(f_rotary_embedding, q, offset, primfunc_name_hint="rotary_embedding")
-    k_embed = nn.emit_te(f_rotary_embedding, k, offset, primfunc_name_hint="rotary_embedding")
+    if k_offset is None:
+        k_offset = offset
+    k_embed = nn.emit_te(f_rotary_embedding, k, k_offset, primfunc_name_hint="rotary_embedding")
     return q_embed, k_embed
 
 
@@ -230,6 +244,8 @@ class LlamaAttention(nn.Module):
         self.num_query_heads = config.num_attention_heads // self.num_shards
         self.head_dim = self.hidden_size // config.num_attention_heads
         self.position_embedding_base = config.position_embedding_base
+        self.kv_cache_block_size = config.kv_cache_block_size
+        self.attention_sink = config.attention_sink
 
         self.combine_matmul = config.combine_matmul
         if self.combine_matmul:
@@ -268,12 +284,200 @@ class LlamaAttention(nn.Module):
         )
         self.o_proj.weight.shard_dim = 1
 
+    def _update_and_view_kv_cache(
+        self,
+        key_states: relax.Expr,
+        value_states: relax.Expr,
+        kv_seq_len: tvm.tir.PrimExpr,
+        past_key_value: Tuple[relax.Expr],
+    ) -> Tuple[relax.Expr, relax.Expr, Tuple[relax.Expr]]:
+        from tvm.relax.op import reshape, squeeze
+
+        kv_states_shape = key_states.struct_info.shape
+        kv_states_dtype = key_states.struct_info.dtype
+        assert kv_states_shape[0] == 1  # bsz
+        kv_states_shape = R.shape(
+            [kv_states_shape[0], kv_seq_len, kv_states_shape[2], kv_states_shape[3]]
+        )
+        kv_cache_shape = R.shape([kv_seq_len, kv_states_shape[2], kv_states_shape[3]])
+
+        squeezed_key = nn.emit(squeeze(key_states, axis=0))
+        squeezed_value = nn.emit(squeeze(value_states, axis=0))
+        k_cache, v_cache = past_key_value
+        f_kv_cache_append = relax.extern("vm.builtin.attention_kv_cache_append")
+        k_cache = nn.emit(
+            relax.Call(
+                f_kv_cache_append,
+                args=[k_cache, squeezed_key],
+                sinfo_args=[relax.ObjectStructInfo()],
+            )
+        )
+        v_cache = nn.emit(
+            relax.Call(
+                f_kv_cache_append,
+                args=[v_cache, squeezed_value],
+                sinfo_args=[relax.ObjectStructInfo()],
+            )
+        )
+        past_key_value = (k_cache, v_cache)
+        f_kv_cache_view = relax.extern("vm.builtin.attention_kv_cache_view")
+        k_cache = nn.emit(
+            relax.Call(
+                f_kv_cache_view,
+                args=[k_cache, kv_cache_shape],
+                sinfo_args=[R.Tensor(kv_cache_shape, kv_states_dtype)],
+            )
+        )
+        v_cache = nn.emit(
+            relax.Call(
+                f_kv_cache_view,
+                args=[v_cache, kv_cache_shape],
+                sinfo_args=[R.Tensor(kv_cache_shape, kv_states_dtype)],
+            )
+        )
+        key_states = nn.emit(reshape(k_cache, kv_states_shape))
+        value_states = nn.emit(reshape(v_cache, kv_states_shape))
+        return key_states, value_states, past_key_value
+
+    def _update_paged_kv_cache(
+        self,
+        key_states: relax.Expr,
+        value_states: relax.Expr,
+        kv_cache: relax.Expr,
+        layer_id: int,
+    ) -> Tuple[relax.Expr, relax.Expr, relax.Expr, relax.Expr]:
+        """Append the new keys/values of every sequence in the batch to the paged KV cache,
+        and return the key/value pools of the layer and the block tables, through which the
+        attention reads the cached keys/values."""
+        bb = relax.BlockBuilder.current()
+        bsz, _, num_heads, head_dim = key_states.struct_info.shape
+        kv_states_dtype = key_states.struct_info.dtype
+        block_size = self.kv_cache_block_size
+
+        # the keys and values of a layer are scattered into their blocks by one kernel
+        kv_cache = nn.emit(
+            relax.Call(
+                relax.extern("mlc.paged_kv_cache.append"),
+                args=[kv_cache, key_states, value_states, relax.PrimValue(layer_id)],
+                sinfo_args=[relax.ObjectStructInfo()],
+            )
+        )
+        num_blocks = tvm.tir.Var("num_blocks", "int64")
+        pools = []
+        for kv_id in range(2):
+            pool = nn.emit(
+                relax.Call(
+                    relax.extern("mlc.paged_kv_cache.get_pool"),
+                    args=[kv_cache, relax.PrimValue(layer_id * 2 + kv_id)],
+                    sinfo_args=[relax.TensorStructInfo(ndim=4, dtype=kv_states_dtype)],
+                )
+            )
+            pools.append(
+                bb.match_cast(
+                    pool,
+                    relax.TensorStructInfo(
+                        (num_blocks, block_size, num_heads, head_dim), kv_states_dtype
+                    ),
+                )
+            )
+        block_table = nn.emit(
+            relax.Call(
+                relax.extern("mlc.paged_kv_cache.get_block_table"),
+                args=[kv_cache],
+                sinfo_args=[relax.TensorStructInfo(ndim=2, dtype="int32")],
+            )
+        )
+        block_table = bb.match_cast(
+            block_table,
+            relax.TensorStructInfo((bsz, tvm.tir.Var("max_num_blocks", "int64")), "int32"),
+        )
+        return pools[0], pools[1], block_table, kv_cache
+
+    def _paged_attention_scores(
+        self,
+        query_states: relax.Expr,
+        k_pool: relax.Expr,
+        block_table: relax.Expr,
+        kv_seq_len: tvm.tir.PrimExpr,
+    ) -> relax.Expr:
+        """Compute q·k of every query against the cached keys, in shape
+        (bsz, num_query_heads, q_len, kv_seq_len). The keys are read from their blocks
+        through the block tables, so no dense copy of the cache is made, and the key heads
+        are shared by their query heads in place."""
+        bsz, q_len, num_query_heads, head_dim = query_states.struct_info.shape
+        n_rep = self.num_query_heads // self.num_key_value_heads
+        block_size = self.kv_cache_block_size
+
+        def f_paged_attention_scores(q: te.Tensor, pool: te.Tensor, block_table: te.Tensor):
+            d = te.reduce_axis((0, head_dim), name="d")
+            return te.compute(
+                (bsz, num_query_heads, q_len, kv_seq_len),
+                lambda b, h, i, j: te.sum(
+                    q[b, i, h, d]
+                    * pool[
+                        block_table[b, j // block_size].astype("int64"),
+                        j % block_size,
+                        h // n_rep,
+                        d,
+                    ],
+                    axis=d,
+                ),
+                name="paged_attention_scores",
+            )
+
+        return nn.emit_te(
+            f_paged_attention_scores,
+            query_states,
+            k_pool,
+            block_table,
+            primfunc_name_hint="paged_attention_scores",
+        )
+
+    def _paged_attention_output(
+        self, attn_weights: relax.Expr, v_pool: relax.Expr, block_table: relax.Expr
+    ) -> relax.Expr:
+        """Compute the attention output in shape (bsz, q_len, num_query_heads, head_dim),
+        reading the cached values through the block tables."""
+        bsz, num_query_heads, q_len, kv_seq_len = attn_weights.struct_info.shape
+        head_dim = v_pool.struct_info.shape[3]
+        n_rep = self.num_query_heads // self.num_key_value_heads
+        block_size = self.kv_cache_block_size
+
+        def f_paged_attention_output(
+            weights: te.Tensor, pool: te.Tensor, block_table: te.Tensor
+        ):
+            j = te.reduce_axis((0, kv_seq_len), name="j")
+            return te.compute(
+                (bsz, q_len, num_query_heads, head_dim),
+                lambda b, i, h, d: te.sum(
+                    weights[b, h, i, j]
+                    * pool[
+                        block_table[b, j // block_size].astype("int64"),
+                        j % block_size,
+                        h // n_rep,
+                        d,
+                    ],
+                    axis=j,
+                ),
+                name="paged_attention_output",
+            )
+
+        return nn.emit_te(
+            f_paged_attention_output,
+            attn_weights,
+            v_pool,
+            block_table,
+            primfunc_name_hint="paged_attention_output",
+        )
+
     def forward(
         self,
         hidden_states: relax.Expr,
         all_seq_len_shape: relax.Expr,
         past_key_value: Tuple[relax.Expr],
         attention_mask: Optional[relax.Expr] = None,
+        past_lens: Optional[relax.Expr] = None,
+        layer_id: int = 0,
     ) -> Tuple[relax.Expr, Optional[relax.Expr], Optional[Tuple[relax.Expr]]]:
         from tvm.relax.op import (
             astype,
@@ -282,12 +486,12 @@ class LlamaAttention(nn.Module):
             permute_dims,
             reshape,
             split,
-            squeeze,
         )
         from tvm.relax.op.nn import softmax
 
         bsz, q_len, _ = hidden_states.struct_info.shape
-        assert bsz == 1, "Only support batch size 1 at this moment."
+        if past_lens is None:
+            assert bsz == 1, "Only support batch size 1 without `past_lens`."
 
         if self.combine_matmul:
             qkv_states = nn.emit(
@@ -328,71 +532,55 @@ class LlamaAttention(nn.Module):
         )
 
         kv_seq_len = all_seq_len_shape.struct_info.values[0]
-        offset = kv_seq_len - q_len
-        query_states, key_states = apply_rotary_pos_emb(
-            query_states,
-            key_states,
-            self.position_embedding_base,
-            offset=offset,
-        )
-        # [bsz, t, nh, hd]
-
-        kv_states_shape = key_states.struct_info.shape
-        kv_states_dtype = key_states.struct_info.dtype
-        assert kv_states_shape[0] == 1  # bsz
-        kv_states_shape = R.shape(
-            [kv_states_shape[0], kv_seq_len, kv_states_shape[2], kv_states_shape[3]]
-        )
-        kv_cache_shape = R.shape([kv_seq_len, kv_states_shape[2], kv_states_shape[3]])
-
-        squeezed_key = nn.emit(squeeze(key_states, axis=0))
-        squeezed_value = nn.emit(squeeze(value_states, axis=0))
-        k_cache, v_cache = past_key_value
-        f_kv_cache_append = relax.extern("vm.builtin.attention_kv_cache_append")
-        k_cache = nn.emit(
-            relax.Call(
-                f_kv_cache_append,
-                args=[k_cache, squeezed_key],
-                sinfo_args=[relax.ObjectStructInfo()],
+        offset = kv_seq_len - q_len if past_lens is None else past_lens
+        if self.attention_sink and past_lens is None:
+            # the KV cache keeps the keys before the rotary embedding, which is applied to the
+            # whole cache by the index in it, so the positions are re-based when the runtime
+            # evicts the tokens after the attention sinks
+            key_states, value_states, past_key_value = self._update_and_view_kv_cache(
+                key_states, value_states, kv_seq_len, past_key_value
             )
-        )
-        v_cache = nn.emit(
-            relax.Call(
-                f_kv_cache_append,
-                args=[v_cache, squeezed_value],
-                sinfo_args=[relax.ObjectStructInfo()],
-            )
-        )
-        past_key_value = (k_cache, v_cache)
-        f_kv_cache_view = relax.extern("vm.builtin.attention_kv_cache_view")
-        k_cache = nn.emit(
-            relax.Call(
-                f_kv_cache_view,
-                args=[k_cache, kv_cache_shape],
-                sinfo_args=[R.Tensor(kv_cache_shape, kv_states_dtype)],
+            query_states, key_states = apply_rotary_pos_emb(
+                query_states,
+                key_states,
+                self.position_embedding_base,
+                offset=offset,
+                k_offset=0,
             )
-        )
-        v_cache = nn.emit(
-            relax.Call(
-                f_kv_cache_view,
-                args=[v_cache, kv_cache_shape],
-                sinfo_args=[R.Tensor(kv_cache_shape, kv_states_dtype)],
+        else:
+            query_states, key_states = apply_rotary_pos_emb(
+                query_states,
+                key_states,
+                self.position_embedding_base,
+                offset=offset,
             )
-        )
-        key_states = nn.emit(reshape(k_cache, kv_states_shape))
-        value_states = nn.emit(reshape(v_cache, kv_states_shape))
-        if self.num_key_value_heads != self.num_query_heads:
-            n_rep = self.num_query_heads // self.num_key_value_heads
-            key_states = nn.emit(relax.op.repeat(key_states, n_rep, axis=2))
-            value_states = nn.emit(relax.op.repeat(value_states, n_rep, axis=2))
+            # [bsz, t, nh, hd]
+
+            if past_lens is None:
+                key_states, value_states, past_key_value = self._update_and_view_kv_cache(
+                    key_states, value_states, kv_seq_len, past_key_value
+                )
+            else:
+                k_pool, v_pool, block_table, past_key_value = self._update_paged_kv_cache(
+                    key_states, value_states, past_key_value, layer_id
+                )
+        if past_lens is None:
+            if self.num_key_value_heads != self.num_query_heads:
+                n_rep = self.num_query_heads // self.num_key_value_heads
+                key_states = nn.emit(relax.op.repeat(key_states, n_rep, axis=2))
+                value_states = nn.emit(relax.op.repeat(value_states, n_rep, axis=2))
 
-        query_states = nn.emit(permute_dims(query_states, [0, 2, 1, 3]))
-        key_states = nn.emit(permute_dims(key_states, [0, 2, 1, 3]))
-        value_states = nn.emit(permute_dims(value_states, [0, 2, 1, 3]))
+            query_states = nn.emit(permute_dims(query_states, [0, 2, 1, 3]))
+            key_states = nn.emit(permute_dims(key_states, [0, 2, 1, 3]))
+            value_states = nn.emit(permute_dims(value_states, [0, 2, 1, 3]))
 
+            attn_weights = matmul(query_states, permute_dims(key_states, [0, 1, 3, 2]))
+        else:
+            attn_weights = self._paged_attention_scores(
+                query_states, k_pool, block_table, kv_seq_len
+            )
         attn_weights = nn.emit(
-            matmul(query_states, permute_dims(key_states, [0, 1, 3, 2]))
-            / relax.const(math.sqrt(self.head_dim), query_states.struct_info.dtype)
+            attn_weights / relax.const(math.sqrt(self.head_dim), query_states.struct_info.dtype)
         )
 
         tvm.ir.assert_structural_equal(
@@ -416,10 +604,12 @@ class LlamaAttention(nn.Module):
             attn_weights = astype(attn_weights, "float32")
         attn_weights = nn.emit(softmax(attn_weights, axis=-1))
         if attn_weights.struct_info.dtype != query_states.struct_info.dtype:
-            attn_weights = astype(attn_weights, query_states.struct_info.dtype)
-        attn_output = nn.emit(matmul(attn_weights, value_states))
-
-        attn_output = nn.emit(permute_dims(attn_output, [0, 2, 1, 3]))
+            attn_weights = nn.emit(astype(attn_weights, query_states.struct_info.dtype))
+        if past_lens is None:
+            attn_output = nn.emit(matmul(attn_weights, value_states))
+            attn_output = nn.emit(permute_dims(attn_output, [0, 2, 1, 3]))
+        else:
+            attn_output = self._paged_attention_output(attn_weights, v_pool, block_table)
         attn_output = nn.emit(
             reshape(attn_output, (bsz, q_len, self.head_dim * self.num_query_heads))
         )
@@ -448,6 +638,8 @@ class LlamaDecoderLayer(nn.Module):
         all_seq_len_shape: relax.Expr,
         past_key_value: Tuple[relax.Expr],
         attention_mask: Optional[relax.Expr] = None,
+        past_lens: Optional[relax.Expr] = None,
+        layer_id: int = 0,
     ) -> Tuple[relax.Expr, Optional[Tuple[relax.Expr, relax.Expr]]]:
         residual = hidden_states
 
@@ -459,6 +651,8 @@ class LlamaDecoderLayer(nn.Module):
             past_key_value=past_key_value,
             attention_mask=attention_mask,
             all_seq_len_shape=all_seq_len_shape,
+            past_lens=past_lens,
+            layer_id=layer_id,
         )
         hidden_states = nn.emit(residual + hidden_states)
 
@@ -502,6 +696,24 @@ def _make_causal_mask(input_ids_shape, dtype, src_len):
     return nn.emit_te(extend_te, diag_mask, tgt_len, src_len)
 
 
+def _make_batch_causal_mask(input_ids_shape, dtype, src_len, past_lens):
+    bsz, tgt_len = input_ids_shape
+
+    def batch_causal_mask_te(past_lens):
+        # the i-th new token of sequence b sits at position past_lens[b] + i
+        return te.compute(
+            (bsz, 1, tgt_len, src_len),
+            lambda b, _, i, j: tvm.tir.Select(
+                j <= past_lens[b].astype("int64") + i,
+                tvm.tir.max_value(dtype),
+                tvm.tir.min_value(dtype),
+            ),
+            name="make_batch_causal_mask_te",
+        )
+
+    return nn.emit_te(batch_causal_mask_te, past_lens)
+
+
 class LlamaEmbedTokens(nn.Module):
     def __init__(self, config: LlamaConfig, vocab_size_var: tvm.tir.Var):
         self.embed_tokens = Embedding(vocab_size_var, config.hidden_size, dtype=config.dtype)
@@ -559,6 +771,7 @@ class LlamaModel(nn.Module):
         inputs: relax.Expr,
         all_seq_len_shape: relax.Expr,
         past_key_values: relax.Expr,
+        past_lens: Optional[relax.Expr] = None,
     ):
         if self.num_shards > 1:
             inputs = nn.emit(ccl.broadcast_from_worker0(inputs))
@@ -570,11 +783,19 @@ class LlamaModel(nn.Module):
         batch_size, seq_length, _ = inputs_embeds.struct_info.shape
         seq_length_with_past = all_seq_len_shape.struct_info.values[0]
         # embed positions
-        attention_mask = self._prepare_decoder_attention_mask(
-            (batch_size, seq_length),
-            seq_length_with_past,
-            inputs_embeds.struct_info.dtype,
-        )
+        if past_lens is None:
+            attention_mask = self._prepare_decoder_attention_mask(
+                (batch_size, seq_length),
+                seq_length_with_past,
+                inputs_embeds.struct_info.dtype,
+            )
+        else:
+            attention_mask = _make_batch_causal_mask(
+                (batch_size, seq_length),
+                inputs_embeds.struct_info.dtype,
+                seq_length_with_past,
+                past_lens,
+            )
 
         hidden_states = inputs_embeds
 
@@ -583,18 +804,29 @@ class LlamaModel(nn.Module):
 
         for idx, decoder_layer in enumerate(self.layers):
             assert past_key_values is not None
-            past_key_value = (past_key_values[idx * 2], past_key_values[idx * 2 + 1])
+            if past_lens is None:
+                past_key_value = (past_key_values[idx * 2], past_key_values[idx * 2 + 1])
+            else:
+                # the paged KV cache is a single object threaded through all layers
+                past_key_value = past_key_values
 
             hidden_states, key_value_cache = decoder_layer(
                 hidden_states,
                 attention_mask=attention_mask,
                 past_key_value=past_key_value,
                 all_seq_len_shape=all_seq_len_shape,
+                past_lens=past_lens,
+                layer_id=idx,
             )
-            next_decoder_cache += key_value_cache
+            if past_lens is None:
+                next_decoder_cache += key_value_cache
+            else:
+                past_key_values = key_value_cache
 
         hidden_states = self.norm(hidden_states)
 
+        if past_lens is not None:
+            return hidden_states, past_key_values
         assert len(next_decoder_cache) == len(self.layers) * 2
         return hidden_states, next_decoder_cache
 
@@ -620,11 +852,15 @@ class LlamaForCausalLM(nn.Module):
         inputs: relax.Expr,
         all_seq_len_shape: relax.Expr,
         past_key_values: relax.Expr,
+        past_lens: Optional[relax.Expr] = None,
+        input_lens: Optional[relax.Expr] = None,
+        all_logits: bool = False,
     ):
         hidden_states, key_value_cache = self.model(
             inputs=inputs,
             all_seq_len_shape=all_seq_len_shape,
             past_key_values=past_key_values,
+            past_lens=past_lens,
         )
 
         def te_slicing(x: te.Tensor):
@@ -634,7 +870,21 @@ class LlamaForCausalLM(nn.Module):
                 name="slice",
             )
 
-        logits = self.lm_head(nn.emit_te(te_slicing, hidden_states, primfunc_name_hint="slice"))
+        def te_batch_slicing(x: te.Tensor, input_lens: te.Tensor):
+            # take the last valid position of each (right-padded) sequence
+            return te.compute(
+                shape=(x.shape[0], 1, x.shape[-1]),
+                fcompute=lambda i, j, k: x[i, input_lens[i].astype("int64") - 1, k],
+                name="batch_slice",
+            )
+
+        if input_lens is not None:
+            hidden_states = nn.emit_te(
+                te_batch_slicing, hidden_states, input_lens, primfunc_name_hint="batch_slice"
+            )
+        elif past_lens is None and not all_logits:
+            hidden_states = nn.emit_te(te_slicing, hidden_states, primfunc_name_hint="slice")
+        logits = self.lm_head(hidden_states)
         if logits.struct_info.dtype != "float32":
             logits = nn.emit(relax.op.astype(logits, "float32"))
 
@@ -678,6 +928,113 @@ def create_embed_func(
     bb.update_func(gv, mod[gv].with_attr("num_input", 1))
 
 
+def create_batch_embed_func(
+    bb: relax.BlockBuilder,
+    param_manager: ParamManager,
+    config: LlamaConfig,
+    quant_scheme: QuantizationScheme,
+) -> None:
+    """Embed a batch of token sequences, right-padded to the longest one, in one call."""
+    func_name = "embed_batch"
+
+    bsz = tvm.tir.Var("b", "int64")
+    seq_len = tvm.tir.Var("n", "int64")
+    with bb.function(func_name):
+        model = LlamaEmbedTokensWrapper(config, tvm.tir.Var("v", "int64"))
+        param_manager.register_params(model, func_name, quant_scheme, get_param_quant_kind)
+
+        input_ids = nn.Placeholder((bsz, seq_len), dtype="int32", name="input_ids")
+        with bb.dataflow():
+            inputs_embeds = model(input_ids)
+            params = [input_ids] + model.parameters()
+            gv = bb.emit_output(inputs_embeds)
+        bb.emit_func_output(gv, params)
+
+    mod = bb.get()
+    gv = mod.get_global_var(func_name)
+    bb.update_func(gv, mod[gv].with_attr("num_input", 1))
+
+
+def create_pooled_embed_func(
+    bb: relax.BlockBuilder,
+    param_manager: ParamManager,
+    config: LlamaConfig,
+    quant_scheme: QuantizationScheme,
+) -> None:
+    """Embed a batch of token sequences and pool each into one vector on device.
+
+    The input ids are right-padded to the longest input and ``input_lens`` holds the
+    number of valid ids of each input. ``pooling_params`` is (last_token, normalize):
+    the embeddings are mean-pooled over the valid tokens, or the last valid token is
+    taken when last_token is non-zero, and the result is L2-normalized when normalize
+    is non-zero. Only the pooled float32 vectors are returned.
+    """
+    func_name = "embed_pooled"
+
+    bsz = tvm.tir.Var("b", "int64")
+    seq_len = tvm.tir.Var("n", "int64")
+    hidden_size = config.hidden_size
+
+    def te_pooling_weights(input_lens: te.Tensor, params: te.Tensor):
+        def fcompute(b, k):
+            length = tvm.tir.Cast("int64", input_lens[b])
+            zero = tvm.tir.const(0, "float32")
+            last_token = tvm.tir.Select(k == length - 1, tvm.tir.const(1, "float32"), zero)
+            mean = tvm.tir.Select(
+                k < length,
+                tvm.tir.const(1, "float32")
+                / tvm.tir.Cast("float32", tvm.tir.max(input_lens[b], 1)),
+                zero,
+            )
+            return tvm.tir.Select(params[0] != 0, last_token, mean)
+
+        return te.compute((bsz, seq_len), fcompute, name="pooling_weights")
+
+    def te_normalize(pooled: te.Tensor, square_sum: te.Tensor, params: te.Tensor):
+        def fcompute(b, j):
+            norm = tvm.tir.max(tvm.tir.sqrt(square_sum[b, 0]), tvm.tir.const(1e-12, "float32"))
+            return tvm.tir.Select(params[1] != 0, pooled[b, j] / norm, pooled[b, j])
+
+        return te.compute((bsz, hidden_size), fcompute, name="normalize")
+
+    with bb.function(func_name):
+        model = LlamaEmbedTokensWrapper(config, tvm.tir.Var("v", "int64"))
+        param_manager.register_params(model, func_name, quant_scheme, get_param_quant_kind)
+
+        input_ids = nn.Placeholder((bsz, seq_len), dtype="int32", name="input_ids")
+        input_lens = nn.Placeholder((bsz,), dtype="int32", name="input_lens")
+        pooling_params = nn.Placeholder((2,), dtype="int32", name="pooling_params")
+        with bb.dataflow():
+            inputs_embeds = model(input_ids)
+            weights = nn.emit_te(
+                te_pooling_weights,
+                input_lens,
+                pooling_params,
+                primfunc_name_hint="pooling_weights",
+            )
+            # (b, 1, n) x (b, n, hidden) -> (b, 1, hidden)
+            pooled = nn.emit(
+                relax.op.matmul(
+                    relax.op.reshape(weights, (bsz, 1, seq_len)),
+                    relax.op.astype(inputs_embeds, "float32"),
+                )
+            )
+            pooled = nn.emit(relax.op.reshape(pooled, (bsz, hidden_size)))
+            square_sum = nn.emit(
+                relax.op.sum(relax.op.multiply(pooled, pooled), axis=[1], keepdims=True)
+            )
+            output = nn.emit_te(
+                te_normalize, pooled, square_sum, pooling_params, primfunc_name_hint="normalize"
+            )
+            params = [input_ids, input_lens, pooling_params] + model.parameters()
+            gv = bb.emit_output(output)
+        bb.emit_func_output(gv, params)
+
+    mod = bb.get()
+    gv = mod.get_global_var(func_name)
+    bb.update_func(gv, mod[gv].with_attr("num_input", 3))
+
+
 def create_encoding_func(
     bb: relax.BlockBuilder,
     param_manager: ParamManager,
@@ -764,6 +1121,210 @@ def create_decoding_func(
     bb.update_func(gv, mod[gv].with_attr("num_input", 3))
 
 
+def create_multi_step_decoding_func(
+    bb: relax.BlockBuilder,
+    param_manager: ParamManager,
+    config: LlamaConfig,
+    quant_scheme: QuantizationScheme,
+    num_steps: int,
+) -> None:
+    """Run "decode" for a fixed number of steps, feeding the argmax of each step to the next.
+
+    The steps are unrolled in one function, so that greedy decoding returns to the host
+    once every `num_steps` tokens. The token ids are returned in shape (1, num_steps), and
+    every step appends its input to the KV cache, i.e. the last token id is not in it.
+    """
+    func_name = "decode_n"
+
+    bsz = 1
+    all_seq_len = tvm.tir.Var("n", "int64")
+
+    def te_argmax(logits: te.Tensor, max_logit: te.Tensor):
+        # the smallest index of the maximum, the same as the greedy path of sampling
+        vocab_size = logits.shape[-1]
+        j = te.reduce_axis((0, vocab_size), name="j")
+        return te.compute(
+            (bsz, 1),
+            lambda b, i: te.min(
+                tvm.tir.Select(logits[b, i, j] == max_logit[b, i], j, vocab_size - 1), axis=j
+            ),
+            name="argmax",
+        )
+
+    with bb.function(func_name):
+        model = LlamaForCausalLM(config, tvm.tir.Var("v", "int64"))
+        param_manager.register_params(model, func_name, quant_scheme, get_param_quant_kind)
+
+        input_ids = nn.Placeholder((bsz, 1), dtype="int32", name="input_ids")
+        all_seq_len_shape = relax.Var("all_seq_len", relax.ShapeStructInfo((all_seq_len,)))
+        past_key_values = relax.Var(
+            "kv_cache",
+            relax.TupleStructInfo(
+                [relax.ObjectStructInfo() for _ in range(config.num_hidden_layers * 2)]
+            ),
+        )
+        with bb.dataflow():
+            token_ids = []
+            next_input = input_ids
+            key_value_cache = past_key_values
+            for step in range(num_steps):
+                logits, key_value_cache = model(
+                    next_input,
+                    relax.ShapeExpr([all_seq_len + step]),
+                    past_key_values=key_value_cache,
+                )
+                max_logit = nn.emit(relax.op.max(logits, axis=[2]))
+                next_input = nn.emit_te(te_argmax, logits, max_logit, primfunc_name_hint="argmax")
+                next_input = nn.emit(relax.op.astype(next_input, "int32"))
+                token_ids.append(next_input)
+            params = [
+                input_ids,
+                all_seq_len_shape,
+                past_key_values,
+            ] + model.parameters()
+            token_ids = nn.emit(relax.op.concat(token_ids, axis=1))
+            gv = bb.emit_output((token_ids, relax.Tuple(key_value_cache)))
+        bb.emit_func_output(gv, params)
+
+    mod = bb.get()
+    gv = mod.get_global_var(func_name)
+    bb.update_func(gv, mod[gv].with_attr("num_input", 3))
+
+
+def create_verification_func(
+    bb: relax.BlockBuilder,
+    param_manager: ParamManager,
+    config: LlamaConfig,
+    quant_scheme: QuantizationScheme,
+) -> None:
+    """Run the input tokens like "prefill", but return the logits of every position.
+
+    It is used by speculative decoding to check several drafted tokens in one forward pass.
+    """
+    func_name = "verify"
+
+    bsz = 1
+    seq_len = tvm.tir.Var("n", "int64")
+    all_seq_len = tvm.tir.Var("m", "int64")
+    with bb.function(func_name):
+        model = LlamaForCausalLM(config, tvm.tir.Var("v", "int64"))
+        param_manager.register_params(model, func_name, quant_scheme, get_param_quant_kind)
+
+        input_ids = nn.Placeholder((bsz, seq_len), dtype="int32", name="input_ids")
+        all_seq_len_shape = relax.Var("all_seq_len", relax.ShapeStructInfo((all_seq_len,)))
+        past_key_values = relax.Var(
+            "kv_cache",
+            relax.TupleStructInfo(
+                [relax.ObjectStructInfo() for _ in range(config.num_hidden_layers * 2)]
+            ),
+        )
+        with bb.dataflow():
+            logits, key_value_cache = model(
+                input_ids, all_seq_len_shape, past_key_values=past_key_values, all_logits=True
+            )
+            params = [
+                input_ids,
+                all_seq_len_shape,
+                past_key_values,
+            ] + model.parameters()
+            gv = bb.emit_output((logits, relax.Tuple(key_value_cache)))
+        bb.emit_func_output(gv, params)
+
+    mod = bb.get()
+    gv = mod.get_global_var(func_name)
+    bb.update_func(gv, mod[gv].with_attr("num_input", 3))
+
+
+def create_batch_encoding_func(
+    bb: relax.BlockBuilder,
+    param_manager: ParamManager,
+    config: LlamaConfig,
+    quant_scheme: QuantizationScheme,
+) -> None:
+    """Prefill a batch of sequences stored in the paged KV cache.
+
+    The input ids are right-padded to the longest input. ``past_lens`` holds the number of
+    tokens already cached for each sequence and ``input_lens`` the number of valid input ids.
+    ``all_seq_len`` is the maximum of ``past_lens + input_lens`` over the batch.
+    """
+    func_name = "batch_prefill"
+
+    bsz = tvm.tir.Var("b", "int64")
+    seq_len = tvm.tir.Var("n", "int64")
+    all_seq_len = tvm.tir.Var("m", "int64")
+    with bb.function(func_name):
+        model = LlamaForCausalLM(config, tvm.tir.Var("v", "int64"))
+        param_manager.register_params(model, func_name, quant_scheme, get_param_quant_kind)
+
+        input_ids = nn.Placeholder((bsz, seq_len), dtype="int32", name="input_ids")
+        past_lens = nn.Placeholder((bsz,), dtype="int32", name="past_lens")
+        input_lens = nn.Placeholder((bsz,), dtype="int32", name="input_lens")
+        all_seq_len_shape = relax.Var("all_seq_len", relax.ShapeStructInfo((all_seq_len,)))
+        kv_cache = relax.Var("kv_cache", relax.ObjectStructInfo())
+        with bb.dataflow():
+            logits, kv_cache_out = model(
+                input_ids,
+                all_seq_len_shape,
+                past_key_values=kv_cache,
+                past_lens=past_lens,
+                input_lens=input_lens,
+            )
+            params = [
+                input_ids,
+                past_lens,
+                input_lens,
+                all_seq_len_shape,
+                kv_cache,
+            ] + model.parameters()
+            gv = bb.emit_output((logits, kv_cache_out))
+        bb.emit_func_output(gv, params)
+
+    mod = bb.get()
+    gv = mod.get_global_var(func_name)
+    bb.update_func(gv, mod[gv].with_attr("num_input", 5))
+
+
+def create_batch_decoding_func(
+    bb: relax.BlockBuilder,
+    param_manager: ParamManager,
+    config: LlamaConfig,
+    quant_scheme: QuantizationScheme,
+) -> None:
+    """Decode one token for each sequence of a batch stored in the paged KV cache."""
+    func_name = "batch_decode"
+
+    bsz = tvm.tir.Var("b", "int64")
+    all_seq_len = tvm.tir.Var("n", "int64")
+
+    with bb.function(func_name):
+        model = LlamaForCausalLM(config, tvm.tir.Var("v", "int64"))
+        param_manager.register_params(model, func_name, quant_scheme, get_param_quant_kind)
+
+        input_ids = nn.Placeholder((bsz, 1), dtype="int32", name="input_ids")
+        past_lens = nn.Placeholder((bsz,), dtype="int32", name="past_lens")
+        all_seq_len_shape = relax.Var("all_seq_len", relax.ShapeStructInfo((all_seq_len,)))
+        kv_cache = relax.Var("kv_cache", relax.ObjectStructInfo())
+        with bb.dataflow():
+            logits, kv_cache_out = model(
+                input_ids,
+                all_seq_len_shape,
+                past_key_values=kv_cache,
+                past_lens=past_lens,
+            )
+            params = [
+                input_ids,
+                past_lens,
+                all_seq_len_shape,
+                kv_cache,
+            ] + model.parameters()
+            gv = bb.emit_output((logits, kv_cache_out))
+        bb.emit_func_output(gv, params)
+
+    mod = bb.get()
+    gv = mod.get_global_var(func_name)
+    bb.update_func(gv, mod[gv].with_attr("num_input", 4))
+
+
 def create_kv_cache_func(bb: relax.BlockBuilder, config: LlamaConfig) -> None:
     num_key_value_heads = (
         config.num_attention_heads
@@ -796,6 +1357,106 @@ def create_kv_cache_func(bb: relax.BlockBuilder, config: LlamaConfig) -> None:
         bb.emit_func_output(gv)
 
 
+def _get_kv_cache_append_func(block_size: int, num_heads: int, head_dim: int, dtype: str):
+    from tvm.script import tir as T
+
+    @T.prim_func
+    def kv_cache_append(
+        var_k_pool: T.handle,
+        var_v_pool: T.handle,
+        var_k_data: T.handle,
+        var_v_data: T.handle,
+        var_position_map: T.handle,
+    ):
+        T.func_attr({"tir.noalias": T.bool(True)})
+        num_blocks, batch_size, seq_len = T.int64(), T.int64(), T.int64()
+        # pylint: disable=invalid-name
+        k_pool = T.match_buffer(
+            var_k_pool,
+            (num_blocks, T.int64(block_size), T.int64(num_heads), T.int64(head_dim)),
+            dtype,
+        )
+        v_pool = T.match_buffer(
+            var_v_pool,
+            (num_blocks, T.int64(block_size), T.int64(num_heads), T.int64(head_dim)),
+            dtype,
+        )
+        k_data = T.match_buffer(
+            var_k_data, (batch_size, seq_len, T.int64(num_heads), T.int64(head_dim)), dtype
+        )
+        v_data = T.match_buffer(
+            var_v_data, (batch_size, seq_len, T.int64(num_heads), T.int64(head_dim)), dtype
+        )
+        position_map = T.match_buffer(var_position_map, (batch_size, seq_len), "int32")
+        # pylint: enable=invalid-name
+        # the position map holds the row of each new token in the pools, and -1 for padding
+        for b, i, h, d in T.grid(batch_size, seq_len, T.int64(num_heads), T.int64(head_dim)):
+            with T.block("append"):
+                v_b, v_i, v_h, v_d = T.axis.remap("SSSS", [b, i, h, d])
+                if position_map[v_b, v_i] >= 0:
+                    k_pool[
+                        T.Cast("int64", position_map[v_b, v_i]) // T.int64(block_size),
+                        T.Cast("int64", position_map[v_b, v_i]) % T.int64(block_size),
+                        v_h,
+                        v_d,
+                    ] = k_data[v_b, v_i, v_h, v_d]
+                    v_pool[
+                        T.Cast("int64", position_map[v_b, v_i]) // T.int64(block_size),
+                        T.Cast("int64", position_map[v_b, v_i]) % T.int64(block_size),
+                        v_h,
+                        v_d,
+                    ] = v_data[v_b, v_i, v_h, v_d]
+
+    return kv_cache_append
+
+
+def create_paged_kv_cache_func(bb: relax.BlockBuilder, config: LlamaConfig) -> None:
+    """Create the paged KV cache used by "batch_prefill" and "batch_decode", which holds
+    ``num_tokens`` tokens in total, in blocks of ``kv_cache_block_size`` tokens. The cache
+    writes the new keys/values of a layer into their blocks with the "kv_cache_append"
+    kernel."""
+    num_key_value_heads = (
+        config.num_attention_heads
+        if config.num_key_value_heads is None
+        else config.num_key_value_heads
+    ) // config.num_shards
+    num_tokens = tvm.tir.Var("num_tokens", "int64")
+    num_tokens_shape = relax.Var("num_tokens", relax.ShapeStructInfo((num_tokens,)))
+    block_size = config.kv_cache_block_size
+    init_shape = relax.ShapeExpr(
+        (
+            (num_tokens + block_size - 1) // block_size,  # num_blocks
+            block_size,
+            num_key_value_heads,
+            config.hidden_size // config.num_attention_heads,  # head_dim
+        )
+    )
+    append_func = bb.add_func(
+        _get_kv_cache_append_func(
+            block_size,
+            num_key_value_heads,
+            config.hidden_size // config.num_attention_heads,
+            config.dtype,
+        ),
+        "kv_cache_append",
+    )
+    with bb.function("create_paged_kv_cache", [num_tokens_shape]):
+        with bb.dataflow():
+            pools = [
+                bb.emit(relax.op.zeros(init_shape, config.dtype))
+                for _ in range(config.num_hidden_layers * 2)
+            ]
+            kv_cache = bb.emit(
+                relax.Call(
+                    relax.extern("mlc.paged_kv_cache.create"),
+                    args=[relax.Tuple(pools), append_func],
+                    sinfo_args=[relax.ObjectStructInfo()],
+                )
+            )
+            gv = bb.emit_output(kv_cache)
+        bb.emit_func_output(gv)
+
+
 def create_softmax_func(bb: relax.BlockBuilder, config: LlamaConfig) -> None:
     with bb.function("softmax_with_temperature"):
         logits = nn.Placeholder((1, 1, tvm.tir.Var("v", "int64")), dtype="float32", name="logits")
@@ -807,6 +1468,212 @@ def create_softmax_func(bb: relax.BlockBuilder, config: LlamaConfig) -> None:
         bb.emit_func_output(gv, [logits, temperature])
 
 
+def _get_repetition_penalty_func():
+    from tvm.script import tir as T
+
+    @T.prim_func
+    def apply_repetition_penalty(
+        var_logits: T.handle, var_token_ids: T.handle, var_params: T.handle, var_out: T.handle
+    ):
+        T.func_attr({"tir.noalias": T.bool(True)})
+        batch_size, vocab_size, num_tokens = T.int64(), T.int64(), T.int64()
+        # pylint: disable=invalid-name
+        logits = T.match_buffer(var_logits, (batch_size, T.int64(1), vocab_size), "float32")
+        token_ids = T.match_buffer(var_token_ids, (batch_size, num_tokens), "int32")
+        params = T.match_buffer(var_params, (T.int64(4),), "float32")
+        out = T.match_buffer(var_out, (batch_size, T.int64(1), vocab_size), "float32")
+        # pylint: enable=invalid-name
+        for b, v in T.grid(batch_size, vocab_size):
+            with T.block("copy"):
+                v_b, v_v = T.axis.remap("SS", [b, v])
+                out[v_b, T.int64(0), v_v] = logits[v_b, T.int64(0), v_v]
+        # the token ids of each row are distinct, and padded with -1
+        for b, k in T.grid(batch_size, num_tokens):
+            with T.block("penalize"):
+                v_b, v_k = T.axis.remap("SS", [b, k])
+                if token_ids[v_b, v_k] >= 0:
+                    out[v_b, T.int64(0), T.Cast("int64", token_ids[v_b, v_k])] = T.if_then_else(
+                        logits[v_b, T.int64(0), T.Cast("int64", token_ids[v_b, v_k])]
+                        <= T.float32(0),
+                        logits[v_b, T.int64(0), T.Cast("int64", token_ids[v_b, v_k])] * params[2],
+                        logits[v_b, T.int64(0), T.Cast("int64", token_ids[v_b, v_k])] / params[2],
+                    )
+
+    return apply_repetition_penalty
+
+
+def _te_uniform_noise(seed: tvm.tir.PrimExpr, index: tvm.tir.PrimExpr) -> tvm.tir.PrimExpr:
+    # a counter-based hash of (seed, index) mapped to the open interval (0, 1)
+    x = tvm.tir.Cast("uint32", index) * tvm.tir.const(0x9E3779B9, "uint32")
+    x = x ^ tvm.tir.Cast("uint32", seed)
+    x = x ^ (x >> tvm.tir.const(16, "uint32"))
+    x = x * tvm.tir.const(0x7FEB352D, "uint32")
+    x = x ^ (x >> tvm.tir.const(15, "uint32"))
+    x = x * tvm.tir.const(0x846CA68B, "uint32")
+    x = x ^ (x >> tvm.tir.const(16, "uint32"))
+    return (
+        tvm.tir.Cast("float32", x >> tvm.tir.const(8, "uint32")) + tvm.tir.const(0.5, "float32")
+    ) * tvm.tir.const(1.0 / (1 << 24), "float32")
+
+
+def create_sampling_func(
+    bb: relax.BlockBuilder, config: LlamaConfig, num_bisect_steps: int = 20
+) -> None:
+    """Sample the next token of each row of logits on device.
+
+    The function applies the repetition penalty and the temperature, and keeps the
+    candidates of top-k and top-p sampling. It avoids sorting the vocabulary: the
+    probability threshold of the candidates is found by bisection, and a candidate
+    is drawn with the Gumbel-max trick, using noise hashed from the given seed.
+
+    The sampling parameters are (temperature, top_p, repetition_penalty, top_k). A
+    temperature close to zero means greedy decoding, and a non-positive top_k keeps
+    the whole vocabulary.
+
+    The candidates differ from those of sorting in two ways. The threshold is only
+    approximate: ``num_bisect_steps`` steps leave it up to ``max_prob / 2 **
+    num_bisect_steps`` below the exact one, so tokens whose probabilities are that close
+    to the smallest kept probability may be kept as well, while no token of the exact
+    candidates is ever dropped. And the tokens tied with the k-th largest probability
+    are all kept, so more than ``top_k`` candidates can remain.
+
+    The sampled token ids are returned, together with the log-probability of every
+    sampled token under the distribution scaled by the temperature, so that samples can
+    be ranked, e.g. by best_of.
+    """
+    bsz = tvm.tir.Var("batch_size", "int64")
+    vocab_size = tvm.tir.Var("v", "int64")
+    num_penalty_tokens = tvm.tir.Var("n", "int64")
+    seed = tvm.tir.Var("seed", "int64")
+    penalty_func = bb.add_func(_get_repetition_penalty_func(), "apply_repetition_penalty")
+
+    def te_scale(logits: te.Tensor, params: te.Tensor):
+        temperature = tvm.tir.max(params[0], tvm.tir.const(1e-6, "float32"))
+        return te.compute(
+            logits.shape, lambda b, i, j: logits[b, i, j] / temperature, name="scale"
+        )
+
+    def _te_sum_above_mid(probs: te.Tensor, bounds: te.Tensor, fvalue, name: str):
+        j = te.reduce_axis((0, vocab_size), name="j")
+        half = tvm.tir.const(0.5, "float32")
+        return te.compute(
+            (bsz,),
+            lambda b: te.sum(
+                tvm.tir.Select(
+                    probs[b, 0, j] >= (bounds[b, 0] + bounds[b, 1]) * half,
+                    fvalue(b, j),
+                    tvm.tir.const(0, "float32"),
+                ),
+                axis=j,
+            ),
+            name=name,
+        )
+
+    def te_kept_mass(probs: te.Tensor, bounds: te.Tensor):
+        return _te_sum_above_mid(probs, bounds, lambda b, j: probs[b, 0, j], "kept_mass")
+
+    def te_kept_count(probs: te.Tensor, bounds: te.Tensor):
+        return _te_sum_above_mid(
+            probs, bounds, lambda b, j: tvm.tir.const(1, "float32"), "kept_count"
+        )
+
+    def te_bisect(bounds: te.Tensor, mass: te.Tensor, count: te.Tensor, params: te.Tensor):
+        # bounds[b] = (lo, hi), the candidates above lo always satisfy top-k or top-p
+        top_k = tvm.tir.Select(
+            params[3] > tvm.tir.const(0, "float32"),
+            params[3],
+            tvm.tir.Cast("float32", vocab_size),
+        )
+        # leave room for the rounding error of the summation
+        top_p = params[1] - tvm.tir.const(1e-6, "float32")
+
+        def fcompute(b, i):
+            mid = (bounds[b, 0] + bounds[b, 1]) * tvm.tir.const(0.5, "float32")
+            satisfied = tvm.tir.Or(count[b] >= top_k, mass[b] >= top_p)
+            return tvm.tir.Select(
+                i == 0,
+                tvm.tir.Select(satisfied, mid, bounds[b, 0]),
+                tvm.tir.Select(satisfied, bounds[b, 1], mid),
+            )
+
+        return te.compute((bsz, 2), fcompute, name="bisect")
+
+    def te_score(scaled: te.Tensor, probs: te.Tensor, bounds: te.Tensor, params: te.Tensor):
+        do_sample = params[0] >= tvm.tir.const(1e-6, "float32")
+
+        def fcompute(b, j):
+            gumbel = -tvm.tir.log(-tvm.tir.log(_te_uniform_noise(seed, b * vocab_size + j)))
+            return tvm.tir.Select(
+                probs[b, 0, j] >= bounds[b, 0],
+                scaled[b, 0, j] + tvm.tir.Select(do_sample, gumbel, tvm.tir.const(0, "float32")),
+                tvm.tir.min_value("float32"),
+            )
+
+        return te.compute((bsz, vocab_size), fcompute, name="score")
+
+    def te_argmax(score: te.Tensor, max_score: te.Tensor):
+        j = te.reduce_axis((0, vocab_size), name="j")
+        return te.compute(
+            (bsz,),
+            lambda b: te.min(
+                tvm.tir.Select(score[b, j] == max_score[b], j, vocab_size - 1), axis=j
+            ),
+            name="argmax",
+        )
+
+    def te_token_logprob(probs: te.Tensor, token_ids: te.Tensor):
+        tiny = tvm.tir.const(np.finfo("float32").tiny, "float32")
+        return te.compute(
+            (bsz,),
+            lambda b: tvm.tir.log(tvm.tir.max(probs[b, 0, token_ids[b]], tiny)),
+            name="token_logprob",
+        )
+
+    with bb.function("sample_top_p_top_k"):
+        logits = nn.Placeholder((bsz, 1, vocab_size), dtype="float32", name="logits")
+        penalty_token_ids = nn.Placeholder(
+            (bsz, num_penalty_tokens), dtype="int32", name="penalty_token_ids"
+        )
+        sampling_params = nn.Placeholder((4,), dtype="float32", name="sampling_params")
+        seed_shape = relax.Var("seed", relax.ShapeStructInfo((seed,)))
+        with bb.dataflow():
+            penalized = nn.emit(
+                relax.call_tir(
+                    penalty_func,
+                    [logits, penalty_token_ids, sampling_params],
+                    out_sinfo=relax.TensorStructInfo((bsz, 1, vocab_size), "float32"),
+                )
+            )
+            scaled = nn.emit_te(te_scale, penalized, sampling_params, primfunc_name_hint="scale")
+            probs = nn.emit(relax.op.nn.softmax(scaled, axis=-1))
+            bounds = nn.emit(
+                relax.op.concat(
+                    [
+                        relax.op.zeros((bsz, 1), "float32"),
+                        relax.op.reshape(relax.op.max(probs, axis=[1, 2]), (bsz, 1)),
+                    ],
+                    axis=1,
+                )
+            )
+            for _ in range(num_bisect_steps):
+                mass = nn.emit_te(te_kept_mass, probs, bounds, primfunc_name_hint="kept_mass")
+                count = nn.emit_te(te_kept_count, probs, bounds, primfunc_name_hint="kept_count")
+                bounds = nn.emit_te(
+                    te_bisect, bounds, mass, count, sampling_params, primfunc_name_hint="bisect"
+                )
+            score = nn.emit_te(
+                te_score, scaled, probs, bounds, sampling_params, primfunc_name_hint="score"
+            )
+            max_score = nn.emit(relax.op.max(score, axis=1))
+            token_ids = nn.emit_te(te_argmax, score, max_score, primfunc_name_hint="argmax")
+            logprobs = nn.emit_te(
+                te_token_logprob, probs, token_ids, primfunc_name_hint="token_logprob"
+            )
+            token_ids = nn.emit(relax.op.astype(token_ids, "int32"))
+            gv = bb.emit_output((token_ids, logprobs))
+        bb.emit_func_output(gv, [logits, penalty_token_ids, sampling_params, seed_shape])
+
+
 def emit_shard3d(bb: relax.BlockBuilder) -> None:
     from tvm.script import tir as T
 
@@ -858,6 +1725,7 @@ def get_model(args, hf_config):
         max_sequence_length=max_position_embeddings,
         position_embedding_base=position_embedding_base,
         combine_matmul=True,
+        attention_sink=args.attention_sink,
         num_shards=args.num_shards,
         build_model_only=args.build_model_only,
         convert_weight_only=args.convert_weight_only,
@@ -871,16 +1739,40 @@ def get_model(args, hf_config):
 
     if sep_embed:
         create_embed_func(bb, param_manager, config, args.quantization)
+        create_batch_embed_func(bb, param_manager, config, args.quantization)
+        create_pooled_embed_func(bb, param_manager, config, args.quantization)
     create_encoding_func(bb, param_manager, config, args.quantization, sep_embed)
     create_decoding_func(bb, param_manager, config, args.quantization)
+    create_verification_func(bb, param_manager, config, args.quantization)
+    if args.decode_n_steps > 1:
+        create_multi_step_decoding_func(
+            bb, param_manager, config, args.quantization, args.decode_n_steps
+        )
+    create_batch_encoding_func(bb, param_manager, config, args.quantization)
+    create_batch_decoding_func(bb, param_manager, config, args.quantization)
     create_kv_cache_func(bb, config)
+    create_paged_kv_cache_func(bb, config)
     create_softmax_func(bb, config)
+    create_sampling_func(bb, config)
+    attention_sink_kv_shape = None
+    if config.attention_sink:
+        num_key_value_heads = (
+            config.num_attention_heads
+            if config.num_key_value_heads is None
+            else config.num_key_value_heads
+        ) // config.num_shards
+        attention_sink_kv_shape = [
+            num_key_value_heads,
+            config.hidden_size // config.num_attention_heads,
+        ]
     create_metadata_func(
         bb,
         model_name=model_name,
         max_window_size=config.max_sequence_length,
         stop_tokens=[2],
         add_prefix_space=False,
+        attention_sink_kv_shape=attention_sink_kv_shape,
+        decode_n_steps=args.decode_n_steps,
     )
 
     mod = bb.get()
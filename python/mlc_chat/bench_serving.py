@@ -0,0 +1,327 @@
+"""Load generation benchmark of the MLC Chat REST server.
+
+Requests are sent to a running ``python -m mlc_chat.rest`` server with Poisson or
+fixed-rate arrivals, and the latency of every request is measured on the client:
+
+- TTFT, the time to the first output token, which is the first streamed chunk with
+  content, or the whole request when not streaming.
+- TPOT, the time per output token after the first one.
+- ITL, the time between two streamed chunks.
+- E2E, the end-to-end latency of the request.
+
+The number of output tokens is the ``completion_tokens`` of the usage the server reports,
+which comes with the last chunk when streaming.
+
+The report is printed as JSON, e.g.
+
+.. code:: bash
+
+    python -m mlc_chat.bench_serving --num-prompts 200 --request-rate 4 --stream
+    python -m mlc_chat.bench_serving --trace trace.jsonl --max-concurrency 16
+"""
+# pylint: disable=import-error, invalid-name
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+import numpy as np
+
+# The words of synthetic prompts, which are sampled uniformly.
+SYNTHETIC_WORDS = (
+    "the model serves many requests at the same time while the scheduler batches the "
+    "decode steps of every running sequence and the cache keeps the prompt of each chat"
+).split()
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def _parse_args():
+    args = argparse.ArgumentParser("MLC Chat REST API Serving Benchmark")
+    args.add_argument("--host", type=str, default="127.0.0.1", help="The host of the server.")
+    args.add_argument("--port", type=int, default=8000, help="The port of the server.")
+    args.add_argument("--model", type=str, default="", help="The model name sent in requests.")
+    args.add_argument(
+        "--endpoint",
+        type=str,
+        choices=["chat", "completions"],
+        default="chat",
+        help="Benchmark /v1/chat/completions or /v1/completions.",
+    )
+    args.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="A JSONL file of requests to replay. Each line has a \"prompt\" string or the "
+        "\"messages\" of a chat, and optionally \"timestamp\", the arrival time in seconds "
+        "relative to the first request, which is used when --request-rate is not given.",
+    )
+    args.add_argument(
+        "--num-prompts",
+        type=int,
+        default=100,
+        help="The number of requests. A trace is cycled or truncated to it.",
+    )
+    args.add_argument(
+        "--prompt-len",
+        type=int,
+        default=128,
+        help="The number of words of every synthetic prompt, used without --trace.",
+    )
+    args.add_argument(
+        "--request-rate",
+        type=float,
+        default=None,
+        help="The number of requests per second. All requests are sent at once when it is "
+        "inf, and by default the trace timestamps are replayed, or all requests are sent at once.",
+    )
+    args.add_argument(
+        "--arrival",
+        type=str,
+        choices=["poisson", "fixed"],
+        default="poisson",
+        help="The arrival process at --request-rate, with exponential or constant intervals.",
+    )
+    args.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=None,
+        help="The maximum number of requests in flight. Unlimited by default.",
+    )
+    args.add_argument("--stream", action="store_true", help="Whether to stream the responses.")
+    args.add_argument(
+        "--slo-ttft",
+        type=float,
+        default=None,
+        help="The TTFT objective in seconds. Goodput counts the requests meeting all objectives.",
+    )
+    args.add_argument(
+        "--slo-tpot", type=float, default=None, help="The TPOT objective in seconds."
+    )
+    args.add_argument("--seed", type=int, default=0, help="The seed of the arrivals and prompts.")
+    args.add_argument(
+        "--output", type=str, default=None, help="The file to write the JSON report to."
+    )
+    parsed = args.parse_args()
+    if parsed.stream and parsed.endpoint != "chat":
+        args.error("--stream is only supported by the chat endpoint")
+    return parsed
+
+
+@dataclass
+class RequestResult:
+    """The client-side measurement of one request."""
+
+    success: bool = False
+    error: str = ""
+    ttft: float = 0.0
+    e2e: float = 0.0
+    itls: List[float] = field(default_factory=list)
+    completion_tokens: int = 0
+
+    @property
+    def tpot(self) -> Optional[float]:
+        if self.completion_tokens <= 1:
+            return None
+        return (self.e2e - self.ttft) / (self.completion_tokens - 1)
+
+
+def load_requests(args) -> List[Dict[str, Any]]:
+    r"""Load the trace, or make synthetic requests.
+
+    Returns
+    -------
+    requests : List[Dict[str, Any]]
+        The requests, each with ``"messages"`` or ``"prompt"``, and optionally
+        ``"timestamp"``.
+    """
+    rng = random.Random(args.seed)
+    if args.trace is None:
+        return [
+            {"prompt": " ".join(rng.choice(SYNTHETIC_WORDS) for _ in range(args.prompt_len))}
+            for _ in range(args.num_prompts)
+        ]
+    with open(args.trace, "r", encoding="utf-8") as trace_file:
+        trace = [json.loads(line) for line in trace_file if line.strip()]
+    if not trace:
+        raise ValueError(f"The trace {args.trace} is empty")
+    if not all("timestamp" in request for request in trace):
+        return [trace[i % len(trace)] for i in range(args.num_prompts)]
+    # every cycle of the trace starts one period after the previous one, where the period
+    # is the span of the trace plus the mean interval between its requests
+    span = trace[-1]["timestamp"] - trace[0]["timestamp"]
+    period = span * len(trace) / (len(trace) - 1) if len(trace) > 1 else 0.0
+    requests = []
+    for i in range(args.num_prompts):
+        cycle, index = divmod(i, len(trace))
+        request = dict(trace[index])
+        request["timestamp"] += cycle * period
+        requests.append(request)
+    return requests
+
+
+def get_arrival_times(args, requests: List[Dict[str, Any]]) -> List[float]:
+    r"""The time of every request in seconds, relative to the start of the benchmark."""
+    if args.request_rate is None:
+        if all("timestamp" in request for request in requests):
+            start = requests[0]["timestamp"]
+            return [request["timestamp"] - start for request in requests]
+        return [0.0] * len(requests)
+    if args.request_rate == float("inf"):
+        return [0.0] * len(requests)
+    rng = np.random.default_rng(args.seed)
+    if args.arrival == "poisson":
+        intervals = rng.exponential(1.0 / args.request_rate, len(requests))
+    else:
+        intervals = np.full(len(requests), 1.0 / args.request_rate)
+    intervals[0] = 0.0
+    return np.cumsum(intervals).tolist()
+
+
+def make_payload(args, request: Dict[str, Any]) -> Dict[str, Any]:
+    if args.endpoint == "chat":
+        messages = request.get("messages") or [{"role": "user", "content": request["prompt"]}]
+        return {"model": args.model, "messages": messages, "stream": args.stream}
+    prompt = request.get("prompt")
+    if prompt is None:
+        prompt = request["messages"][-1]["content"]
+    return {"model": args.model, "prompt": prompt}
+
+
+async def send_request(
+    session: aiohttp.ClientSession, url: str, payload: Dict[str, Any], stream: bool
+) -> RequestResult:
+    r"""Send one request and measure its latency."""
+    result = RequestResult()
+    start = time.perf_counter()
+    try:
+        async with session.post(url, json=payload) as response:
+            if response.status != 200:
+                result.error = f"HTTP {response.status}: {await response.text()}"
+                return result
+            if stream:
+                last = None
+                usage = None
+                async for line in response.content:
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[len(b"data:") :].strip()
+                    if data == b"[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    usage = chunk.get("usage") or usage
+                    if not any(choice["delta"].get("content") for choice in chunk["choices"]):
+                        continue
+                    now = time.perf_counter()
+                    if last is None:
+                        result.ttft = now - start
+                    else:
+                        result.itls.append(now - last)
+                    last = now
+                result.e2e = time.perf_counter() - start
+                if usage is None:
+                    raise ValueError("The stream has no usage, the server is too old")
+                result.completion_tokens = usage.get("completion_tokens") or 0
+            else:
+                body = await response.json()
+                result.e2e = time.perf_counter() - start
+                result.ttft = result.e2e
+                result.completion_tokens = (body.get("usage") or {}).get("completion_tokens") or 0
+            result.success = True
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as err:
+        result.error = f"{type(err).__name__}: {err}"
+    return result
+
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    r"""Send all the requests at their arrival times, and summarize the results."""
+    requests = load_requests(args)
+    arrival_times = get_arrival_times(args, requests)
+    path = "/v1/chat/completions" if args.endpoint == "chat" else "/v1/completions"
+    url = f"http://{args.host}:{args.port}{path}"
+    semaphore = asyncio.Semaphore(args.max_concurrency) if args.max_concurrency else None
+
+    async def issue(session, request, arrival_time, start):
+        await asyncio.sleep(max(0.0, start + arrival_time - time.perf_counter()))
+        payload = make_payload(args, request)
+        if semaphore is None:
+            return await send_request(session, url, payload, args.stream)
+        async with semaphore:
+            return await send_request(session, url, payload, args.stream)
+
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *[
+                issue(session, request, arrival_time, start)
+                for request, arrival_time in zip(requests, arrival_times)
+            ]
+        )
+        duration = time.perf_counter() - start
+    return summarize(args, results, duration)
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    summary = {"mean": float(np.mean(values))}
+    for p in PERCENTILES:
+        summary[f"p{p}"] = float(np.percentile(values, p))
+    return summary
+
+
+def summarize(args, results: List[RequestResult], duration: float) -> Dict[str, Any]:
+    r"""Aggregate the results into the report."""
+    succeeded = [result for result in results if result.success]
+    errors: Dict[str, int] = {}
+    for result in results:
+        if not result.success:
+            errors[result.error] = errors.get(result.error, 0) + 1
+
+    def meets_slo(result: RequestResult) -> bool:
+        if args.slo_ttft is not None and result.ttft > args.slo_ttft:
+            return False
+        if args.slo_tpot is not None and (result.tpot or 0.0) > args.slo_tpot:
+            return False
+        return True
+
+    num_good = sum(1 for result in succeeded if meets_slo(result))
+    completion_tokens = sum(result.completion_tokens for result in succeeded)
+    return {
+        "num_requests": len(results),
+        "num_succeeded": len(succeeded),
+        "error_rate": (len(results) - len(succeeded)) / len(results) if results else 0.0,
+        "errors": errors,
+        "duration": duration,
+        "request_throughput": len(succeeded) / duration,
+        "output_token_throughput": completion_tokens / duration,
+        # the requests per second meeting the latency objectives
+        "goodput": num_good / duration,
+        "ttft": _percentiles([result.ttft for result in succeeded]),
+        "tpot": _percentiles([result.tpot for result in succeeded if result.tpot is not None]),
+        "itl": _percentiles([itl for result in succeeded for itl in result.itls]),
+        "e2e": _percentiles([result.e2e for result in succeeded]),
+    }
+
+
+def main():
+    args = _parse_args()
+    report = asyncio.run(run_benchmark(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(text + "\n")
+    if report["num_succeeded"] == 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
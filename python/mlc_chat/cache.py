@@ -0,0 +1,422 @@
+"""Caches of model outputs used by the REST server.
+
+:class:`EmbeddingCache` maps texts to their embedding vectors and token counts.
+Entries are addressed by a hash of the model id and the normalized text, so that
+re-embedding the same chunk, e.g. during repeated RAG ingestion, skips the model
+and the tokenizer entirely. The cache keeps
+a byte-bounded LRU tier in memory and an optional memory-mapped tier on disk, which
+survives restarts of the server.
+
+:class:`CompletionCache` maps deterministic generation requests to their outputs, and
+coalesces identical requests in flight, so that only one of them runs the model.
+"""
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+
+# The digest of a key in bytes, as stored on disk.
+DIGEST_SIZE = 32
+
+
+def _embedding_key(model_id: str, inp: Union[str, Sequence[int]]) -> bytes:
+    if not isinstance(inp, str):
+        # the token ids of a text
+        token_bytes = np.asarray(inp, dtype="<i4").tobytes()
+        return hashlib.sha256(f"{model_id}\0tokens\0".encode("utf-8") + token_bytes).digest()
+    # normalize the unicode representation, so that equal texts share an entry
+    normalized = unicodedata.normalize("NFC", inp)
+    return hashlib.sha256(f"{model_id}\0{normalized}".encode("utf-8")).digest()
+
+
+class CachedEmbedding(NamedTuple):
+    r"""The cached embedding of an input.
+
+    Parameters
+    ----------
+    vector : np.ndarray
+        The float32 embedding vector.
+    num_tokens : int
+        The number of tokens of the input, which is reported in the usage.
+    """
+
+    vector: np.ndarray
+    num_tokens: int
+
+
+class _DiskTier:
+    r"""A fixed number of embedding slots in memory-mapped files under a directory.
+
+    ``vectors`` holds one float32 vector per slot, and ``slots`` holds the digest of
+    the key, the token count of the input and a last-use counter of each slot, where a
+    zero counter means the slot is empty. A new entry takes an empty slot, or else the least recently used slot, which
+    are tracked in memory so that neither takes a scan of the slots. The files are
+    named after the vector dimension, so models of different sizes keep separate files.
+
+    Parameters
+    ----------
+    path : str
+        The directory of the files.
+    capacity_bytes : int
+        The maximum size of the files.
+    dim : int
+        The dimension of the embedding vectors.
+    """
+
+    def __init__(self, path: str, capacity_bytes: int, dim: int):
+        os.makedirs(path, exist_ok=True)
+        slot_dtype = np.dtype(
+            [("digest", f"S{DIGEST_SIZE}"), ("num_tokens", "<u4"), ("last_use", "<u8")]
+        )
+        num_slots = capacity_bytes // (dim * 4 + slot_dtype.itemsize)
+        if num_slots <= 0:
+            raise ValueError(
+                f"The disk capacity of {capacity_bytes} bytes cannot hold an embedding of "
+                f"dimension {dim}"
+            )
+        vectors_path = os.path.join(path, f"embeddings-{dim}.f32")
+        slots_path = os.path.join(path, f"embeddings-{dim}.slots")
+        expected_sizes = {
+            vectors_path: num_slots * dim * 4,
+            slots_path: num_slots * slot_dtype.itemsize,
+        }
+        if all(
+            os.path.exists(file_path) and os.path.getsize(file_path) == size
+            for file_path, size in expected_sizes.items()
+        ):
+            mode = "r+"
+        else:
+            # the files are new, made with another capacity, or one of them is missing
+            # or truncated
+            mode = "w+"
+        self.vectors = np.memmap(vectors_path, dtype="float32", mode=mode, shape=(num_slots, dim))
+        self.slots = np.memmap(slots_path, dtype=slot_dtype, mode=mode, shape=(num_slots,))
+        last_use = np.array(self.slots["last_use"])
+        used = np.nonzero(last_use)[0]
+        used = used[np.argsort(last_use[used], kind="stable")]
+        self.index = {bytes(self.slots["digest"][i]): int(i) for i in used}
+        # the used slots from the least to the most recently used, and the empty slots
+        self.order: "collections.OrderedDict[int, None]" = collections.OrderedDict(
+            (int(i), None) for i in used
+        )
+        self.free = [int(i) for i in np.nonzero(last_use == 0)[0][::-1]]
+        self.dim = dim
+        self.counter = int(last_use.max())
+
+    def get(self, key: bytes) -> Optional[CachedEmbedding]:
+        slot = self.index.get(key)
+        if slot is None:
+            return None
+        self.counter += 1
+        self.slots["last_use"][slot] = self.counter
+        self.order.move_to_end(slot)
+        return CachedEmbedding(np.array(self.vectors[slot]), int(self.slots["num_tokens"][slot]))
+
+    def put(self, key: bytes, vector: np.ndarray, num_tokens: int):
+        slot = self.index.get(key)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                slot, _ = self.order.popitem(last=False)
+                del self.index[bytes(self.slots["digest"][slot])]
+            self.index[key] = slot
+        self.counter += 1
+        self.vectors[slot] = vector
+        self.slots[slot] = (key, num_tokens, self.counter)
+        self.order[slot] = None
+        self.order.move_to_end(slot)
+
+    def flush(self):
+        self.vectors.flush()
+        self.slots.flush()
+
+
+class EmbeddingCache:
+    r"""A content-addressed LRU cache of embedding vectors, together with the token
+    counts of the inputs, which are reported in the usage. The inputs are texts,
+    or token ids of texts, which are keyed separately. It is thread-safe. The memory
+    tier and the on-disk tier have separate locks, so that a lookup in memory on the
+    asyncio event loop never waits for the disk I/O made by other threads.
+
+    Parameters
+    ----------
+    model_id : str
+        The id of the model producing the embeddings, which is part of every key.
+    capacity_bytes : int
+        The maximum total size of the vectors kept in memory.
+    disk_path : Optional[str]
+        The directory of the on-disk tier. When it is given, the vectors are also
+        written to memory-mapped files under the directory, which are reused by
+        later processes.
+    disk_capacity_bytes : int
+        The maximum size of the files of the on-disk tier.
+    """
+
+    def __init__(
+        self,
+        model_id: str,
+        capacity_bytes: int,
+        disk_path: Optional[str] = None,
+        disk_capacity_bytes: int = 1 << 30,
+    ):
+        if capacity_bytes < 0:
+            raise ValueError(
+                f"`capacity_bytes` is expected to be non-negative, while it is {capacity_bytes}"
+            )
+        self.model_id = model_id
+        self.capacity_bytes = capacity_bytes
+        self.disk_path = disk_path
+        self.disk_capacity_bytes = disk_capacity_bytes
+        self.num_hits = 0
+        self.num_misses = 0
+        self._entries: "collections.OrderedDict[bytes, CachedEmbedding]" = (
+            collections.OrderedDict()
+        )
+        self._num_bytes = 0
+        # _lock guards the memory tier and the counters, _disk_lock the on-disk tier
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk: Optional[_DiskTier] = None
+        if disk_path is not None and os.path.isdir(disk_path):
+            # reopen the files written most recently, the dimension is in their name
+            names = [
+                name
+                for name in os.listdir(disk_path)
+                if name.startswith("embeddings-") and name.endswith(".slots")
+            ]
+            if names:
+                name = max(names, key=lambda n: os.path.getmtime(os.path.join(disk_path, n)))
+                dim = int(name[len("embeddings-") : -len(".slots")])
+                self._disk = _DiskTier(disk_path, disk_capacity_bytes, dim)
+
+    def get(
+        self, inputs: List[Union[str, Sequence[int]]], disk: bool = False
+    ) -> List[Optional[CachedEmbedding]]:
+        r"""Look up the embeddings of inputs.
+
+        The lookup in memory never blocks on I/O, while the lookup on disk reads the
+        memory-mapped files, so the server looks up the memory tier on the event loop,
+        and the inputs missing from it on disk in another thread.
+
+        Parameters
+        ----------
+        inputs : List[Union[str, Sequence[int]]]
+            The texts or token ids to look up.
+        disk : bool
+            Whether to look up the on-disk tier too. When it is False and the cache has
+            an on-disk tier, the inputs missing from memory are not counted as misses,
+            as they are expected to be looked up on disk next.
+
+        Returns
+        -------
+        entries : List[Optional[CachedEmbedding]]
+            The cached embedding of each input, or None when it is not cached.
+        """
+        keys = [_embedding_key(self.model_id, inp) for inp in inputs]
+        with self._lock:
+            entries = [self._get_in_memory(key) for key in keys]
+        if disk:
+            with self._disk_lock:
+                for i, key in enumerate(keys):
+                    if entries[i] is None and self._disk is not None:
+                        entries[i] = self._disk.get(key)
+        with self._lock:
+            for key, entry in zip(keys, entries):
+                if entry is not None:
+                    self.num_hits += 1
+                    if disk:
+                        self._put_in_memory(key, entry)
+                elif disk or self.disk_path is None:
+                    self.num_misses += 1
+        return entries
+
+    def put(
+        self,
+        inputs: List[Union[str, Sequence[int]]],
+        vectors: np.ndarray,
+        num_tokens: Sequence[int],
+    ):
+        r"""Add the embeddings of inputs.
+
+        Parameters
+        ----------
+        inputs : List[Union[str, Sequence[int]]]
+            The texts or token ids.
+        vectors : np.ndarray
+            The embedding vector of each input, in shape ``(len(inputs), dim)``.
+        num_tokens : Sequence[int]
+            The number of tokens of each input.
+        """
+        vectors = np.asarray(vectors, dtype="float32")
+        keys = [_embedding_key(self.model_id, inp) for inp in inputs]
+        with self._lock:
+            for key, vector, count in zip(keys, vectors, num_tokens):
+                self._put_in_memory(key, CachedEmbedding(np.array(vector), int(count)))
+        if self.disk_path is None:
+            return
+        with self._disk_lock:
+            for key, vector, count in zip(keys, vectors, num_tokens):
+                if self._disk is None or self._disk.dim != len(vector):
+                    self._disk = _DiskTier(self.disk_path, self.disk_capacity_bytes, len(vector))
+                self._disk.put(key, vector, int(count))
+
+    def flush(self):
+        r"""Write the on-disk tier back to the files."""
+        with self._disk_lock:
+            if self._disk is not None:
+                self._disk.flush()
+
+    def hit_rate(self) -> float:
+        r"""The fraction of the looked up inputs that are found in the cache."""
+        num_lookups = self.num_hits + self.num_misses
+        return self.num_hits / num_lookups if num_lookups else 0.0
+
+    def _get_in_memory(self, key: bytes) -> Optional[CachedEmbedding]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _put_in_memory(self, key: bytes, entry: CachedEmbedding):
+        if entry.vector.nbytes > self.capacity_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._num_bytes -= old.vector.nbytes
+        self._entries[key] = entry
+        self._num_bytes += entry.vector.nbytes
+        while self._num_bytes > self.capacity_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._num_bytes -= evicted.vector.nbytes
+
+
+@dataclass
+class CachedCompletion:
+    r"""The outputs of a finished generation request.
+
+    Parameters
+    ----------
+    deltas : List[List[str]]
+        The streamed text pieces of every sample, so that a streamed response can be
+        replayed chunk by chunk.
+    usage : Dict[str, int]
+        The usage of the request.
+    finish_reasons : List[str]
+        Why every sample stopped, ``"stop"`` or ``"length"``.
+    """
+
+    deltas: List[List[str]] = field(default_factory=list)
+    usage: Dict[str, int] = field(default_factory=dict)
+    finish_reasons: List[str] = field(default_factory=list)
+
+    @property
+    def outputs(self) -> List[str]:
+        r"""The full output text of every sample."""
+        return ["".join(deltas) for deltas in self.deltas]
+
+
+def completion_key(model_id: str, generation_config: Dict[str, Any], request: Any) -> bytes:
+    r"""The key of a generation request.
+
+    Parameters
+    ----------
+    model_id : str
+        The id of the model.
+    generation_config : Dict[str, Any]
+        The configuration the outputs depend on, such as the sampling parameters and the
+        conversation template.
+    request : Any
+        The JSON-serializable content of the request, such as the messages and the number
+        of samples.
+    """
+    payload = json.dumps([model_id, generation_config, request], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).digest()
+
+
+class CompletionCache:
+    r"""An exact-match LRU cache of generation outputs.
+
+    A request first calls :func:`lookup`. On a miss, the caller becomes the leader of
+    the key, computes the outputs and must call :func:`end` with them, or with None
+    when it fails. Identical requests arriving meanwhile wait for the leader instead of
+    running the model, and one of them takes over if the leader fails. It is used on
+    the asyncio event loop thread only.
+
+    Parameters
+    ----------
+    capacity : int
+        The maximum number of cached requests.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity <= 0:
+            raise ValueError(f"`capacity` is expected to be positive, while it is {capacity}")
+        self.capacity = capacity
+        self.num_hits = 0
+        self.num_misses = 0
+        self._entries: "collections.OrderedDict[bytes, CachedCompletion]" = (
+            collections.OrderedDict()
+        )
+        self._in_flight: Dict[bytes, asyncio.Future] = {}
+
+    async def lookup(self, key: bytes) -> Optional[CachedCompletion]:
+        r"""Get the outputs of a request, waiting for an identical request in flight.
+
+        Parameters
+        ----------
+        key : bytes
+            The key of the request, see :func:`completion_key`.
+
+        Returns
+        -------
+        completion : Optional[CachedCompletion]
+            The outputs, or None when the caller has to compute them and call :func:`end`.
+        """
+        while True:
+            completion = self._entries.get(key)
+            if completion is not None:
+                self._entries.move_to_end(key)
+                self.num_hits += 1
+                return completion
+            future = self._in_flight.get(key)
+            if future is None:
+                self._in_flight[key] = asyncio.get_event_loop().create_future()
+                self.num_misses += 1
+                return None
+            # the waiter may be cancelled, while the leader's future must stay intact
+            completion = await asyncio.shield(future)
+            if completion is not None:
+                self.num_hits += 1
+                return completion
+
+    def end(self, key: bytes, completion: Optional[CachedCompletion]):
+        r"""Finish computing a request after a miss of :func:`lookup`.
+
+        Parameters
+        ----------
+        key : bytes
+            The key of the request.
+        completion : Optional[CachedCompletion]
+            The outputs, or None when the request failed or was cancelled.
+        """
+        if completion is not None:
+            self._entries[key] = completion
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        future = self._in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(completion)
+
+    def hit_rate(self) -> float:
+        r"""The fraction of the looked up requests that are found in the cache."""
+        num_lookups = self.num_hits + self.num_misses
+        return self.num_hits / num_lookups if num_lookups else 0.0
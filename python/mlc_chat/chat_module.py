@@ -7,7 +7,7 @@ import os
 import sys
 from dataclasses import dataclass, fields, asdict
 from enum import Enum
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import tvm
 
@@ -129,9 +129,60 @@ class ChatConfig:
 
         For additional information on top-p sampling, please refer to this blog
         post: https://huggingface.co/blog/how-to-generate#top-p-nucleus-sampling.
+    top_k : Optional[int]
+        When positive, only the ``top_k`` most likely tokens are sampled from at
+        each step, together with the ``top_p`` restriction. The default value is
+        ``0``, which keeps the whole vocabulary.
     mean_gen_len : Optional[int]
     max_gen_len : Optional[int]
     shift_fill_factor : Optional[float]
+    attention_sink_size : Optional[int]
+        When positive, and the model library is built with ``--attention-sink``,
+        the context window shifts by keeping the KV cache of the first
+        ``attention_sink_size`` tokens, the attention sinks, and of the most recent
+        tokens, and evicting the tokens in between, instead of prefilling the
+        history again. The output is then no longer cut at the window size, so a
+        long chat never stalls on a full prefill. A few sink tokens, e.g. ``4``,
+        are enough to keep the generation stable. The default value is ``0``,
+        which disables it.
+    prefill_chunk_size : Optional[int]
+        When positive, the prompt is prefilled in chunks of at most this many
+        tokens, each attending to the KV cache of the previous chunks, which bounds
+        the peak activation memory of long prompts. The REST server also runs the
+        decode steps of the other requests between the chunks. The default value
+        is ``0``, which prefills the whole prompt at once.
+    pipeline_decode : Optional[bool]
+        Whether to enqueue the forward pass of each output token as soon as it is
+        sampled, so that the device runs it while the host detokenizes the token and
+        checks for the stop string. A stop string found late drops the forward pass
+        from the KV cache. It applies to the KV cache of a single sequence. The
+        default value is ``False``.
+    max_batch_size : Optional[int]
+        The maximum number of sequences that are decoded together in one batch when
+        the model library provides batched functions. The default value is ``4``.
+    kv_cache_capacity : Optional[int]
+        The total number of tokens held by the paged KV cache shared by the batched
+        sequences. Each sequence only takes the blocks it needs, so a capacity smaller
+        than ``max_batch_size`` times the window size can serve ``max_batch_size``
+        sequences when they are short. The default value is ``max_batch_size``
+        times the maximum window size.
+    prefix_cache_capacity : Optional[int]
+        The number of prompt tokens kept in the prefix cache of the batched
+        sequences. A new sequence whose prompt starts with a cached prompt, such as
+        a shared system prompt, reuses its KV cache and only prefills the rest of
+        the prompt. The cached prompts are evicted in least recently used order.
+        The default value is the maximum window size, and ``0`` disables it.
+    prompt_lookup_num_tokens : Optional[int]
+        When positive, each decode step drafts up to this many tokens by looking
+        up the latest n-gram of the output in the prompt and the chat history, and
+        verifies them in one forward pass. It speeds up decoding when the output
+        copies from the input, e.g. summarization and code editing, and does not
+        change the output distribution. It requires the model library to provide
+        the ``verify`` function. The default value is ``0``, which disables it.
+    draft_num_tokens : Optional[int]
+        The number of tokens proposed by the draft model at each decode step, when
+        :class:`mlc_chat.ChatModule` is created with a ``draft_model``. The default
+        value is ``4``.
     tokenizer_files : Optional[List[str]]
         List of tokenizer files of the model.
     conv_config : Optional[ConvConfig]
@@ -150,9 +201,18 @@ class ChatConfig:
     temperature: Optional[float] = None
     repetition_penalty: Optional[float] = None
     top_p: Optional[float] = None
+    top_k: Optional[int] = None
     mean_gen_len: Optional[int] = None
     max_gen_len: Optional[int] = None
     shift_fill_factor: Optional[float] = None
+    attention_sink_size: Optional[int] = None
+    prefill_chunk_size: Optional[int] = None
+    pipeline_decode: Optional[bool] = None
+    max_batch_size: Optional[int] = None
+    kv_cache_capacity: Optional[int] = None
+    prefix_cache_capacity: Optional[int] = None
+    prompt_lookup_num_tokens: Optional[int] = None
+    draft_num_tokens: Optional[int] = None
     tokenizer_files: Optional[List[str]] = None
     conv_config: Optional[ConvConfig] = None
     model_category: Optional[str] = None
@@ -435,6 +495,11 @@ def _convert_chat_config_to_json_str(chat_config: Optional[ChatConfig], conv_tem
     return json.dumps(chat_dict)
 
 
+def _convert_embedding_inputs(inputs):
+    # token ids are passed to the chat module as shape tuples
+    return [inp if isinstance(inp, str) else tvm.runtime.ShapeTuple(inp) for inp in inputs]
+
+
 def _detect_local_device(device_id: int = 0):
     """Automatically detect the local device if user does not specify.
 
@@ -518,6 +583,18 @@ class ChatModule:
         The full path to the model library file to use (e.g. a ``.so`` file).
         If unspecified, we will use the provided ``model`` to search over
         possible paths.
+
+    draft_model : Optional[str]
+        A small model that shares the tokenizer of ``model``, given in the same
+        form as ``model``. When specified, each decode step lets the draft model
+        propose ``draft_num_tokens`` tokens, which ``model`` verifies in one
+        forward pass. The output follows the same distribution as decoding
+        without the draft model. It requires the model library of ``model`` to
+        provide the ``verify`` function.
+
+    draft_lib_path : Optional[str]
+        The full path to the model library file of ``draft_model``. If unspecified,
+        we will use the provided ``draft_model`` to search over possible paths.
     """
 
     def __init__(
@@ -526,6 +603,8 @@ class ChatModule:
         device: str = "auto",
         chat_config: Optional[ChatConfig] = None,
         lib_path: Optional[str] = None,
+        draft_model: Optional[str] = None,
+        draft_lib_path: Optional[str] = None,
     ):
         device_err_msg = (
             f"Invalid device name: {device}. Please enter the device in the form "
@@ -569,7 +648,13 @@ class ChatModule:
         self._reload_func = chat_mod["reload"]
         self._unload_func = chat_mod["unload"]
         self._prefill_func = chat_mod["prefill"]
+        self._prefill_fork_func = chat_mod["prefill_fork"]
+        self._begin_prefill_func = chat_mod["begin_prefill"]
+        self._prefill_chunk_func = chat_mod["prefill_chunk"]
         self._embed_func = chat_mod["embed"]
+        self._embed_batch_func = chat_mod["embed_batch"]
+        self._embed_pooled_func = chat_mod["embed_pooled"]
+        self._tokenize_func = chat_mod["tokenize"]
         self._prefill_with_embed_func = chat_mod["prefill_with_embed"]
         self._decode_func = chat_mod["decode"]
         self._raw_generate_func = chat_mod["raw_generate"]
@@ -577,6 +662,9 @@ class ChatModule:
         self._load_json_override_func = chat_mod["load_json_override"]
         self._stopped_func = chat_mod["stopped"]
         self._get_message_func = chat_mod["get_message"]
+        self._get_message_delta_func = chat_mod["get_message_delta"]
+        self._get_output_logprob_func = chat_mod["get_output_logprob"]
+        self._get_sequence_stats_json_func = chat_mod["get_sequence_stats_json"]
         self._runtime_stats_text_func = chat_mod["runtime_stats_text"]
         self._reset_runtime_stats_func = chat_mod["reset_runtime_stats"]
         self._get_config_json_func = chat_mod["get_config_json"]
@@ -584,6 +672,12 @@ class ChatModule:
         self._evaluate_func = chat_mod["evaluate"]
         self._get_role0_func = chat_mod["get_role0"]
         self._get_role1_func = chat_mod["get_role1"]
+        self._add_sequence_func = chat_mod["add_sequence"]
+        self._switch_sequence_func = chat_mod["switch_sequence"]
+        self._remove_sequence_func = chat_mod["remove_sequence"]
+        self._load_conversation_history_func = chat_mod["load_conversation_history"]
+        self._batch_decode_func = chat_mod["batch_decode"]
+        self._load_draft_model_func = chat_mod["load_draft_model"]
 
         # 3. Look up model_path
         self.model_path, self.config_file_path = _get_model_path(model)
@@ -602,6 +696,20 @@ class ChatModule:
         )
         self._reload(self.lib_path, self.model_path, user_chat_config_json_str)
 
+        # 7. Load the draft model for speculative decoding
+        if draft_model is not None:
+            draft_model_path, draft_config_file_path = _get_model_path(draft_model)
+            draft_chat_config = _get_chat_config(draft_config_file_path, None)
+            draft_lib_path = _get_lib_module_path(
+                draft_model,
+                draft_model_path,
+                draft_chat_config,
+                draft_lib_path,
+                device_name,
+                draft_config_file_path,
+            )
+            self._load_draft_model(draft_lib_path, draft_model_path)
+
     def generate(self, prompt: str, progress_callback=None) -> str:
         r"""A high-level method that returns the full response from the chat module given a user prompt.
         User can optionally specify which callback method to use upon receiving the response. By default,
@@ -783,6 +891,18 @@ class ChatModule:
         """
         self._reload_func(lib, model_path, app_config_json)
 
+    def _load_draft_model(self, lib: str, model_path: str):
+        r"""Load the draft model used for speculative decoding.
+
+        Parameters
+        ----------
+        lib : str
+            The library path of the draft model.
+        model_path : str
+            The model path of the draft model.
+        """
+        self._load_draft_model_func(lib, model_path)
+
     def _unload(self):
         r"""Unload the chat module and clear memory of all loaded models."""
         self._unload_func()
@@ -807,6 +927,59 @@ class ChatModule:
         """
         self._prefill_func(input, decode_next_token, place_in_prompt.value)
 
+    def _prefill_fork(self, input: str, fork_seq_ids: List[int]):
+        r"""Run prefill stage for a given input on the active sequence, and fork the
+        sequence into new ones that share the KV cache of the prompt. The active
+        sequence and every fork sample their own first output token, and can be
+        decoded further with :func:`_batch_decode`. It requires the model to provide
+        batched functions.
+
+        Parameters
+        ----------
+        input : str
+            The user input string.
+        fork_seq_ids : List[int]
+            The ids of the new sequences, which must not exist yet.
+        """
+        self._prefill_fork_func(input, *fork_seq_ids)
+
+    def _begin_prefill(self, input: str) -> int:
+        r"""Start the prefill stage for a given input on the active sequence, whose
+        prompt is then prefilled chunk by chunk with :func:`_prefill_chunk`, so that
+        other sequences can be decoded between the chunks.
+
+        Parameters
+        ----------
+        input : str
+            The user input string.
+
+        Returns
+        -------
+        num_pending : int
+            The number of prompt tokens to prefill.
+        """
+        return self._begin_prefill_func(input)
+
+    def _prefill_chunk(self, max_tokens: int, fork_seq_ids: Optional[List[int]] = None) -> int:
+        r"""Prefill the next chunk of the prompt started by :func:`_begin_prefill` on
+        the active sequence. After the last chunk, the sequence is forked as in
+        :func:`_prefill_fork`, and every sequence samples its first output token.
+
+        Parameters
+        ----------
+        max_tokens : int
+            The maximum number of prompt tokens prefilled.
+        fork_seq_ids : Optional[List[int]]
+            The ids of the new sequences forked after the last chunk, which must not
+            exist yet.
+
+        Returns
+        -------
+        num_pending : int
+            The number of prompt tokens still to prefill, ``0`` after the last chunk.
+        """
+        return self._prefill_chunk_func(max_tokens, *(fork_seq_ids or []))
+
     def _embed(self, input: str, place_in_prompt: PlaceInPrompt = PlaceInPrompt.All):
         r"""A more fine-grained embedding API. Given a text input, get the embedding of the tokenized prompt.
         User can decide where to place the input in the prompt. This functionality usually aids the subsequent
@@ -826,6 +999,73 @@ class ChatModule:
         """
         return self._embed_func(input, place_in_prompt.value)
 
+    def _tokenize(self, text: str) -> List[int]:
+        r"""Tokenize a text with the tokenizer of the model, without the prompt of
+        the conversation template around it.
+
+        Parameters
+        ----------
+        text : str
+            The text to tokenize.
+
+        Returns
+        -------
+        token_ids : List[int]
+            The token ids of the text.
+        """
+        return [int(token_id) for token_id in self._tokenize_func(text)]
+
+    def _embed_batch(
+        self, inputs: List[Union[str, List[int]]]
+    ) -> Tuple[tvm.runtime.NDArray, List[int]]:
+        r"""Get the embeddings of a batch of texts in one call, each tokenized as a
+        standalone prompt like :func:`embed_text`. Unlike :func:`embed_text`, the chat
+        is left untouched, so there is no need to reset it.
+
+        Parameters
+        ----------
+        inputs : List[Union[str, List[int]]]
+            The input strings, or their token ids given by :func:`_tokenize`.
+
+        Returns
+        -------
+        embeddings : tvm.runtime.NDArray
+            The embeddings right-padded to the longest input, in shape
+            ``(len(inputs), max_num_tokens, hidden_size)``.
+        num_tokens : List[int]
+            The number of valid tokens of each input.
+        """
+        embeddings, num_tokens = self._embed_batch_func(*_convert_embedding_inputs(inputs))
+        return embeddings, [int(n) for n in num_tokens]
+
+    def _embed_pooled(
+        self,
+        inputs: List[Union[str, List[int]]],
+        last_token: bool = False,
+        normalize: bool = True,
+    ) -> Optional[tvm.runtime.NDArray]:
+        r"""Get one embedding vector for each of a batch of texts, pooled on device
+        by the compiled ``embed_pooled`` function, so that only the pooled vectors are
+        copied to the host. The texts are tokenized like :func:`_embed_batch`.
+
+        Parameters
+        ----------
+        inputs : List[Union[str, List[int]]]
+            The input strings, or their token ids given by :func:`_tokenize`.
+        last_token : bool
+            Whether to take the embedding of the last token of each text, instead of
+            the mean over all the tokens.
+        normalize : bool
+            Whether to L2-normalize the pooled vectors.
+
+        Returns
+        -------
+        embeddings : Optional[tvm.runtime.NDArray]
+            The float32 vectors in shape ``(len(inputs), hidden_size)``, or None when
+            the model library does not provide ``embed_pooled``.
+        """
+        return self._embed_pooled_func(last_token, normalize, *_convert_embedding_inputs(inputs))
+
     def _prefill_with_embed(self, embedding: tvm.runtime.NDArray, decode_next_token: bool = True):
         r"""Given an embedding, run the prefill stage and optionally decode the first output token.
 
@@ -844,6 +1084,33 @@ class ChatModule:
         """
         self._decode_func()
 
+    def _get_output_logprob(self) -> float:
+        r"""Get the sum of the log-probabilities of the output tokens of the active
+        sequence, under the distributions scaled by the temperature. It is ``0`` for
+        greedy decoding, and NaN when the tokens are sampled on device by a model
+        library built before the sampling function returned the log-probabilities.
+
+        Returns
+        -------
+        logprob : float
+            The cumulative log-probability of the output.
+        """
+        return self._get_output_logprob_func()
+
+    def _get_sequence_stats(self) -> Dict[str, Any]:
+        r"""Get the usage and timing of the current round of the active sequence.
+
+        Returns
+        -------
+        stats : Dict[str, Any]
+            ``"prompt_tokens"``, the number of tokens in the KV cache after the prefill,
+            the chat history included, ``"completion_tokens"``, the number of output
+            tokens, ``"sample_time"``, the seconds spent on sampling the output, and
+            ``"finish_reason"``, ``"length"`` when the output reaches the length limit,
+            or ``"stop"`` otherwise.
+        """
+        return json.loads(self._get_sequence_stats_json_func())
+
     def _stopped(self) -> bool:
         r"""Check if the stop condition is met for the current round.
 
@@ -867,6 +1134,21 @@ class ChatModule:
         """
         return self._get_message_func()
 
+    def _get_message_delta(self) -> str:
+        r"""Get the text appended to the output message since the last call.
+
+        Returns
+        -------
+        delta : str
+
+        Note
+        ----
+        The deltas of a round add up to the message returned by
+        :func:`_get_message` when the round stops, so streaming callers do not
+        need to diff the full messages.
+        """
+        return self._get_message_delta_func()
+
     def _get_config_json(self):
         r"""Get the configuration of the chat module in a single json string.
 
@@ -917,3 +1199,63 @@ class ChatModule:
     def _process_system_prompts(self):
         r"""Pre-process by prefilling the system prompts, running prior to any user input."""
         self._process_system_prompts_func()
+
+    def _add_sequence(self, seq_id: int):
+        r"""Add a new sequence with a fresh conversation and its own KV cache.
+        The new sequence is not activated until :func:`_switch_sequence` is called.
+
+        Parameters
+        ----------
+        seq_id : int
+            The id of the new sequence. Sequence ``0`` is created on reload and
+            always exists.
+        """
+        self._add_sequence_func(seq_id)
+
+    def _switch_sequence(self, seq_id: int):
+        r"""Make the given sequence the active one. All the chat functions such as
+        :func:`_prefill`, :func:`_decode` and :func:`_get_message` act on the active
+        sequence, while the state of the other sequences is kept untouched.
+
+        Parameters
+        ----------
+        seq_id : int
+            The id of the sequence to activate.
+        """
+        self._switch_sequence_func(seq_id)
+
+    def _load_conversation_history(self, history: List[Tuple[str, str]]):
+        r"""Fill the conversation of the active sequence with a chat history, which
+        gets prefilled together with the next :func:`_prefill`. It must be called
+        before the first prefill of the sequence.
+
+        Parameters
+        ----------
+        history : List[Tuple[str, str]]
+            The ``(role, content)`` pairs of the history, where role is one of
+            ``"system"``, ``"user"`` and ``"assistant"``. A system message replaces
+            the system prompt of the conversation template.
+        """
+        self._load_conversation_history_func(json.dumps([list(item) for item in history]))
+
+    def _remove_sequence(self, seq_id: int):
+        r"""Remove an inactive sequence and release its KV cache.
+
+        Parameters
+        ----------
+        seq_id : int
+            The id of the sequence to remove.
+        """
+        self._remove_sequence_func(seq_id)
+
+    def _batch_decode(self, seq_ids: List[int]):
+        r"""Decode the next token of each of the given sequences. When the model
+        provides batched functions, the sequences are decoded together in a single
+        forward pass. The active sequence stays unchanged.
+
+        Parameters
+        ----------
+        seq_ids : List[int]
+            The ids of the sequences to decode.
+        """
+        self._batch_decode_func(*seq_ids)
@@ -3,8 +3,12 @@ from __future__ import annotations
 from langchain.embeddings import OpenAIEmbeddings
 from langchain.embeddings.openai import embed_with_retry, async_embed_with_retry
 
+import asyncio
+import base64
 import logging
 from typing import (
+    Any,
+    Dict,
     List,
     Optional,
     Sequence,
@@ -16,47 +20,83 @@ import numpy as np
 logger = logging.getLogger(__name__)
 
 
+# The embedding of the empty text of each (API base, model), fetched once per process.
+_EMPTY_EMBEDDINGS: Dict[Tuple[str, str], List[float]] = {}
+
+
 class MLCEmbeddings(OpenAIEmbeddings):
-    def _chunk_tokens(self, texts: Sequence[str]) -> Tuple[List[List], List[int]]:
-        """Tokenize and chunk texts to fit in the model's context window."""
+    embedding_encoding_format: str = "base64"
+    """The format of the vectors in the responses of the server, one of ``"float"``,
+    ``"base64"`` and ``"base64_float16"``. The base64 formats carry the raw float32 /
+    float16 bytes, which are much smaller than lists of floats in JSON."""
+
+    @property
+    def _embedding_params(self) -> Dict[str, Any]:
+        return {**self._invocation_params, "encoding_format": self.embedding_encoding_format}
+
+    def _decode_embeddings(self, response: Any) -> List[List[float]]:
+        embeddings = []
+        for r in response["data"]:
+            embedding = r["embedding"]
+            if isinstance(embedding, str):
+                dtype = "<f2" if self.embedding_encoding_format == "base64_float16" else "<f4"
+                embedding = np.frombuffer(base64.b64decode(embedding), dtype=dtype)
+                embedding = embedding.astype("float32").tolist()
+            embeddings.append(embedding)
+        return embeddings
+
+    def _tokenize_request(self, texts: Sequence[str]) -> Tuple[str, Dict[str, Any], Dict]:
+        url = f"{self.openai_api_base.rstrip('/')}/tokenize"
+        headers = {}
+        if self.openai_api_key:
+            headers["Authorization"] = f"Bearer {self.openai_api_key}"
+        return url, headers, {"model": self.model, "input": list(texts)}
+
+    def _split_chunks(self, token_lists: List[List[int]]) -> Tuple[List[List[int]], List[int]]:
         if not self.embedding_ctx_length:
             raise ValueError(
                 "embedding_ctx_length must be defined to use _get_len_safe_embeddings."
             )
-
-        try:
-            import tiktoken
-        except ImportError:
-            raise ImportError(
-                "Could not import tiktoken python package. "
-                "This is needed in order to for OpenAIEmbeddings. "
-                "Please install it with `pip install tiktoken`."
-            )
-
         tokens = []
         indices = []
-        model_name = self.tiktoken_model_name or self.model
-        try:
-            encoding = tiktoken.encoding_for_model(model_name)
-        except KeyError:
-            logger.warning("Warning: model not found. Using cl100k_base encoding.")
-            model = "cl100k_base"
-            encoding = tiktoken.get_encoding(model)
-        for i, text in enumerate(texts):
-            if self.model.endswith("001"):
-                # See: https://github.com/openai/openai-python/issues/418#issuecomment-1525939500
-                # replace newlines, which can negatively affect performance.
-                text = text.replace("\n", " ")
-            token = encoding.encode(
-                text,
-                allowed_special=self.allowed_special,
-                disallowed_special=self.disallowed_special,
-            )
+        for i, token in enumerate(token_lists):
             for j in range(0, len(token), self.embedding_ctx_length):
                 tokens.append(token[j : j + self.embedding_ctx_length])
                 indices.append(i)
         return tokens, indices
 
+    def _chunk_tokens(self, texts: Sequence[str]) -> Tuple[List[List], List[int]]:
+        """Tokenize texts with the tokenizer of the served model in one request, and
+        chunk them to fit in the model's context window."""
+        import requests
+
+        url, headers, payload = self._tokenize_request(texts)
+        response = requests.post(url, headers=headers, json=payload, timeout=self.request_timeout)
+        response.raise_for_status()
+        return self._split_chunks(response.json()["tokens"])
+
+    def _aiohttp_timeout(self) -> Any:
+        """The timeout of the aiohttp session, after request_timeout like the sync path."""
+        import aiohttp
+
+        if self.request_timeout is None:
+            return aiohttp.ClientTimeout(total=5 * 60)
+        if isinstance(self.request_timeout, tuple):
+            # the (connect, read) timeouts taken by requests
+            connect, read = self.request_timeout
+            return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        return aiohttp.ClientTimeout(total=self.request_timeout)
+
+    async def _achunk_tokens(self, texts: Sequence[str]) -> Tuple[List[List], List[int]]:
+        import aiohttp
+
+        url, headers, payload = self._tokenize_request(texts)
+        async with aiohttp.ClientSession(timeout=self._aiohttp_timeout()) as session:
+            async with session.post(url, headers=headers, json=payload) as response:
+                response.raise_for_status()
+                token_lists = (await response.json())["tokens"]
+        return self._split_chunks(token_lists)
+
     def _batch_embed(
         self, inputs: Sequence, *, chunk_size: Optional[int] = None
     ) -> List[List[float]]:
@@ -71,59 +111,72 @@ class MLCEmbeddings(OpenAIEmbeddings):
             except ImportError:
                 pass
 
+        # every request carries a whole chunk, which the server embeds in batches
         for i in _iter:
             response = embed_with_retry(
                 self,
-                input=inputs[i : i + _chunk_size],
-                **self._invocation_params,
+                input=list(inputs[i : i + _chunk_size]),
+                **self._embedding_params,
             )
-            batched_embeddings.extend(r["embedding"] for r in response["data"])
+            batched_embeddings.extend(self._decode_embeddings(response))
         return batched_embeddings
 
     async def _abatch_embed(
         self, inputs: Sequence, *, chunk_size: Optional[int] = None
     ) -> List[List[float]]:
-        batched_embeddings: List[List[float]] = []
+        # the requests of all the chunks are in flight together
         _chunk_size = chunk_size or self.chunk_size
-        _iter = range(0, len(inputs), _chunk_size)
-        if self.show_progress_bar:
-            try:
-                from tqdm.auto import tqdm
-
-                _iter = tqdm(_iter)
-            except ImportError:
-                pass
+        responses = await asyncio.gather(
+            *[
+                async_embed_with_retry(
+                    self,
+                    input=list(inputs[i : i + _chunk_size]),
+                    **self._embedding_params,
+                )
+                for i in range(0, len(inputs), _chunk_size)
+            ]
+        )
+        return [
+            embedding for response in responses for embedding in self._decode_embeddings(response)
+        ]
+
+    def _get_empty_embedding(self) -> List[float]:
+        key = (self.openai_api_base, self.model)
+        if key not in _EMPTY_EMBEDDINGS:
+            response = embed_with_retry(
+                self,
+                input="",
+                **self._embedding_params,
+            )
+            _EMPTY_EMBEDDINGS[key] = self._decode_embeddings(response)[0]
+        return _EMPTY_EMBEDDINGS[key]
 
-        for i in _iter:
+    async def _aget_empty_embedding(self) -> List[float]:
+        key = (self.openai_api_base, self.model)
+        if key not in _EMPTY_EMBEDDINGS:
             response = await async_embed_with_retry(
                 self,
-                input=inputs[i : i + _chunk_size],
-                **self._invocation_params,
+                input="",
+                **self._embedding_params,
             )
-            batched_embeddings.extend(r["embedding"] for r in response["data"])
-        return batched_embeddings
-
-    # please refer to
-    # https://github.com/openai/openai-cookbook/blob/main/examples/Embedding_long_inputs.ipynb
-    def _get_len_safe_embeddings(
-        self, texts: List[str], *, engine: str, chunk_size: Optional[int] = None
+            _EMPTY_EMBEDDINGS[key] = self._decode_embeddings(response)[0]
+        return _EMPTY_EMBEDDINGS[key]
+
+    def _average_chunks(
+        self,
+        num_texts: int,
+        tokens: List[List[int]],
+        indices: List[int],
+        batched_embeddings: List[List[float]],
+        empty_average: Optional[List[float]],
     ) -> List[List[float]]:
-        tokens, indices = self._chunk_tokens(texts)
-        batched_embeddings = self._batch_embed(tokens, chunk_size=chunk_size)
-        results: List[List[List[float]]] = [[] for _ in range(len(texts))]
-        num_tokens_in_batch: List[List[int]] = [[] for _ in range(len(texts))]
+        results: List[List[List[float]]] = [[] for _ in range(num_texts)]
+        num_tokens_in_batch: List[List[int]] = [[] for _ in range(num_texts)]
         for idx, tokens_i, batched_emb in zip(indices, tokens, batched_embeddings):
             results[idx].append(batched_emb)
             num_tokens_in_batch[idx].append(len(tokens_i))
 
         embeddings = []
-        empty_average = embed_with_retry(
-            self,
-            input="",
-            **self._invocation_params,
-        )[
-            "data"
-        ][0]["embedding"]
         for _result, num_tokens in zip(results, num_tokens_in_batch):
             if len(_result) == 0:
                 average = empty_average
@@ -136,35 +189,36 @@ class MLCEmbeddings(OpenAIEmbeddings):
 
     # please refer to
     # https://github.com/openai/openai-cookbook/blob/main/examples/Embedding_long_inputs.ipynb
-    async def _aget_len_safe_embeddings(
+    def _get_len_safe_embeddings(
         self, texts: List[str], *, engine: str, chunk_size: Optional[int] = None
     ) -> List[List[float]]:
         tokens, indices = self._chunk_tokens(texts)
-        batched_embeddings = await self._abatch_embed(tokens, chunk_size=chunk_size)
-
-        results: List[List[List[float]]] = [[] for _ in range(len(texts))]
-        num_tokens_in_batch: List[List[int]] = [[] for _ in range(len(texts))]
-        for idx, tokens_i, batched_emb in zip(indices, tokens, batched_embeddings):
-            results[idx].append(batched_emb)
-            num_tokens_in_batch[idx].append(len(tokens_i))
+        batched_embeddings = self._batch_embed(tokens, chunk_size=chunk_size)
+        # the empty text is only embedded when some text has no tokens
+        empty_average = None
+        if len(set(indices)) < len(texts):
+            empty_average = self._get_empty_embedding()
+        return self._average_chunks(
+            len(texts), tokens, indices, batched_embeddings, empty_average
+        )
 
-        embeddings = []
-        empty_average = (
-            await async_embed_with_retry(
-                self,
-                input="",
-                **self._invocation_params,
+    # please refer to
+    # https://github.com/openai/openai-cookbook/blob/main/examples/Embedding_long_inputs.ipynb
+    async def _aget_len_safe_embeddings(
+        self, texts: List[str], *, engine: str, chunk_size: Optional[int] = None
+    ) -> List[List[float]]:
+        tokens, indices = await self._achunk_tokens(texts)
+        if len(set(indices)) < len(texts):
+            batched_embeddings, empty_average = await asyncio.gather(
+                self._abatch_embed(tokens, chunk_size=chunk_size),
+                self._aget_empty_embedding(),
             )
-        )["data"][0]["embedding"]
-        for _result, num_tokens in zip(results, num_tokens_in_batch):
-            if len(_result) == 0:
-                average = empty_average
-            else:
-                average = np.average(_result, axis=0, weights=num_tokens)
-            normalized = (average / np.linalg.norm(average)).tolist()
-            embeddings.append(normalized)
-
-        return embeddings
+        else:
+            batched_embeddings = await self._abatch_embed(tokens, chunk_size=chunk_size)
+            empty_average = None
+        return self._average_chunks(
+            len(texts), tokens, indices, batched_embeddings, empty_average
+        )
 
     def embed_documents(
         self, texts: List[str], chunk_size: Optional[int] = None
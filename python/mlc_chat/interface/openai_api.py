@@ -17,10 +17,16 @@ class ChatCompletionRequest(BaseModel):
     model: str
     messages: list[ChatMessage]
     stream: bool | None = False
+    n: Optional[int] = 1
+    # the number of samples generated, of which the n most likely ones are returned
+    best_of: Optional[int] = None
+    # the streamed text pieces are merged into one chunk until there are
+    # stream_chunk_tokens of them, or stream_chunk_ms milliseconds passed since the first one
+    stream_chunk_tokens: int = Field(default=1, ge=1)
+    stream_chunk_ms: float = Field(default=0.0, ge=0.0)
     # TODO: Implement support for the following fields
     # temperature: Optional[float] = 1.0
     # top_p: Optional[float] = 1.0
-    # n: Optional[int] = 1
     # stop: Optional[Union[str, List[str]]] = None
     # max_tokens: Optional[int] = None
     # presence_penalty: Optional[float] = 0.0
@@ -63,6 +69,8 @@ class ChatCompletionStreamResponse(BaseModel):
 class CompletionRequest(BaseModel):
     model: str
     prompt: str | list[str]
+    n: Optional[int] = 1
+    best_of: Optional[int] = None
 
 class CompletionResponseChoice(BaseModel):
     index: int
@@ -80,6 +88,9 @@ class CompletionResponse(BaseModel):
 class EmbeddingsRequest(BaseModel):
     model: Optional[str] = None
     input: Union[str, List[Any]]
+    # "float" for lists of numbers, or "base64" / "base64_float16" for the base64 of the
+    # little-endian float32 / float16 bytes of the vectors
+    encoding_format: Literal["float", "base64", "base64_float16"] = "float"
     user: Optional[str] = None
 
 class EmbeddingsResponse(BaseModel):
@@ -87,3 +98,12 @@ class EmbeddingsResponse(BaseModel):
     data: List[Dict[str, Any]]
     model: Optional[str] = None
     usage: UsageInfo
+
+class TokenizeRequest(BaseModel):
+    model: Optional[str] = None
+    input: Union[str, List[str]]
+
+class TokenizeResponse(BaseModel):
+    object: str = "list"
+    tokens: List[List[int]]
+    model: Optional[str] = None
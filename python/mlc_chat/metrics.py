@@ -0,0 +1,202 @@
+"""Per-request latency and usage metrics of the REST server.
+
+The metrics are kept as histograms and exported in the text exposition format of
+Prometheus, so that the monitoring system can compute percentiles over any window,
+e.g. ``histogram_quantile(0.99, rate(mlc_chat_time_to_first_token_seconds_bucket[5m]))``.
+"""
+import bisect
+import threading
+from typing import Dict, List, Optional, Sequence
+
+# The upper bounds of the buckets of the latency histograms, in seconds.
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0, 30.0, 60.0
+)
+# The upper bounds of the buckets of the token count histograms.
+TOKEN_BUCKETS = (1, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Histogram:
+    r"""A cumulative histogram in the Prometheus sense.
+
+    Parameters
+    ----------
+    name : str
+        The metric name.
+    documentation : str
+        The help text of the metric.
+    buckets : Sequence[float]
+        The increasing upper bounds of the buckets. The ``+Inf`` bucket is implicit.
+    """
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float]):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        # a value equal to an upper bound falls into that bucket, as `le` means <=
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.bucket_counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{_format_value(bound)}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {_format_value(self.sum)}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class Counter:
+    r"""A counter with one label.
+
+    Parameters
+    ----------
+    name : str
+        The metric name.
+    documentation : str
+        The help text of the metric.
+    label : str
+        The name of the label.
+    """
+
+    def __init__(self, name: str, documentation: str, label: str):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.values: Dict[str, int] = {}
+
+    def inc(self, label_value: str):
+        self.values[label_value] = self.values.get(label_value, 0) + 1
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for label_value, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {value}')
+        return lines
+
+
+class ServingMetrics:
+    r"""The metrics of the requests run by :class:`mlc_chat.scheduler.Scheduler`.
+
+    Requests are observed on the inference thread when they finish, and the metrics
+    are rendered on the event loop thread, so both are guarded by a lock. Every
+    sample of a request with several samples is observed as a request of its own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter(
+            "mlc_chat_requests_total",
+            "The number of finished requests by their status.",
+            "status",
+        )
+        self.queue_wait = Histogram(
+            "mlc_chat_queue_wait_seconds",
+            "The time from the arrival of a request to its admission.",
+            LATENCY_BUCKETS,
+        )
+        self.time_to_first_token = Histogram(
+            "mlc_chat_time_to_first_token_seconds",
+            "The time from the arrival of a request to its first output token.",
+            LATENCY_BUCKETS,
+        )
+        self.inter_token_latency = Histogram(
+            "mlc_chat_inter_token_latency_seconds",
+            "The time between two decode steps of a request.",
+            LATENCY_BUCKETS,
+        )
+        self.e2e_latency = Histogram(
+            "mlc_chat_e2e_request_latency_seconds",
+            "The time from the arrival of a request to its last output token.",
+            LATENCY_BUCKETS,
+        )
+        self.sample_time = Histogram(
+            "mlc_chat_sample_time_seconds",
+            "The time spent on sampling the output tokens of a request.",
+            LATENCY_BUCKETS,
+        )
+        self.prompt_tokens = Histogram(
+            "mlc_chat_prompt_tokens",
+            "The number of prompt tokens of a request, the chat history included.",
+            TOKEN_BUCKETS,
+        )
+        self.completion_tokens = Histogram(
+            "mlc_chat_completion_tokens",
+            "The number of output tokens of a request.",
+            TOKEN_BUCKETS,
+        )
+
+    def observe_request(
+        self,
+        status: str,
+        arrival_time: float,
+        admit_time: Optional[float] = None,
+        token_times: Sequence[float] = (),
+        usage: Optional[Dict] = None,
+    ):
+        r"""Record a finished request.
+
+        Parameters
+        ----------
+        status : str
+            How the request finished, e.g. ``"stop"``, ``"cancelled"`` or ``"error"``.
+        arrival_time : float
+            The ``time.perf_counter()`` when the request arrived.
+        admit_time : Optional[float]
+            The ``time.perf_counter()`` when the request was admitted, or None when it
+            left before admission.
+        token_times : Sequence[float]
+            The ``time.perf_counter()`` of every step producing output tokens.
+        usage : Optional[Dict]
+            The usage returned by :func:`mlc_chat.ChatModule._get_sequence_stats` when
+            the request stopped generating.
+        """
+        with self._lock:
+            self.requests.inc(status)
+            if admit_time is not None:
+                self.queue_wait.observe(admit_time - arrival_time)
+            if token_times:
+                self.time_to_first_token.observe(token_times[0] - arrival_time)
+                for prev, cur in zip(token_times[:-1], token_times[1:]):
+                    self.inter_token_latency.observe(cur - prev)
+                self.e2e_latency.observe(token_times[-1] - arrival_time)
+            if usage is not None:
+                self.prompt_tokens.observe(usage["prompt_tokens"])
+                self.completion_tokens.observe(usage["completion_tokens"])
+                self.sample_time.observe(usage["sample_time"])
+
+    def render(self) -> str:
+        r"""Render all the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            lines = self.requests.render()
+            for histogram in (
+                self.queue_wait,
+                self.time_to_first_token,
+                self.inter_token_latency,
+                self.e2e_latency,
+                self.sample_time,
+                self.prompt_tokens,
+                self.completion_tokens,
+            ):
+                lines.extend(histogram.render())
+        return "\n".join(lines) + "\n"
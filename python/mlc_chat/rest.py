@@ -1,24 +1,43 @@
 import argparse
 import asyncio
+import base64
 import os
+import json
+import math
 import subprocess
 import sys
+import time
 from contextlib import asynccontextmanager
 
 import uvicorn
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
-from dataclasses import dataclass, field, fields
-from typing import Optional
+from dataclasses import asdict, dataclass, field, fields
+from typing import AsyncIterator, List, Optional, Tuple
+
+import shortuuid
 
 from .base import set_global_random_seed
-from .chat_module import ChatModule
+from .cache import (
+    CachedCompletion,
+    CachedEmbedding,
+    CompletionCache,
+    EmbeddingCache,
+    completion_key,
+)
+from .chat_module import ChatConfig, ChatModule
 from .interface.openai_api import *
+from .scheduler import GenerationRequest, Scheduler, SchedulerFullError
 
 import numpy as np
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 @dataclass
 class RestAPIArgs:
     """RestAPIArgs is the dataclass that organizes the arguments used for starting a REST API server."""
@@ -91,6 +110,101 @@ class RestAPIArgs:
             )
         }
     )
+    max_num_sequences: int = field(
+        default=4,
+        metadata={
+            "help": (
+                """
+                The maximum number of completion requests that are decoded together.
+                Requests beyond this number wait in a queue. Every running request
+                holds its own KV cache, defaults to ``4``.
+                """
+            )
+        }
+    )
+    max_num_sessions: int = field(
+        default=4,
+        metadata={
+            "help": (
+                """
+                The maximum number of finished chats kept together with their KV cache,
+                so that a follow-up request of the chat only prefills its new message.
+                The least recently used chat is evicted when there are more, defaults
+                to ``4``.
+                """
+            )
+        }
+    )
+    max_num_waiting: int = field(
+        default=64,
+        metadata={
+            "help": (
+                """
+                The maximum number of completion requests waiting in the queue. Requests
+                beyond this number are rejected with HTTP status 503, defaults to ``64``.
+                """
+            )
+        }
+    )
+    prefill_chunk_size: int = field(
+        default=None,
+        metadata={
+            "help": (
+                """
+                The maximum number of prompt tokens prefilled in one scheduling step. Long
+                prompts are prefilled in chunks, between which the running requests keep
+                decoding, and the peak activation memory is bounded. By default, it is taken
+                from ``prefill_chunk_size`` of the chat config, where ``0`` prefills every
+                prompt at once.
+                """
+            )
+        }
+    )
+    embedding_cache_size: int = field(
+        default=256,
+        metadata={
+            "help": (
+                """
+                The size in MB of the in-memory cache of the vectors returned by
+                ``/v1/embeddings``, defaults to ``256``. Set it to ``0`` to disable the cache.
+                """
+            )
+        }
+    )
+    embedding_cache_dir: str = field(
+        default=None,
+        metadata={
+            "help": (
+                """
+                The directory of the on-disk tier of the embedding cache, which survives
+                restarts of the server. By default, there is no on-disk tier.
+                """
+            )
+        }
+    )
+    embedding_cache_disk_size: int = field(
+        default=1024,
+        metadata={
+            "help": (
+                """
+                The size in MB of the on-disk tier of the embedding cache, defaults to ``1024``.
+                """
+            )
+        }
+    )
+    completion_cache_size: int = field(
+        default=0,
+        metadata={
+            "help": (
+                """
+                The maximum number of responses cached for identical requests, which are
+                replayed instead of generated again, defaults to ``0`` that disables the cache.
+                Identical requests in flight are coalesced into one. The cache is only used
+                when the outputs are deterministic, i.e. when the temperature is ``0``.
+                """
+            )
+        }
+    )
 
 
 def convert_args_to_argparser() -> argparse.ArgumentParser:
@@ -111,6 +225,18 @@ def convert_args_to_argparser() -> argparse.ArgumentParser:
 
 session = {}
 
+# the maximum number of inputs of /v1/embeddings embedded in one call
+EMBEDDING_BATCH_SIZE = 32
+
+
+def json_dumps(obj) -> str:
+    """
+    Serializes the plain JSON content of a response, with orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -119,12 +245,42 @@ async def lifespan(app: FastAPI):
     chat_mod = ChatModule(
         model=ARGS.model,
         device=ARGS.device,
+        # the idle chat sessions keep their sequences in the batch
+        chat_config=ChatConfig(
+            max_batch_size=ARGS.max_num_sequences + ARGS.max_num_sessions,
+            prefill_chunk_size=ARGS.prefill_chunk_size,
+        ),
         lib_path=ARGS.lib_path
     )
     session["chat_mod"] = chat_mod
+    session["scheduler"] = Scheduler(
+        chat_mod,
+        max_num_sequences=ARGS.max_num_sequences,
+        max_num_sessions=ARGS.max_num_sessions,
+        max_num_waiting=ARGS.max_num_waiting,
+    )
+    model_id = chat_mod.chat_config.local_id or chat_mod.model_path
+    if ARGS.embedding_cache_size > 0:
+        session["embedding_cache"] = EmbeddingCache(
+            model_id=model_id,
+            capacity_bytes=ARGS.embedding_cache_size << 20,
+            disk_path=ARGS.embedding_cache_dir,
+            disk_capacity_bytes=ARGS.embedding_cache_disk_size << 20,
+        )
+    temperature = chat_mod.chat_config.temperature
+    if ARGS.completion_cache_size > 0 and temperature is not None and temperature < 1e-6:
+        session["completion_cache"] = CompletionCache(ARGS.completion_cache_size)
+        session["model_id"] = model_id
+        # the outputs also depend on the sampling parameters and the conversation template
+        session["generation_config"] = asdict(chat_mod.chat_config)
+    # the model runs on the inference thread of the scheduler, off the event loop
+    session["scheduler"].start()
 
     yield
 
+    session["scheduler"].stop()
+    if "embedding_cache" in session:
+        session["embedding_cache"].flush()
     session.clear()
 
 
@@ -142,25 +298,228 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-class AsyncChatCompletionStream:
-    def __aiter__(self):
-        return self
 
-    async def get_next_msg(self):
-        if not session["chat_mod"]._stopped():
-            session["chat_mod"]._decode()
-            msg = session["chat_mod"]._get_message()
-            return msg
-        else:
-            raise StopAsyncIteration
+def get_num_samples(n: Optional[int], best_of: Optional[int], stream: bool = False) -> int:
+    n = 1 if n is None else n
+    best_of = n if best_of is None else best_of
+    if n < 1 or best_of < n:
+        raise HTTPException(
+            status_code=400, detail=f"Expect 1 <= n <= best_of, while n={n}, best_of={best_of}"
+        )
+    if stream and best_of > n:
+        raise HTTPException(status_code=400, detail="best_of cannot be used with streaming")
+    return best_of
 
-    async def __anext__(self):
-        if not session["chat_mod"]._stopped():
-            task = asyncio.create_task(self.get_next_msg())
-            msg = await task
-            return msg
-        else:
-            raise StopAsyncIteration
+
+def add_request(prompt: str, history=None, num_samples: int = 1) -> GenerationRequest:
+    try:
+        return session["scheduler"].add_request(prompt, history, num_samples)
+    except SchedulerFullError as err:
+        raise HTTPException(status_code=503, detail=str(err)) from err
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err)) from err
+
+
+def get_completion_key(*request_content) -> Optional[bytes]:
+    """
+    Gets the key of a request in the completion cache, or None when the cache is disabled.
+    """
+    if "completion_cache" not in session:
+        return None
+    return completion_key(session["model_id"], session["generation_config"], request_content)
+
+
+# the background tasks filling the completion cache, referenced until they finish
+cache_tasks = set()
+
+
+async def start_generation(
+    prompt: str, history=None, num_samples: int = 1, key: Optional[bytes] = None
+):
+    """
+    Starts generating for a request, unless an identical request is cached or in flight.
+    Returns the generation, or the cached completion.
+    """
+    cache = session.get("completion_cache")
+    if key is not None:
+        completion = await cache.lookup(key)
+        if completion is not None:
+            return None, completion
+    try:
+        generation = add_request(prompt, history, num_samples)
+    except BaseException:
+        if key is not None:
+            cache.end(key, None)
+        raise
+    if key is not None:
+        # the cache is filled even if the client goes away before the response is sent
+        task = asyncio.create_task(cache_completion(cache, key, generation))
+        cache_tasks.add(task)
+        task.add_done_callback(cache_tasks.discard)
+    return generation, None
+
+
+async def cache_completion(cache: CompletionCache, key: bytes, generation: GenerationRequest):
+    completion = None
+    try:
+        await asyncio.gather(*[sample.wait_finished() for sample in generation.samples])
+        if (
+            all(sample.error is None and not sample.cancelled for sample in generation.samples)
+            and (len(generation.samples) == 1 or can_rank_samples(generation))
+        ):
+            completion = CachedCompletion(
+                deltas=[sample.deltas for sample in rank_samples(generation)],
+                usage=get_usage(generation).dict(),
+                finish_reasons=get_finish_reasons(rank_samples(generation)),
+            )
+    finally:
+        # the coalesced requests take over when the generation failed
+        cache.end(key, completion)
+
+
+def can_rank_samples(generation: GenerationRequest) -> bool:
+    """
+    Checks that the log-probabilities of all the samples of a request are known, which
+    they are not when the model library samples on device without returning them.
+    """
+    return not any(math.isnan(sample.output_logprob) for sample in generation.samples)
+
+
+def rank_samples(generation: GenerationRequest) -> List[GenerationRequest]:
+    """
+    Sorts the samples of a request by their log-probabilities, the most likely first.
+    """
+    # the sort is stable, so the samples of equal log-probabilities keep their order
+    return sorted(generation.samples, key=lambda sample: sample.output_logprob, reverse=True)
+
+
+async def wait_for_outputs(generation: GenerationRequest, n: int = 1) -> List[str]:
+    """
+    Waits for all the samples of a request, and returns the outputs of the n samples
+    of the highest log-probabilities.
+    """
+    try:
+        await asyncio.gather(*[sample.get_output() for sample in generation.samples])
+    finally:
+        # the handler is cancelled when the client disconnects
+        if not all(sample.finished for sample in generation.samples):
+            generation.cancel()
+    if len(generation.samples) > n and not can_rank_samples(generation):
+        raise HTTPException(
+            status_code=400,
+            detail="best_of > n requires the log-probabilities of the samples, which the "
+            "sampling function of the model library does not return, rebuild the model library",
+        )
+    return [sample.output_message for sample in rank_samples(generation)[:n]]
+
+
+def get_finish_reasons(samples: List[GenerationRequest]) -> List[str]:
+    """
+    Gets why every finished sample stopped, "length" at the length limit, or "stop".
+    """
+    return [
+        sample.usage.get("finish_reason", "stop") if sample.usage is not None else "stop"
+        for sample in samples
+    ]
+
+
+async def get_outputs(
+    generation: Optional[GenerationRequest], completion: Optional[CachedCompletion], n: Optional[int]
+) -> Tuple[List[str], List[str], UsageInfo]:
+    """
+    Gets the outputs, the finish reasons and the usage of a request, which is generating
+    or cached.
+    """
+    n = n or 1
+    if generation is None:
+        return completion.outputs[:n], completion.finish_reasons[:n], UsageInfo(**completion.usage)
+    msgs = await wait_for_outputs(generation, n)
+    return msgs, get_finish_reasons(rank_samples(generation)[:n]), get_usage(generation)
+
+
+async def iter_cached_samples(completion: CachedCompletion):
+    """
+    Yields the (index, delta) pairs of a cached completion, as they were generated.
+    """
+    for index, deltas in enumerate(completion.deltas):
+        for delta in deltas:
+            yield index, delta
+
+
+def get_usage(generation: GenerationRequest) -> UsageInfo:
+    """
+    Gets the usage of a finished request. The samples share the prompt, which is counted once.
+    """
+    usages = [sample.usage for sample in generation.samples if sample.usage is not None]
+    if not usages:
+        return UsageInfo(prompt_tokens=0, completion_tokens=0, total_tokens=0)
+    prompt_tokens = usages[0]["prompt_tokens"]
+    completion_tokens = sum(usage["completion_tokens"] for usage in usages)
+    return UsageInfo(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+    )
+
+
+async def iter_samples(generation: GenerationRequest):
+    """
+    Yields the (index, delta) pairs of all the samples of a request as they are generated.
+    """
+    if len(generation.samples) == 1:
+        async for delta in generation:
+            yield 0, delta
+        return
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def forward(index: int, sample: GenerationRequest):
+        try:
+            async for delta in sample:
+                queue.put_nowait((index, delta))
+            queue.put_nowait((index, None))
+        except Exception as err:  # pylint: disable=broad-except
+            queue.put_nowait((index, err))
+
+    tasks = [
+        asyncio.create_task(forward(index, sample))
+        for index, sample in enumerate(generation.samples)
+    ]
+    try:
+        num_running = len(tasks)
+        while num_running > 0:
+            index, delta = await queue.get()
+            if delta is None:
+                num_running -= 1
+            elif isinstance(delta, Exception):
+                raise delta
+            else:
+                yield index, delta
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def coalesce_deltas(
+    deltas: AsyncIterator[Tuple[int, str]], max_pieces: int, max_interval: float
+):
+    """
+    Merges the consecutive (index, delta) pairs of the same sample, until there are
+    max_pieces of them or max_interval seconds passed since the first one. The interval
+    is checked as the pieces arrive, so a piece waits at most one decode step more.
+    """
+    buffer_index, buffer, buffer_start = 0, [], 0.0
+    async for index, delta in deltas:
+        if buffer and index != buffer_index:
+            yield buffer_index, "".join(buffer)
+            buffer = []
+        if not buffer:
+            buffer_index, buffer_start = index, time.perf_counter()
+        buffer.append(delta)
+        if len(buffer) >= max_pieces or time.perf_counter() - buffer_start >= max_interval:
+            yield buffer_index, "".join(buffer)
+            buffer = []
+    if buffer:
+        yield buffer_index, "".join(buffer)
 
 
 @app.post("/v1/chat/completions")
@@ -168,48 +527,93 @@ async def request_completion(request: ChatCompletionRequest):
     """
     Creates model response for the given chat conversation.
     """
-    if len(request.messages) > 1:
-            raise ValueError(
-                """
-                The /v1/chat/completions endpoint currently only supports single message prompts.
-                Please ensure your request contains only one message
-                """)
-
+    if not request.messages or request.messages[-1].role != "user":
+        raise ValueError(
+            """
+            The /v1/chat/completions endpoint expects the last message to be a user message.
+            """)
+    for message in request.messages[:-1]:
+        if message.role not in ("system", "user", "assistant"):
+            raise ValueError(f"Unknown role \"{message.role}\" in the messages")
+
+    # a follow-up of a previous chat reuses its KV cache, and only prefills the last message
+    history = [(message.role, message.content) for message in request.messages[:-1]]
+    num_samples = get_num_samples(request.n, request.best_of, request.stream)
+    key = get_completion_key(
+        "chat", history, request.messages[-1].content, request.n, num_samples
+    )
+    generation, completion = await start_generation(
+        request.messages[-1].content, history, num_samples, key
+    )
     if request.stream:
 
-        session["chat_mod"]._prefill(input=request.messages[0].content)
+        # the chunks are serialized from plain dicts, as the per-chunk cost of the pydantic
+        # models is comparable to a decode step
+        chunk_id = f"chatcmpl-{shortuuid.random()}"
+        created = int(time.time())
+
+        def make_chunk(
+            index: int,
+            delta: dict,
+            finish_reason: Optional[str] = None,
+            usage: Optional[dict] = None,
+        ) -> str:
+            chunk = {
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "choices": [{"index": index, "delta": delta, "finish_reason": finish_reason}],
+            }
+            if usage is not None:
+                chunk["usage"] = usage
+            return f"data: {json_dumps(chunk)}\n\n"
 
         async def iter_response():
-            prev_txt = ""
-            async for content in AsyncChatCompletionStream():
-                if content:
-                    chunk = ChatCompletionStreamResponse(
-                        choices=[
-                            ChatCompletionResponseStreamChoice(
-                                index=0,
-                                delta=DeltaMessage(
-                                    role="assistant", content=content[len(prev_txt) :]
-                                ),
-                                finish_reason="stop",
-                            )
-                        ]
-                    )
-                    prev_txt = content
-                    yield f"data: {chunk.json(exclude_unset=True)}\n\n"
+            if generation is None:
+                deltas = iter_cached_samples(completion)
+            else:
+                deltas = iter_samples(generation)
+            started = set()
+            try:
+                async for index, delta in coalesce_deltas(
+                    deltas, request.stream_chunk_tokens, request.stream_chunk_ms / 1000
+                ):
+                    if index in started:
+                        yield make_chunk(index, {"content": delta})
+                    else:
+                        started.add(index)
+                        yield make_chunk(index, {"role": "assistant", "content": delta})
+                if generation is None:
+                    finish_reasons = completion.finish_reasons
+                    usage = completion.usage
+                else:
+                    finish_reasons = get_finish_reasons(generation.samples)
+                    usage = get_usage(generation).dict()
+                # the last chunk carries the usage of the whole request
+                for index, finish_reason in enumerate(finish_reasons):
+                    is_last = index == len(finish_reasons) - 1
+                    yield make_chunk(index, {}, finish_reason, usage if is_last else None)
+                yield "data: [DONE]\n\n"
+            finally:
+                # the stream is closed early when the client disconnects
+                if generation is not None and not all(
+                    sample.finished for sample in generation.samples
+                ):
+                    generation.cancel()
 
         return StreamingResponse(iter_response(), media_type="text/event-stream")
     else:
-        msg = session["chat_mod"].generate(prompt=request.messages[0].content)
+        msgs, finish_reasons, usage = await get_outputs(generation, completion, request.n)
         return ChatCompletionResponse(
             choices=[
                 ChatCompletionResponseChoice(
-                    index=0,
+                    index=index,
                     message=ChatMessage(role="assistant", content=msg),
-                    finish_reason="stop",
+                    finish_reason=finish_reason,
                 )
+                for index, (msg, finish_reason) in enumerate(zip(msgs, finish_reasons))
             ],
-            # TODO: Fill in correct usage info
-            usage=UsageInfo(prompt_tokens=0, completion_tokens=0, total_tokens=0),
+            usage=usage,
         )
 
 
@@ -218,7 +622,6 @@ async def request_completion(request: CompletionRequest):
     """
     Creates a completion for a given prompt.
     """
-    session["chat_mod"].reset_chat()
     # Langchain's load_qa_chain.run expects the input to be a list with the query
     if isinstance(request.prompt, list):
         if len(request.prompt) > 1:
@@ -231,52 +634,142 @@ async def request_completion(request: CompletionRequest):
     else:
         prompt = request.prompt
 
-    msg = session["chat_mod"].generate(prompt=prompt)
+    num_samples = get_num_samples(request.n, request.best_of)
+    key = get_completion_key("completions", prompt, request.n, num_samples)
+    generation, completion = await start_generation(prompt, num_samples=num_samples, key=key)
+    msgs, finish_reasons, usage = await get_outputs(generation, completion, request.n)
 
     return CompletionResponse(
-        choices=[CompletionResponseChoice(index=0, text=msg)],
-        # TODO: Fill in correct usage info
-        usage=UsageInfo(prompt_tokens=0, completion_tokens=0, total_tokens=0),
+        choices=[
+            CompletionResponseChoice(index=index, text=msg, finish_reason=finish_reason)
+            for index, (msg, finish_reason) in enumerate(zip(msgs, finish_reasons))
+        ],
+        usage=usage,
     )
 
 
+def encode_embeddings(embeddings: np.ndarray, encoding_format: str):
+    """
+    Encodes the rows of embeddings in the format of the response. The base64 formats
+    are emitted straight from the buffer, which is much smaller and faster than floats in JSON.
+    """
+    if encoding_format == "float":
+        return embeddings.tolist()
+    dtype = "<f2" if encoding_format == "base64_float16" else "<f4"
+    embeddings = np.ascontiguousarray(embeddings, dtype=dtype)
+    return [base64.b64encode(emb.tobytes()).decode("ascii") for emb in embeddings]
+
+
 @app.post("/v1/embeddings")
 async def request_embeddings(request: EmbeddingsRequest):
     """
     Gets embedding for some text.
     """
+    # the inputs are texts or token ids given by /v1/tokenize
     inps = []
     if type(request.input) == str:
         inps.append(request.input)
     elif type(request.input) == list:
-        inps = request.input
+        if request.input and all(type(inp) == int for inp in request.input):
+            inps.append(request.input)
+        else:
+            inps = request.input
     else:
         assert f"Invalid input type {type(request.input)}"
-    
-    data = []
-    for i, inp in enumerate(inps):
-        session["chat_mod"].reset_chat()
-        emb = session["chat_mod"].embed_text(input=inp).numpy()
-        mean_emb = np.squeeze(np.mean(emb, axis=1), axis=0)
-        norm_emb = mean_emb / np.linalg.norm(mean_emb)
-        data.append({"object": "embedding", "embedding": norm_emb.tolist(), "index": i})
-    # TODO: Fill in correct usage info
+
+    def embed_batch(inps):
+        # the inputs in a batch are embedded in one call, and pooled on device when supported
+        norm_embs = session["chat_mod"]._embed_pooled(inps)
+        if norm_embs is not None:
+            return norm_embs.numpy()
+        embeddings, num_tokens = session["chat_mod"]._embed_batch(inps)
+        embeddings = embeddings.numpy().astype("float32")
+        num_tokens = np.array(num_tokens)
+        mask = np.arange(embeddings.shape[1])[None, :] < num_tokens[:, None]
+        mean_embs = (embeddings * mask[:, :, None]).sum(axis=1) / num_tokens[:, None]
+        return mean_embs / np.linalg.norm(mean_embs, axis=1, keepdims=True)
+
+    def embed(inps):
+        # bound the padded batch of a large request
+        return np.concatenate(
+            [
+                embed_batch(inps[i : i + EMBEDDING_BATCH_SIZE])
+                for i in range(0, len(inps), EMBEDDING_BATCH_SIZE)
+            ]
+        )
+
+    def count_tokens(inp):
+        # the usage counts the tokens of the inputs themselves
+        return len(inp) if isinstance(inp, list) else len(session["chat_mod"]._tokenize(inp))
+
+    cache = session.get("embedding_cache")
+    entries = cache.get(inps) if cache is not None else [None] * len(inps)
+    missing = [i for i, entry in enumerate(entries) if entry is None]
+    if missing and cache is not None and cache.disk_path is not None:
+        # the on-disk tier is looked up in another thread, as it may block on I/O, and not
+        # on the inference thread, so that a hit does not wait for the decode steps
+        disk_inps = [inps[i] for i in missing]
+        disk_entries = await asyncio.get_event_loop().run_in_executor(
+            None, lambda: cache.get(disk_inps, disk=True)
+        )
+        for i, entry in zip(missing, disk_entries):
+            entries[i] = entry
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+    # only the inputs missing from the cache go through the model and the tokenizer, the
+    # cache hits keep their token counts
+    if missing:
+        missing_inps = [inps[i] for i in missing]
+
+        def embed_missing():
+            missing_embs = embed(missing_inps)
+            counts = [count_tokens(inp) for inp in missing_inps]
+            # the cache is filled on the inference thread, as it may write to disk
+            if cache is not None:
+                cache.put(missing_inps, missing_embs, counts)
+            return [CachedEmbedding(emb, count) for emb, count in zip(missing_embs, counts)]
+
+        missing_entries = await session["scheduler"].run_in_worker(embed_missing)
+        for i, entry in zip(missing, missing_entries):
+            entries[i] = entry
+    norm_embs = np.stack([entry.vector for entry in entries])
+    num_tokens = sum(entry.num_tokens for entry in entries)
+    data = [
+        {"object": "embedding", "embedding": emb, "index": i}
+        for i, emb in enumerate(encode_embeddings(norm_embs, request.encoding_format))
+    ]
     return EmbeddingsResponse(
         data=data,
         usage=UsageInfo(
-            prompt_tokens=0,
+            prompt_tokens=num_tokens,
             completion_tokens=0,
-            total_tokens=0
+            total_tokens=num_tokens
         )
     )
 
 
+@app.post("/v1/tokenize")
+async def request_tokenize(request: TokenizeRequest):
+    """
+    Tokenizes texts with the tokenizer of the model. The token ids can be passed to
+    /v1/embeddings in place of the texts, e.g. to split long texts into chunks.
+    """
+    inps = [request.input] if isinstance(request.input, str) else request.input
+    tokens = await session["scheduler"].run_in_worker(
+        lambda: [session["chat_mod"]._tokenize(inp) for inp in inps]
+    )
+    return TokenizeResponse(tokens=tokens)
+
+
 @app.post("/chat/reset")
 async def reset():
     """
     Reset the chat for the currently initialized model.
     """
-    session["chat_mod"].reset_chat()
+    def reset_chat():
+        session["chat_mod"].reset_chat()
+        session["scheduler"].clear_sessions()
+
+    await session["scheduler"].run_in_worker(reset_chat)
 
 
 @app.get("/stats")
@@ -284,9 +777,26 @@ async def read_stats():
     """
     Get the runtime stats.
     """
-    return session["chat_mod"].stats()
+    stats = await session["scheduler"].run_in_worker(session["chat_mod"].stats)
+    if "embedding_cache" in session:
+        stats += f", embedding cache hit rate: {session['embedding_cache'].hit_rate():.1%}"
+    if "completion_cache" in session:
+        stats += f", completion cache hit rate: {session['completion_cache'].hit_rate():.1%}"
+    return stats
+
+
+@app.get("/metrics")
+async def read_metrics():
+    """
+    Get the latency and usage histograms of the finished requests, in the Prometheus text format.
+    """
+    return PlainTextResponse(
+        session["scheduler"].metrics.render(), media_type="text/plain; version=0.0.4"
+    )
 
 
-ARGS = convert_args_to_argparser().parse_args()
 if __name__ == "__main__":
-    uvicorn.run("mlc_chat.rest:app", host=ARGS.host, port=ARGS.port, reload=False, access_log=False)
+    # the arguments are parsed only when run as a script, so that importing the module,
+    # e.g. in tests, has no side effects
+    ARGS = convert_args_to_argparser().parse_args()
+    uvicorn.run(app, host=ARGS.host, port=ARGS.port, reload=False, access_log=False)
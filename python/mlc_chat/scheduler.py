@@ -0,0 +1,518 @@
+"""The iteration-level request scheduler used by the REST server.
+
+Requests are queued and multiplexed over a single :class:`mlc_chat.ChatModule`.
+Every request runs on its own sequence of the chat module. New requests join the
+running set and finished ones leave it at token boundaries, so that many streams
+make progress together instead of being served one after another. When the model
+library provides batched functions, the running sequences are decoded in one batch.
+
+The scheduler runs on its own inference thread, which makes all the calls into the
+chat module, so that the asyncio event loop of the server stays responsive while
+the model runs. Results are handed back to the event loop through asyncio queues.
+
+A finished chat is kept as an idle session, which holds the sequence together with
+its KV cache. A follow-up request whose history is the transcript of a session
+resumes it, so that only the new user message is prefilled.
+
+A request for several samples prefills its prompt once. The sequence is then forked
+into one sequence per sample, which share the KV cache of the prompt and are decoded
+in the same batch.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import itertools
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from .chat_module import ChatModule
+from .metrics import ServingMetrics
+
+# The sequence created when the chat module is loaded. It is never used by scheduled
+# requests and is kept active between steps, so that other endpoints can keep using
+# the chat module directly.
+DEFAULT_SEQUENCE_ID = 0
+
+
+class SchedulerFullError(RuntimeError):
+    """Raised when a request is added while too many requests are waiting."""
+
+
+class GenerationRequest:
+    r"""A generation request scheduled by :class:`Scheduler`.
+
+    The request is an async iterator over the newly generated text pieces. It is
+    created on the event loop thread, and fed by the inference thread.
+
+    Parameters
+    ----------
+    prompt : str
+        The user input prompt.
+    history : Optional[Sequence[Tuple[str, str]]]
+        The ``(role, content)`` pairs of the chat before the prompt, where role is
+        one of ``"system"``, ``"user"`` and ``"assistant"``.
+    """
+
+    def __init__(self, prompt: str, history: Optional[Sequence[Tuple[str, str]]] = None):
+        self.prompt = prompt
+        self.history: Tuple[Tuple[str, str], ...] = tuple(
+            (role, content) for role, content in (history or ())
+        )
+        self.seq_id: Optional[int] = None
+        self.output_message = ""
+        # the non-empty text pieces in the order they are generated
+        self.deltas: List[str] = []
+        self.error: Optional[Exception] = None
+        # the sum of the log-probabilities of the output, see ChatModule._get_output_logprob
+        self.output_logprob = 0.0
+        # the usage when the request stops generating, see ChatModule._get_sequence_stats
+        self.usage: Optional[Dict[str, Any]] = None
+        # the time.perf_counter() of the arrival, the admission and every generation step
+        self.arrival_time = time.perf_counter()
+        self.admit_time: Optional[float] = None
+        self.token_times: List[float] = []
+        self.finished = False
+        self.cancelled = False
+        # the number of prompt tokens still to prefill when the prompt is prefilled in chunks
+        self.num_pending_prompt_tokens = 0
+        # the request itself followed by the other samples of the same prompt
+        self.samples: List["GenerationRequest"] = [self]
+        self._loop = asyncio.get_event_loop()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._done = self._loop.create_future()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        delta = await self._queue.get()
+        if delta is None:
+            raise StopAsyncIteration
+        if isinstance(delta, Exception):
+            raise delta
+        return delta
+
+    async def get_output(self) -> str:
+        r"""Wait until the request finishes and return the full output message.
+
+        Returns
+        -------
+        output : str
+            The generated full output.
+        """
+        async for _ in self:
+            pass
+        return self.output_message
+
+    async def wait_finished(self):
+        r"""Wait until the request finishes, without consuming its text pieces."""
+        await asyncio.shield(self._done)
+
+    def cancel(self):
+        r"""Stop generating for the request and all its samples, e.g. when the client
+        disconnects. The request leaves the scheduler at the next token boundary.
+        """
+        for sample in self.samples:
+            sample.cancelled = True
+
+    def _update(self, delta: str):
+        self.output_message += delta
+        if delta:
+            self.deltas.append(delta)
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, delta)
+
+    def _finish(self, error: Optional[Exception] = None):
+        self.finished = True
+        self.error = error
+        if error is not None:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, error)
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+        self._loop.call_soon_threadsafe(self._set_done)
+
+    def _set_done(self):
+        if not self._done.done():
+            self._done.set_result(None)
+
+
+class Scheduler:
+    r"""Continuous batching scheduler over a :class:`mlc_chat.ChatModule`.
+
+    Each step first decodes one token for every running request, in one batch
+    when the model supports it, and then admits waiting requests (which get
+    prefilled) as long as there are free sequence slots. The steps run on the
+    inference thread started by :func:`start`.
+
+    When ``prefill_chunk_size`` is set in the chat config, a step prefills at
+    most that many prompt tokens in total, continuing the admitted prompts chunk
+    by chunk, so that a long prompt does not stall the decoding of the running
+    requests for the whole prefill.
+
+    Parameters
+    ----------
+    chat_mod : ChatModule
+        The chat module to run the requests on.
+    max_num_sequences : int
+        The maximum number of requests that run concurrently. Every running
+        request holds its own KV cache.
+    max_num_sessions : int
+        The maximum number of idle sessions kept for follow-up requests. Every
+        session holds its own KV cache, and the least recently used one is
+        evicted when there are too many.
+    max_num_waiting : int
+        The maximum number of requests waiting for admission. Requests beyond it
+        are rejected with :class:`SchedulerFullError`, so that an overloaded
+        server sheds load instead of queueing without bound.
+
+    Attributes
+    ----------
+    metrics : ServingMetrics
+        The latency and usage metrics of the finished requests.
+    """
+
+    def __init__(
+        self,
+        chat_mod: ChatModule,
+        max_num_sequences: int = 4,
+        max_num_sessions: int = 0,
+        max_num_waiting: int = 64,
+    ):
+        if max_num_sequences <= 0:
+            raise ValueError(
+                f"`max_num_sequences` is expected to be positive, while it is {max_num_sequences}"
+            )
+        if max_num_sessions < 0:
+            raise ValueError(
+                f"`max_num_sessions` is expected to be non-negative, while it is {max_num_sessions}"
+            )
+        if max_num_waiting < 0:
+            raise ValueError(
+                f"`max_num_waiting` is expected to be non-negative, while it is {max_num_waiting}"
+            )
+        self.chat_mod = chat_mod
+        self.max_num_sequences = max_num_sequences
+        self.max_num_sessions = max_num_sessions
+        self.max_num_waiting = max_num_waiting
+        self.metrics = ServingMetrics()
+        self.prefill_chunk_size = chat_mod.chat_config.prefill_chunk_size or 0
+        # the requests and tasks handed over to the inference thread, guarded by _cond
+        self._cond = threading.Condition()
+        self._incoming: List[GenerationRequest] = []
+        self._tasks: List[Tuple[Callable[[], Any], concurrent.futures.Future]] = []
+        self._num_waiting = 0
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        # the states below are only touched by the inference thread
+        self._waiting: Deque[GenerationRequest] = collections.deque()
+        self._running: List[GenerationRequest] = []
+        # transcript -> sequence id of the idle sessions, in least recently used order
+        self._sessions: "collections.OrderedDict[Tuple[Tuple[str, str], ...], int]" = (
+            collections.OrderedDict()
+        )
+        self._seq_ids = itertools.count(DEFAULT_SEQUENCE_ID + 1)
+
+    def start(self):
+        r"""Start the inference thread."""
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="mlc-chat-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        r"""Stop the inference thread after the current step."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def add_request(
+        self,
+        prompt: str,
+        history: Optional[Sequence[Tuple[str, str]]] = None,
+        num_samples: int = 1,
+    ) -> GenerationRequest:
+        r"""Queue a new request.
+
+        Parameters
+        ----------
+        prompt : str
+            The user input prompt.
+        history : Optional[Sequence[Tuple[str, str]]]
+            The ``(role, content)`` pairs of the chat before the prompt. When it
+            is the transcript of an idle session, the request resumes the session.
+        num_samples : int
+            The number of outputs sampled for the prompt. The prompt is prefilled
+            once and shared by all the samples, which requires the model to provide
+            batched functions when there are more than one.
+
+        Returns
+        -------
+        request : GenerationRequest
+            The queued request, which streams the text of the first sample. All the
+            samples are in its ``samples``.
+        """
+        if not 1 <= num_samples <= self.max_num_sequences:
+            raise ValueError(
+                f"`num_samples` is expected to be in [1, {self.max_num_sequences}], "
+                f"while it is {num_samples}"
+            )
+        request = GenerationRequest(prompt, history)
+        for _ in range(num_samples - 1):
+            request.samples.append(GenerationRequest(prompt, history))
+        with self._cond:
+            if self._num_waiting >= self.max_num_waiting:
+                raise SchedulerFullError(
+                    f"Too many requests are waiting, the limit is {self.max_num_waiting}"
+                )
+            self._num_waiting += 1
+            self._incoming.append(request)
+            self._cond.notify()
+        return request
+
+    async def run_in_worker(self, func: Callable[[], Any]) -> Any:
+        r"""Run a function on the inference thread between two scheduling steps.
+        All the other uses of the chat module should go through it, as the chat
+        module is not thread-safe.
+
+        Parameters
+        ----------
+        func : Callable[[], Any]
+            The function to run, while the default sequence is active.
+
+        Returns
+        -------
+        result : Any
+            The return value of the function.
+        """
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        with self._cond:
+            self._tasks.append((func, future))
+            self._cond.notify()
+        return await asyncio.wrap_future(future)
+
+    def clear_sessions(self):
+        r"""Evict all the idle sessions and release their KV caches. It must run on
+        the inference thread.
+        """
+        while self._sessions:
+            self._evict_session()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (
+                    self._stopping
+                    or self._incoming
+                    or self._tasks
+                    or self._waiting
+                    or self._running
+                ):
+                    self._cond.wait()
+                self._waiting.extend(self._incoming)
+                self._incoming.clear()
+                if self._stopping:
+                    break
+                tasks, self._tasks = self._tasks, []
+            for func, future in tasks:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(func())
+                except Exception as err:  # pylint: disable=broad-except
+                    future.set_exception(err)
+            self.step()
+        for request in self._waiting:
+            for sample in request.samples:
+                sample._finish(RuntimeError("The scheduler is stopped"))
+        for request in list(self._running):
+            self._finish(request, RuntimeError("The scheduler is stopped"))
+
+    def step(self):
+        r"""Run one scheduling iteration."""
+        try:
+            self._drop_cancelled()
+            self._decode()
+            self._admit()
+            self._prefill()
+        finally:
+            self.chat_mod._switch_sequence(DEFAULT_SEQUENCE_ID)
+
+    def _drop_cancelled(self):
+        for request in [request for request in self._waiting if request.cancelled]:
+            self._waiting.remove(request)
+            with self._cond:
+                self._num_waiting -= 1
+            for sample in request.samples:
+                self._observe(sample, "cancelled")
+                sample._finish()
+        for request in [request for request in self._running if request.cancelled]:
+            self._finish(request, keep_session=False)
+
+    def _decode(self):
+        running = [request for request in self._running if request.num_pending_prompt_tokens == 0]
+        if not running:
+            return
+        try:
+            self.chat_mod._batch_decode([request.seq_id for request in running])
+        except Exception as err:  # pylint: disable=broad-except
+            for request in running:
+                self._finish(request, err)
+            return
+        for request in running:
+            self.chat_mod._switch_sequence(request.seq_id)
+            self._update(request)
+
+    def _num_reserved_sequences(self) -> int:
+        # the samples of a prompt being prefilled are forked after its last chunk
+        num_forks = sum(
+            len(request.samples) - 1
+            for request in self._running
+            if request.num_pending_prompt_tokens > 0
+        )
+        return len(self._running) + num_forks
+
+    def _admit(self):
+        while (
+            self._waiting
+            and self._num_reserved_sequences() + len(self._waiting[0].samples)
+            <= self.max_num_sequences
+        ):
+            request = self._waiting.popleft()
+            with self._cond:
+                self._num_waiting -= 1
+            admit_time = time.perf_counter()
+            for sample in request.samples:
+                sample.admit_time = admit_time
+            # The transcripts of the sessions only grow by a user message and the
+            # reply, so the session sharing the longest message prefix with the
+            # request is reusable only when it holds the whole history.
+            session_seq_id = self._sessions.pop(request.history, None)
+            if session_seq_id is None:
+                request.seq_id = next(self._seq_ids)
+            else:
+                request.seq_id = session_seq_id
+            forks = request.samples[1:]
+            for fork in forks:
+                fork.seq_id = next(self._seq_ids)
+            self._running.append(request)
+            try:
+                if session_seq_id is None:
+                    self.chat_mod._add_sequence(request.seq_id)
+                    self.chat_mod._switch_sequence(request.seq_id)
+                    if request.history:
+                        self.chat_mod._load_conversation_history(request.history)
+                else:
+                    self.chat_mod._switch_sequence(request.seq_id)
+                if self.prefill_chunk_size > 0:
+                    # the prompt is prefilled by _prefill
+                    request.num_pending_prompt_tokens = self.chat_mod._begin_prefill(
+                        request.prompt
+                    )
+                    if request.num_pending_prompt_tokens > 0:
+                        continue
+                elif forks:
+                    # the other samples start from the KV cache of the prompt
+                    self.chat_mod._prefill_fork(request.prompt, [fork.seq_id for fork in forks])
+                else:
+                    self.chat_mod._prefill(request.prompt)
+            except Exception as err:  # pylint: disable=broad-except
+                self._finish(request, err)
+                for fork in forks:
+                    # the forks may have been created before the error
+                    self._remove_sequence(fork.seq_id)
+                    self._observe(fork, "error")
+                    fork._finish(err)
+                continue
+            self._start_decoding(request)
+
+    def _prefill(self):
+        budget = self.prefill_chunk_size
+        for request in list(self._running):
+            if budget <= 0:
+                break
+            if request.num_pending_prompt_tokens == 0:
+                continue
+            forks = request.samples[1:]
+            try:
+                self.chat_mod._switch_sequence(request.seq_id)
+                num_pending = self.chat_mod._prefill_chunk(
+                    budget, [fork.seq_id for fork in forks]
+                )
+            except Exception as err:  # pylint: disable=broad-except
+                self._finish(request, err)
+                continue
+            budget -= request.num_pending_prompt_tokens - num_pending
+            request.num_pending_prompt_tokens = num_pending
+            if num_pending == 0:
+                self._start_decoding(request)
+
+    def _start_decoding(self, request: GenerationRequest):
+        # the prompt is prefilled, and every sample has its first output token
+        self._running.extend(request.samples[1:])
+        for sample in request.samples:
+            self.chat_mod._switch_sequence(sample.seq_id)
+            self._update(sample)
+
+    def _update(self, request: GenerationRequest):
+        request.token_times.append(time.perf_counter())
+        request._update(self.chat_mod._get_message_delta())
+        if self.chat_mod._stopped():
+            request.output_logprob = self.chat_mod._get_output_logprob()
+            request.usage = self.chat_mod._get_sequence_stats()
+            self._finish(request)
+
+    def _finish(
+        self,
+        request: GenerationRequest,
+        error: Optional[Exception] = None,
+        keep_session: bool = True,
+    ):
+        self.chat_mod._switch_sequence(DEFAULT_SEQUENCE_ID)
+        if request.num_pending_prompt_tokens > 0:
+            # the request leaves during its prefill, before the other samples are forked
+            request.num_pending_prompt_tokens = 0
+            keep_session = False
+            for fork in request.samples[1:]:
+                # the forks may have been created before an error of the last chunk
+                self._remove_sequence(fork.seq_id)
+                self._observe(fork, "error" if error is not None else "cancelled")
+                fork._finish(error)
+        if error is None and keep_session and self.max_num_sessions > 0:
+            transcript = request.history + (
+                ("user", request.prompt),
+                ("assistant", request.output_message),
+            )
+            if transcript in self._sessions:
+                self._remove_sequence(self._sessions.pop(transcript))
+            self._sessions[transcript] = request.seq_id
+            while len(self._sessions) > self.max_num_sessions:
+                self._evict_session()
+        else:
+            self._remove_sequence(request.seq_id)
+        self._running.remove(request)
+        if error is not None:
+            self._observe(request, "error")
+        else:
+            self._observe(request, "cancelled" if request.cancelled else "stop")
+        request._finish(error)
+
+    def _observe(self, request: GenerationRequest, status: str):
+        self.metrics.observe_request(
+            status,
+            request.arrival_time,
+            request.admit_time,
+            request.token_times,
+            request.usage,
+        )
+
+    def _evict_session(self):
+        _, seq_id = self._sessions.popitem(last=False)
+        self._remove_sequence(seq_id)
+
+    def _remove_sequence(self, seq_id: int):
+        try:
+            self.chat_mod._remove_sequence(seq_id)
+        except Exception:  # pylint: disable=broad-except
+            # The sequence may not have been created if admission failed.
+            pass
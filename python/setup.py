@@ -87,6 +87,7 @@ setup(
     packages=find_packages(),
     package_dir={"mlc_chat": "mlc_chat"},
     install_requires=["fastapi", "uvicorn", "shortuuid"],
+    extras_require={"bench": ["aiohttp"]},
     distclass=BinaryDistribution,
     **setup_kwargs,
 )
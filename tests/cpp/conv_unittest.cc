@@ -27,3 +27,41 @@ TEST(ConversationTest, ConversationJSONRoundTripTest) {
 TEST(ConversationTest, ConversationPartialUpdateTest) {
   _TestConversationPartialUpdate();
 }
+
+void _TestConversationPromptTokenCheck() {
+  mlc::llm::Conversation conv = mlc::llm::Conversation::FromTemplate("vicuna_v1.1");
+  conv.AppendMessage(conv.roles[0], "Hello");
+  conv.AppendMessage(conv.roles[1], "Hi, how can I help?");
+  conv.AppendMessage(conv.roles[0], "Tell me a joke");
+  conv.AppendReplyHeader(conv.roles[1]);
+  std::vector<std::string> prompts = conv.GetPromptArray();
+  std::string all_prompt;
+  for (const std::string& prompt : prompts) all_prompt += prompt;
+  mlc::llm::Conversation conv_prefix = conv;
+
+  // a byte-level encoder, which tokenizes the entries the same as the whole prompt
+  auto fencode_bytes = [](const std::string& text) {
+    return std::vector<int32_t>(text.begin(), text.end());
+  };
+  ASSERT_TRUE(conv.CheckPromptTokenArray(prompts, fencode_bytes(all_prompt), fencode_bytes));
+  std::vector<int32_t> cached;
+  for (const std::vector<int32_t>& tokens : conv.GetPromptTokenArray(prompts, fencode_bytes)) {
+    cached.insert(cached.end(), tokens.begin(), tokens.end());
+  }
+  ASSERT_EQ(cached, fencode_bytes(all_prompt));
+
+  // an encoder adding a dummy prefix to every input, like SentencePiece
+  auto fencode_prefix = [&fencode_bytes](const std::string& text) {
+    std::vector<int32_t> tokens = fencode_bytes(text);
+    tokens.insert(tokens.begin(), -1);
+    return tokens;
+  };
+  ASSERT_FALSE(
+      conv_prefix.CheckPromptTokenArray(prompts, fencode_prefix(all_prompt), fencode_prefix));
+  ASSERT_FALSE(conv_prefix.PromptTokensConcatenable());
+  // the check fails for good once a prompt differs
+  ASSERT_FALSE(
+      conv_prefix.CheckPromptTokenArray(prompts, fencode_bytes(all_prompt), fencode_bytes));
+}
+
+TEST(ConversationTest, ConversationPromptTokenCheckTest) { _TestConversationPromptTokenCheck(); }
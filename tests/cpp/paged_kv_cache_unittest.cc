@@ -0,0 +1,172 @@
+#include <gtest/gtest.h>
+#include <tvm/runtime/container/array.h>
+#include <tvm/runtime/container/shape_tuple.h>
+#include <tvm/runtime/ndarray.h>
+#include <tvm/runtime/packed_func.h>
+#include <tvm/runtime/registry.h>
+
+#include <algorithm>
+#include <string>
+#include <vector>
+
+using namespace tvm::runtime;
+
+namespace {
+
+constexpr int64_t kNumBlocks = 8;
+constexpr int64_t kBlockSize = 4;
+
+PackedFunc GetFunc(const std::string& name) {
+  const PackedFunc* f = Registry::Get("mlc.paged_kv_cache." + name);
+  CHECK(f != nullptr) << name << " is not registered";
+  return *f;
+}
+
+/*! \brief The append kernel on CPU, for pools and data with one head of size one. */
+void AppendOnCPU(TVMArgs args, TVMRetValue* rv) {
+  for (int kv = 0; kv < 2; ++kv) {
+    NDArray pool = args[kv];
+    NDArray data = args[kv + 2];
+    NDArray position_map = args[4];
+    int64_t num_tokens = position_map->shape[0] * position_map->shape[1];
+    for (int64_t i = 0; i < num_tokens; ++i) {
+      int32_t row = static_cast<int32_t*>(position_map->data)[i];
+      if (row >= 0) {
+        static_cast<float*>(pool->data)[row] = static_cast<float*>(data->data)[i];
+      }
+    }
+  }
+}
+
+/*! \brief A cache of one layer, whose pools have one head of size one. */
+ObjectRef CreateCache() {
+  Array<NDArray> pools;
+  std::vector<float> zeros(kNumBlocks * kBlockSize, 0.0f);
+  for (int kv = 0; kv < 2; ++kv) {
+    NDArray pool =
+        NDArray::Empty({kNumBlocks, kBlockSize, 1, 1}, DataType::Float(32), {kDLCPU, 0});
+    pool.CopyFromBytes(zeros.data(), zeros.size() * sizeof(float));
+    pools.push_back(pool);
+  }
+  return GetFunc("create")(pools, PackedFunc(AppendOnCPU));
+}
+
+std::vector<int64_t> GetBlocks(ObjectRef cache, int64_t slot) {
+  ShapeTuple blocks = GetFunc("get_blocks")(cache, slot);
+  return std::vector<int64_t>(blocks.begin(), blocks.end());
+}
+
+int64_t NumFreeBlocks(ObjectRef cache) { return GetFunc("num_free_blocks")(cache); }
+
+float KeyAt(ObjectRef cache, int64_t block, int64_t offset) {
+  NDArray pool = GetFunc("get_pool")(cache, 0);
+  return static_cast<float*>(pool->data)[block * kBlockSize + offset];
+}
+
+/*!
+ * \brief Append tokens to sequences, where the key and value of each new token are both
+ * set to the given value plus its index in the sequence.
+ */
+void Forward(ObjectRef cache, std::vector<int64_t> slots, std::vector<int64_t> append_lens,
+             float value) {
+  ShapeTuple past_lens = GetFunc("begin_forward")(cache, ShapeTuple(slots),
+                                                  ShapeTuple(append_lens));
+  int64_t seq_len = 0;
+  for (int64_t len : append_lens) seq_len = std::max(seq_len, len);
+  int64_t batch_size = slots.size();
+  NDArray data = NDArray::Empty({batch_size, seq_len, 1, 1}, DataType::Float(32), {kDLCPU, 0});
+  for (int64_t i = 0; i < batch_size; ++i) {
+    for (int64_t j = 0; j < seq_len; ++j) {
+      // the padding must not be written
+      static_cast<float*>(data->data)[i * seq_len + j] =
+          j < append_lens[i] ? value + past_lens[i] + j : -1.0f;
+    }
+  }
+  GetFunc("append")(cache, data, data, 0);
+}
+
+}  // namespace
+
+void _TestPagedKVCacheAppend() {
+  ObjectRef cache = CreateCache();
+  int64_t s0 = GetFunc("add_sequence")(cache);
+  int64_t s1 = GetFunc("add_sequence")(cache);
+  // the inputs of s1 are padded to the length of s0
+  Forward(cache, {s0, s1}, {6, 1}, 0.0f);
+  ASSERT_EQ(GetBlocks(cache, s0), std::vector<int64_t>({0, 1}));
+  ASSERT_EQ(GetBlocks(cache, s1), std::vector<int64_t>({2}));
+  ASSERT_EQ(NumFreeBlocks(cache), kNumBlocks - 3);
+  for (int64_t pos = 0; pos < 6; ++pos) {
+    ASSERT_EQ(KeyAt(cache, pos / kBlockSize, pos % kBlockSize), static_cast<float>(pos));
+  }
+  ASSERT_EQ(KeyAt(cache, 2, 0), 0.0f);
+  ASSERT_EQ(KeyAt(cache, 2, 1), 0.0f);
+  // the next tokens start at the past lengths
+  Forward(cache, {s1, s0}, {3, 2}, 10.0f);
+  ASSERT_EQ(KeyAt(cache, 2, 3), 13.0f);
+  ASSERT_EQ(KeyAt(cache, 1, 3), 17.0f);
+}
+
+void _TestPagedKVCacheForkCopyOnWrite() {
+  ObjectRef cache = CreateCache();
+  int64_t s0 = GetFunc("add_sequence")(cache);
+  Forward(cache, {s0}, {6}, 0.0f);
+  // the fork shares all the blocks, the partially filled last block included
+  int64_t s1 = GetFunc("fork_sequence")(cache, s0);
+  ASSERT_EQ(GetBlocks(cache, s1), std::vector<int64_t>({0, 1}));
+  ASSERT_EQ(NumFreeBlocks(cache), kNumBlocks - 2);
+
+  // the first sequence writing into the shared last block copies it
+  Forward(cache, {s1}, {1}, 100.0f);
+  ASSERT_EQ(GetBlocks(cache, s0), std::vector<int64_t>({0, 1}));
+  ASSERT_EQ(GetBlocks(cache, s1), std::vector<int64_t>({0, 2}));
+  ASSERT_EQ(NumFreeBlocks(cache), kNumBlocks - 3);
+  ASSERT_EQ(KeyAt(cache, 2, 0), 4.0f);
+  ASSERT_EQ(KeyAt(cache, 2, 1), 5.0f);
+  ASSERT_EQ(KeyAt(cache, 2, 2), 106.0f);
+  // the other sequence now owns its last block, which is written in place
+  Forward(cache, {s0}, {1}, 200.0f);
+  ASSERT_EQ(GetBlocks(cache, s0), std::vector<int64_t>({0, 1}));
+  ASSERT_EQ(KeyAt(cache, 1, 2), 206.0f);
+  ASSERT_EQ(NumFreeBlocks(cache), kNumBlocks - 3);
+
+  // popping the tokens of a block releases it, and a shared block outlives one sequence
+  GetFunc("popn")(cache, s1, 3);
+  ASSERT_EQ(GetBlocks(cache, s1), std::vector<int64_t>({0}));
+  ASSERT_EQ(NumFreeBlocks(cache), kNumBlocks - 2);
+  ASSERT_ANY_THROW(GetFunc("popn")(cache, s1, 5));
+  GetFunc("remove_sequence")(cache, s0);
+  ASSERT_EQ(NumFreeBlocks(cache), kNumBlocks - 1);
+  GetFunc("remove_sequence")(cache, s1);
+  ASSERT_EQ(NumFreeBlocks(cache), kNumBlocks);
+}
+
+void _TestPagedKVCacheAttachPrefix() {
+  ObjectRef cache = CreateCache();
+  int64_t s0 = GetFunc("add_sequence")(cache);
+  Forward(cache, {s0}, {6}, 0.0f);
+  // the full first block is held by the prefix cache after the sequence is removed
+  GetFunc("retain_blocks")(cache, ShapeTuple({0}));
+  GetFunc("remove_sequence")(cache, s0);
+  ASSERT_EQ(NumFreeBlocks(cache), kNumBlocks - 1);
+
+  int64_t s1 = GetFunc("add_sequence")(cache);
+  GetFunc("attach_prefix")(cache, s1, ShapeTuple({0}));
+  ASSERT_EQ(GetBlocks(cache, s1), std::vector<int64_t>({0}));
+  GetFunc("release_blocks")(cache, ShapeTuple({0}));
+  ASSERT_EQ(NumFreeBlocks(cache), kNumBlocks - 1);
+  // the prefix is full, so the next token takes a new block and the prefix is not copied
+  ShapeTuple past_lens = GetFunc("begin_forward")(cache, ShapeTuple({s1}), ShapeTuple({1}));
+  ASSERT_EQ(past_lens[0], kBlockSize);
+  ASSERT_EQ(GetBlocks(cache, s1)[0], 0);
+  ASSERT_EQ(NumFreeBlocks(cache), kNumBlocks - 2);
+  ASSERT_ANY_THROW(GetFunc("attach_prefix")(cache, s1, ShapeTuple({0})));
+  GetFunc("remove_sequence")(cache, s1);
+  ASSERT_EQ(NumFreeBlocks(cache), kNumBlocks);
+}
+
+TEST(PagedKVCacheTest, AppendTest) { _TestPagedKVCacheAppend(); }
+
+TEST(PagedKVCacheTest, ForkCopyOnWriteTest) { _TestPagedKVCacheForkCopyOnWrite(); }
+
+TEST(PagedKVCacheTest, AttachPrefixTest) { _TestPagedKVCacheAttachPrefix(); }
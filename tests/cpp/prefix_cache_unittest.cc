@@ -0,0 +1,92 @@
+#include <gtest/gtest.h>
+#include <prefix_cache.h>
+#include <tvm/runtime/container/shape_tuple.h>
+
+#include <vector>
+
+using mlc::llm::PrefixCache;
+using tvm::runtime::ObjectRef;
+using tvm::runtime::ShapeTuple;
+
+void _TestPrefixCacheSplitEdge() {
+  PrefixCache cache;
+  ShapeTuple a({0}), b({1}), c({2});
+  ASSERT_TRUE(cache.Insert({1, 2, 3, 4}, a));
+  // the edge of (1, 2, 3, 4) is split after (1, 2)
+  ASSERT_TRUE(cache.Insert({1, 2, 5}, b));
+  ASSERT_EQ(cache.NumCachedTokens(), 7);
+
+  PrefixCache::MatchResult match = cache.Match({1, 2, 3, 4, 9});
+  ASSERT_EQ(match.length, 4);
+  ASSERT_TRUE(match.snapshot.same_as(a));
+  match = cache.Match({1, 2, 5});
+  ASSERT_EQ(match.length, 3);
+  ASSERT_TRUE(match.snapshot.same_as(b));
+  // a mismatch right after the split point returns any sequence below it
+  match = cache.Match({1, 2, 7});
+  ASSERT_EQ(match.length, 2);
+  ASSERT_TRUE(match.snapshot.same_as(a) || match.snapshot.same_as(b));
+
+  // the node made by the split can hold a snapshot too
+  ASSERT_TRUE(cache.Insert({1, 2}, c));
+  ASSERT_TRUE(cache.Match({1, 2, 7}).snapshot.same_as(c));
+  ASSERT_EQ(cache.NumCachedTokens(), 9);
+  ASSERT_FALSE(cache.Insert({1, 2, 3, 4}, c));
+  ASSERT_TRUE(cache.Match({1, 2, 3, 4}).snapshot.same_as(a));
+}
+
+void _TestPrefixCacheMatchInsideEdge() {
+  PrefixCache cache;
+  ShapeTuple a({0});
+  ASSERT_TRUE(cache.Insert({1, 2, 3, 4}, a));
+  PrefixCache::MatchResult match = cache.Match({1, 2});
+  ASSERT_EQ(match.length, 2);
+  ASSERT_TRUE(match.snapshot.same_as(a));
+  match = cache.Match({1, 9, 3});
+  ASSERT_EQ(match.length, 1);
+  ASSERT_TRUE(match.snapshot.same_as(a));
+  match = cache.Match({9});
+  ASSERT_EQ(match.length, 0);
+  ASSERT_FALSE(match.snapshot.defined());
+  ASSERT_EQ(cache.Match({}).length, 0);
+}
+
+void _TestPrefixCacheEviction() {
+  PrefixCache cache;
+  ShapeTuple a({0}), b({1}), c({2});
+  ASSERT_TRUE(cache.Insert({1, 2, 3, 4}, a));
+  ASSERT_TRUE(cache.Insert({1, 2, 5, 6}, b));
+  // (1, 2, 5, 6, 7, 8) continues the chain below the node of b
+  ASSERT_TRUE(cache.Insert({1, 2, 5, 6, 7, 8}, c));
+  ASSERT_EQ(cache.NumCachedTokens(), 14);
+  // a match makes a the most recently used snapshot
+  ASSERT_TRUE(cache.Match({1, 2, 3}).snapshot.same_as(a));
+
+  ASSERT_TRUE(cache.EvictOne().same_as(b));
+  ASSERT_EQ(cache.NumCachedTokens(), 10);
+  PrefixCache::MatchResult match = cache.Match({1, 2, 5, 6, 7});
+  ASSERT_EQ(match.length, 5);
+  ASSERT_TRUE(match.snapshot.same_as(c));
+
+  ASSERT_TRUE(cache.EvictOne().same_as(a));
+  match = cache.Match({1, 2, 3});
+  ASSERT_EQ(match.length, 2);
+  ASSERT_TRUE(match.snapshot.same_as(c));
+
+  // evicting the last snapshot prunes the whole chain up to the root
+  ASSERT_TRUE(cache.EvictOne().same_as(c));
+  ASSERT_EQ(cache.NumCachedTokens(), 0);
+  ASSERT_EQ(cache.Match({1, 2, 5, 6, 7, 8}).length, 0);
+  ASSERT_FALSE(cache.EvictOne().defined());
+
+  ASSERT_TRUE(cache.Insert({1, 2, 9}, a));
+  match = cache.Match({1, 2, 9});
+  ASSERT_EQ(match.length, 3);
+  ASSERT_TRUE(match.snapshot.same_as(a));
+}
+
+TEST(PrefixCacheTest, SplitEdgeTest) { _TestPrefixCacheSplitEdge(); }
+
+TEST(PrefixCacheTest, MatchInsideEdgeTest) { _TestPrefixCacheMatchInsideEdge(); }
+
+TEST(PrefixCacheTest, EvictionTest) { _TestPrefixCacheEviction(); }
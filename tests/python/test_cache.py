@@ -0,0 +1,159 @@
+"""For testing the LRU eviction and the coalesced lookups of the caches of the REST server."""
+import asyncio
+import os
+import tempfile
+import unittest
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+# pylint: disable=wrong-import-position
+from mlc_chat.cache import CachedCompletion, CompletionCache, EmbeddingCache, completion_key
+
+DIM = 4
+# the size of a slot of the on-disk tier, a vector plus the digest, token count and
+# last-use counter
+DISK_SLOT_BYTES = DIM * 4 + 44
+
+
+def vector(value):
+    return np.full(DIM, value, dtype="float32")
+
+
+class EmbeddingCacheTest(unittest.TestCase):
+    def test_memory_lru_eviction(self):
+        cache = EmbeddingCache("model", capacity_bytes=2 * DIM * 4)
+        cache.put(["a", "b"], np.stack([vector(1), vector(2)]), [1, 2])
+        # touching "a" makes "b" the least recently used entry
+        self.assertIsNotNone(cache.get(["a"])[0])
+        cache.put(["c"], np.stack([vector(3)]), [3])
+        a, b, c = cache.get(["a", "b", "c"])
+        np.testing.assert_array_equal(a.vector, vector(1))
+        self.assertIsNone(b)
+        np.testing.assert_array_equal(c.vector, vector(3))
+        self.assertEqual((a.num_tokens, c.num_tokens), (1, 3))
+        self.assertEqual((cache.num_hits, cache.num_misses), (3, 1))
+
+    def test_keys(self):
+        cache = EmbeddingCache("model", capacity_bytes=1 << 20)
+        cache.put(["caf\u00e9", [1, 2]], np.stack([vector(1), vector(2)]), [1, 2])
+        # the composed and decomposed forms of a text share an entry
+        np.testing.assert_array_equal(cache.get(["cafe\u0301"])[0].vector, vector(1))
+        np.testing.assert_array_equal(cache.get([[1, 2]])[0].vector, vector(2))
+        self.assertEqual(cache.get(["[1, 2]"]), [None])
+        other_model = EmbeddingCache("other model", capacity_bytes=1 << 20)
+        self.assertEqual(other_model.get(["caf\u00e9"]), [None])
+
+    def test_disk_lru_eviction_and_reopen(self):
+        with tempfile.TemporaryDirectory() as disk_path:
+            # nothing is kept in memory, so that every hit comes from the disk
+            cache = EmbeddingCache(
+                "model",
+                capacity_bytes=0,
+                disk_path=disk_path,
+                disk_capacity_bytes=2 * DISK_SLOT_BYTES,
+            )
+            cache.put(["a", "b"], np.stack([vector(1), vector(2)]), [1, 2])
+            self.assertIsNotNone(cache.get(["a"], disk=True)[0])
+            cache.put(["c"], np.stack([vector(3)]), [3])
+            cache.flush()
+
+            reopened = EmbeddingCache(
+                "model",
+                capacity_bytes=0,
+                disk_path=disk_path,
+                disk_capacity_bytes=2 * DISK_SLOT_BYTES,
+            )
+            # the LRU order survives the restart, "a" was used before "c" was put
+            reopened.put(["d"], np.stack([vector(4)]), [4])
+            a, b, c, d = reopened.get(["a", "b", "c", "d"], disk=True)
+            self.assertIsNone(a)
+            self.assertIsNone(b)
+            np.testing.assert_array_equal(c.vector, vector(3))
+            np.testing.assert_array_equal(d.vector, vector(4))
+            # the token counts are kept on disk next to the vectors
+            self.assertEqual((c.num_tokens, d.num_tokens), (3, 4))
+
+    def test_disk_files_are_recreated_when_truncated(self):
+        with tempfile.TemporaryDirectory() as disk_path:
+            cache = EmbeddingCache(
+                "model",
+                capacity_bytes=0,
+                disk_path=disk_path,
+                disk_capacity_bytes=2 * DISK_SLOT_BYTES,
+            )
+            cache.put(["a"], np.stack([vector(1)]), [1])
+            cache.flush()
+            with open(os.path.join(disk_path, f"embeddings-{DIM}.f32"), "r+b") as vectors_file:
+                vectors_file.truncate(DIM * 4)
+
+            reopened = EmbeddingCache(
+                "model",
+                capacity_bytes=0,
+                disk_path=disk_path,
+                disk_capacity_bytes=2 * DISK_SLOT_BYTES,
+            )
+            self.assertEqual(reopened.get(["a"], disk=True), [None])
+            reopened.put(["b"], np.stack([vector(2)]), [2])
+            np.testing.assert_array_equal(reopened.get(["b"], disk=True)[0].vector, vector(2))
+
+    def test_memory_lookup_skips_disk(self):
+        with tempfile.TemporaryDirectory() as disk_path:
+            cache = EmbeddingCache(
+                "model",
+                capacity_bytes=DIM * 4,
+                disk_path=disk_path,
+                disk_capacity_bytes=2 * DISK_SLOT_BYTES,
+            )
+            cache.put(["a", "b"], np.stack([vector(1), vector(2)]), [1, 2])
+            # "a" is only on disk, and its miss in memory is not counted
+            self.assertEqual(cache.get(["a"]), [None])
+            self.assertEqual((cache.num_hits, cache.num_misses), (0, 0))
+            np.testing.assert_array_equal(cache.get(["a"], disk=True)[0].vector, vector(1))
+            self.assertEqual(cache.get(["x"], disk=True), [None])
+            self.assertEqual((cache.num_hits, cache.num_misses), (1, 1))
+            # the disk hit is kept in memory
+            np.testing.assert_array_equal(cache.get(["a"])[0].vector, vector(1))
+
+
+class CompletionCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def test_lru_eviction(self):
+        cache = CompletionCache(capacity=2)
+        for key in (b"a", b"b", b"c"):
+            self.assertIsNone(await cache.lookup(key))
+            cache.end(key, CachedCompletion(deltas=[[key.decode()]]))
+        self.assertIsNone(await cache.lookup(b"a"))
+        cache.end(b"a", None)
+        self.assertEqual((await cache.lookup(b"c")).outputs, ["c"])
+
+    async def test_coalesced_lookups(self):
+        cache = CompletionCache(capacity=4)
+        key = completion_key("model", {"temperature": 0}, ["hello"])
+        self.assertIsNone(await cache.lookup(key))
+        waiters = [asyncio.create_task(cache.lookup(key)) for _ in range(3)]
+        await asyncio.sleep(0)
+        self.assertFalse(any(waiter.done() for waiter in waiters))
+        cache.end(key, CachedCompletion(deltas=[["hi"]]))
+        completions = await asyncio.gather(*waiters)
+        self.assertEqual([completion.outputs for completion in completions], [["hi"]] * 3)
+        self.assertEqual((cache.num_hits, cache.num_misses), (3, 1))
+
+    async def test_waiter_takes_over_failed_leader(self):
+        cache = CompletionCache(capacity=4)
+        self.assertIsNone(await cache.lookup(b"key"))
+        cancelled = asyncio.create_task(cache.lookup(b"key"))
+        waiter = asyncio.create_task(cache.lookup(b"key"))
+        await asyncio.sleep(0)
+        # a cancelled waiter leaves the leader and the other waiters intact
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        self.assertFalse(waiter.done())
+        cache.end(b"key", None)
+        self.assertIsNone(await waiter)
+        cache.end(b"key", CachedCompletion(deltas=[["ok"]]))
+        self.assertEqual((await cache.lookup(b"key")).outputs, ["ok"])
+
+
+if __name__ == "__main__":
+    unittest.main()
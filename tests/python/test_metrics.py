@@ -0,0 +1,70 @@
+"""For testing the histograms and the Prometheus rendering of `ServingMetrics`."""
+import unittest
+
+from mlc_chat.metrics import TOKEN_BUCKETS, Counter, Histogram, ServingMetrics
+
+
+class HistogramTest(unittest.TestCase):
+    def test_buckets(self):
+        histogram = Histogram("latency", "The latency.", [0.1, 1.0])
+        for value in (0.05, 0.1, 0.5, 1.0, 5.0):
+            histogram.observe(value)
+        # a value equal to an upper bound falls into that bucket
+        self.assertEqual(histogram.bucket_counts, [2, 2, 1])
+        self.assertEqual(histogram.count, 5)
+        self.assertAlmostEqual(histogram.sum, 6.65)
+        self.assertEqual(
+            histogram.render(),
+            [
+                "# HELP latency The latency.",
+                "# TYPE latency histogram",
+                'latency_bucket{le="0.1"} 2',
+                'latency_bucket{le="1.0"} 4',
+                'latency_bucket{le="+Inf"} 5',
+                f"latency_sum {6.65!r}",
+                "latency_count 5",
+            ],
+        )
+
+    def test_counter(self):
+        counter = Counter("requests", "The requests.", "status")
+        counter.inc("stop")
+        counter.inc("error")
+        counter.inc("stop")
+        self.assertEqual(
+            counter.render(),
+            [
+                "# HELP requests The requests.",
+                "# TYPE requests counter",
+                'requests{status="error"} 1',
+                'requests{status="stop"} 2',
+            ],
+        )
+
+
+class ServingMetricsTest(unittest.TestCase):
+    def test_observe_request(self):
+        metrics = ServingMetrics()
+        usage = {"prompt_tokens": 10, "completion_tokens": 3, "sample_time": 0.001}
+        metrics.observe_request("stop", 0.0, 0.5, [1.0, 1.2, 1.5], usage)
+        # a request cancelled while waiting has no admission and no tokens
+        metrics.observe_request("cancelled", 0.0)
+        self.assertEqual(metrics.queue_wait.count, 1)
+        self.assertAlmostEqual(metrics.time_to_first_token.sum, 1.0)
+        self.assertEqual(metrics.inter_token_latency.count, 2)
+        self.assertAlmostEqual(metrics.inter_token_latency.sum, 0.5)
+        self.assertAlmostEqual(metrics.e2e_latency.sum, 1.5)
+        # 10 prompt tokens fall into the bucket of the bound 16
+        self.assertEqual(metrics.prompt_tokens.bucket_counts[TOKEN_BUCKETS.index(16)], 1)
+
+        text = metrics.render()
+        self.assertTrue(text.endswith("\n"))
+        self.assertIn('mlc_chat_requests_total{status="cancelled"} 1', text)
+        self.assertIn('mlc_chat_requests_total{status="stop"} 1', text)
+        self.assertIn("mlc_chat_completion_tokens_count 1", text)
+        self.assertIn('mlc_chat_time_to_first_token_seconds_bucket{le="1.0"} 1', text)
+        self.assertIn('mlc_chat_time_to_first_token_seconds_bucket{le="0.75"} 0', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
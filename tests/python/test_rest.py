@@ -0,0 +1,50 @@
+"""For testing the coalescing of streamed text pieces of the REST server."""
+import asyncio
+import unittest
+
+from mlc_chat.rest import coalesce_deltas
+
+
+async def iter_pieces(pieces, delay=0.0):
+    for piece in pieces:
+        if delay:
+            await asyncio.sleep(delay)
+        yield piece
+
+
+async def collect(deltas, max_pieces, max_interval):
+    return [chunk async for chunk in coalesce_deltas(deltas, max_pieces, max_interval)]
+
+
+class CoalesceDeltasTest(unittest.IsolatedAsyncioTestCase):
+    async def test_one_piece_per_chunk(self):
+        pieces = [(0, "a"), (0, "b"), (1, "c")]
+        self.assertEqual(await collect(iter_pieces(pieces), 1, 60.0), pieces)
+
+    async def test_max_pieces(self):
+        pieces = [(0, piece) for piece in "abcde"]
+        self.assertEqual(
+            await collect(iter_pieces(pieces), 2, 60.0), [(0, "ab"), (0, "cd"), (0, "e")]
+        )
+
+    async def test_samples_are_not_merged(self):
+        pieces = [(0, "a"), (0, "b"), (1, "c"), (1, "d"), (0, "e")]
+        self.assertEqual(
+            await collect(iter_pieces(pieces), 8, 60.0), [(0, "ab"), (1, "cd"), (0, "e")]
+        )
+
+    async def test_max_interval(self):
+        # the interval is checked as the pieces arrive, so a chunk is sent with the
+        # first piece arriving after its interval, and the last chunk at the end
+        pieces = [(0, piece) for piece in "abcde"]
+        self.assertEqual(
+            await collect(iter_pieces(pieces, delay=0.02), 8, 0.01),
+            [(0, "ab"), (0, "cd"), (0, "e")],
+        )
+
+    async def test_empty(self):
+        self.assertEqual(await collect(iter_pieces([]), 4, 0.1), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+"""For testing the candidates and the greedy decoding of the on-device sampling function."""
+import unittest
+
+import pytest
+
+np = pytest.importorskip("numpy")
+tvm = pytest.importorskip("tvm")
+
+# pylint: disable=wrong-import-position
+from tvm import relax
+
+from mlc_llm.relax_model.llama import LlamaConfig, create_sampling_func
+
+# every row gets its own noise, so that sampling many copies of a row draws every candidate
+NUM_DRAWS = 256
+
+
+def build_sampling_func():
+    bb = relax.BlockBuilder()
+    create_sampling_func(bb, LlamaConfig())
+    mod = relax.pipeline.get_pipeline()(bb.get())  # pylint: disable=no-value-for-parameter
+    vm = relax.VirtualMachine(relax.build(mod, "llvm"), tvm.cpu())
+    return vm["sample_top_p_top_k"]
+
+
+def log_softmax(logits):
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+
+
+def reference_candidates(logits, top_p, top_k):
+    # the smallest set of the most probable tokens that satisfies top-k or top-p, where
+    # ties with the smallest kept probability are kept as well
+    probs = np.exp(log_softmax(logits))
+    sorted_probs = np.sort(probs)[::-1]
+    top_k_threshold = sorted_probs[top_k - 1] if top_k > 0 else 0.0
+    num_top_p = np.searchsorted(np.cumsum(sorted_probs), top_p)
+    top_p_threshold = sorted_probs[min(num_top_p, len(probs) - 1)]
+    return set(np.nonzero(probs >= max(top_k_threshold, top_p_threshold))[0].tolist())
+
+
+class SamplingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.sample = build_sampling_func()
+
+    def run_sampling(self, logits, temperature, top_p, top_k, seed=0):
+        logits = np.asarray(logits, dtype="float32")
+        penalty_token_ids = np.full((logits.shape[0], 1), -1, dtype="int32")
+        params = np.array([temperature, top_p, 1.0, top_k], dtype="float32")
+        token_ids, logprobs = self.sample(
+            tvm.nd.array(logits[:, None, :]),
+            tvm.nd.array(penalty_token_ids),
+            tvm.nd.array(params),
+            tvm.runtime.ShapeTuple([seed]),
+        )
+        return token_ids.numpy(), logprobs.numpy()
+
+    def test_candidates(self):
+        # (top_p, top_k, expected candidates): top-k, top-p and both, which keep the
+        # smaller of the two sets
+        probs = [0.4, 0.25, 0.2, 0.1, 0.05]
+        cases = [
+            (1.0, 2, {0, 1}),
+            (0.7, 0, {0, 1, 2}),
+            (0.7, 2, {0, 1}),
+            (1.0, 0, {0, 1, 2, 3, 4}),
+        ]
+        logits = np.log(np.array(probs, dtype="float32"))
+        for top_p, top_k, expected in cases:
+            self.assertEqual(reference_candidates(logits, top_p, top_k), expected)
+            token_ids, logprobs = self.run_sampling(
+                np.tile(logits, (NUM_DRAWS, 1)), 1.0, top_p, top_k
+            )
+            self.assertEqual(set(token_ids.tolist()), expected, (top_p, top_k))
+            np.testing.assert_allclose(logprobs, log_softmax(logits)[token_ids], rtol=1e-5)
+
+    def test_top_k_keeps_ties(self):
+        # three tokens are tied at the 2nd largest probability, so 4 candidates are kept
+        logits = np.array([3.0, 2.0, 2.0, 2.0, 0.0, 0.0, -1.0, -5.0], dtype="float32")
+        expected = reference_candidates(logits, 1.0, 2)
+        self.assertEqual(expected, {0, 1, 2, 3})
+        token_ids, _ = self.run_sampling(np.tile(logits, (NUM_DRAWS, 1)), 1.0, 1.0, 2)
+        self.assertEqual(set(token_ids.tolist()), expected)
+
+    def test_greedy(self):
+        logits = np.random.default_rng(0).normal(size=(4, 50)).astype("float32")
+        # ties at the maximum are broken by the smallest token id
+        logits[3, [7, 20]] = logits[3].max() + 1.0
+        for top_p, top_k in [(1.0, 0), (0.5, 3)]:
+            token_ids, _ = self.run_sampling(logits, 0.0, top_p, top_k)
+            np.testing.assert_array_equal(token_ids, np.argmax(logits, axis=-1))
+        self.assertEqual(token_ids[3], 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,192 @@
+"""For testing the admission, cancellation, session reuse and samples of `Scheduler`."""
+import asyncio
+import threading
+import unittest
+from types import SimpleNamespace
+
+from mlc_chat.scheduler import DEFAULT_SEQUENCE_ID, Scheduler, SchedulerFullError
+
+
+class FakeChatModule:
+    """A chat module whose every sequence outputs "x" once per step, until it has
+    `num_tokens` output tokens. It records the calls made by the scheduler."""
+
+    def __init__(self, num_tokens=3, failing_prompts=()):
+        self.chat_config = SimpleNamespace(prefill_chunk_size=None)
+        self.num_tokens = num_tokens
+        self.failing_prompts = set(failing_prompts)
+        self.current = DEFAULT_SEQUENCE_ID
+        self.outputs = {DEFAULT_SEQUENCE_ID: ""}
+        self.pending = {DEFAULT_SEQUENCE_ID: ""}
+        self.added = []
+        self.removed = []
+        self.prefilled = []
+        self.loaded_histories = []
+        self.max_num_active = 0
+        self.thread_ids = set()
+
+    def _record(self):
+        self.thread_ids.add(threading.get_ident())
+        num_active = len(self.outputs) - 1
+        self.max_num_active = max(self.max_num_active, num_active)
+
+    def _add_sequence(self, seq_id):
+        self.outputs[seq_id] = ""
+        self.pending[seq_id] = ""
+        self.added.append(seq_id)
+        self._record()
+
+    def _remove_sequence(self, seq_id):
+        if seq_id not in self.outputs:
+            raise RuntimeError(f"Unknown sequence {seq_id}")
+        del self.outputs[seq_id]
+        del self.pending[seq_id]
+        self.removed.append(seq_id)
+
+    def _switch_sequence(self, seq_id):
+        self.current = seq_id
+
+    def _load_conversation_history(self, history):
+        self.loaded_histories.append(tuple(history))
+
+    def _decode_one(self, seq_id):
+        self.outputs[seq_id] += "x"
+        self.pending[seq_id] += "x"
+
+    def _prefill(self, prompt):
+        if prompt in self.failing_prompts:
+            raise RuntimeError(f"Cannot prefill {prompt}")
+        self.prefilled.append(prompt)
+        self._record()
+        # a resumed session starts a new reply
+        self.outputs[self.current] = ""
+        self._decode_one(self.current)
+
+    def _prefill_fork(self, prompt, fork_seq_ids):
+        self._prefill(prompt)
+        for seq_id in fork_seq_ids:
+            self._add_sequence(seq_id)
+            self.outputs[seq_id] = self.outputs[self.current]
+            self.pending[seq_id] = self.pending[self.current]
+
+    def _batch_decode(self, seq_ids):
+        self._record()
+        for seq_id in seq_ids:
+            self._decode_one(seq_id)
+
+    def _get_message_delta(self):
+        delta, self.pending[self.current] = self.pending[self.current], ""
+        return delta
+
+    def _stopped(self):
+        return len(self.outputs[self.current]) >= self.num_tokens
+
+    def _get_output_logprob(self):
+        return 0.0
+
+    def _get_sequence_stats(self):
+        return {
+            "prompt_tokens": 1,
+            "completion_tokens": len(self.outputs[self.current]),
+            "sample_time": 0.0,
+            "finish_reason": "stop",
+        }
+
+
+class SchedulerTest(unittest.IsolatedAsyncioTestCase):
+    def start_scheduler(self, chat_mod, **kwargs):
+        scheduler = Scheduler(chat_mod, **kwargs)
+        scheduler.start()
+        self.addCleanup(scheduler.stop)
+        return scheduler
+
+    async def test_admission_is_bounded_by_max_num_sequences(self):
+        chat_mod = FakeChatModule(num_tokens=3)
+        scheduler = self.start_scheduler(chat_mod, max_num_sequences=2)
+        requests = [scheduler.add_request(f"prompt {i}") for i in range(5)]
+        outputs = await asyncio.gather(*[request.get_output() for request in requests])
+        self.assertEqual(outputs, ["xxx"] * 5)
+        self.assertEqual(chat_mod.max_num_active, 2)
+        # every finished sequence is released, as sessions are disabled
+        self.assertEqual(sorted(chat_mod.removed), sorted(chat_mod.added))
+
+    async def test_samples_share_prefill(self):
+        chat_mod = FakeChatModule(num_tokens=3)
+        scheduler = self.start_scheduler(chat_mod)
+        request = scheduler.add_request("prompt", num_samples=3)
+        outputs = await asyncio.gather(*[sample.get_output() for sample in request.samples])
+        self.assertEqual(outputs, ["xxx"] * 3)
+        self.assertEqual(chat_mod.prefilled, ["prompt"])
+        self.assertEqual(len({sample.seq_id for sample in request.samples}), 3)
+        with self.assertRaises(ValueError):
+            scheduler.add_request("prompt", num_samples=5)
+
+    async def test_waiting_requests_are_bounded(self):
+        scheduler = Scheduler(FakeChatModule(), max_num_waiting=1)
+        scheduler.add_request("first")
+        with self.assertRaises(SchedulerFullError):
+            scheduler.add_request("second")
+
+    async def test_prefill_error_finishes_request(self):
+        chat_mod = FakeChatModule(num_tokens=2, failing_prompts=["bad"])
+        scheduler = self.start_scheduler(chat_mod)
+        bad = scheduler.add_request("bad")
+        good = scheduler.add_request("good")
+        with self.assertRaises(RuntimeError):
+            await bad.get_output()
+        self.assertTrue(bad.finished)
+        self.assertIn(bad.seq_id, chat_mod.removed)
+        self.assertEqual(await good.get_output(), "xx")
+
+    async def test_cancel_running_request(self):
+        chat_mod = FakeChatModule(num_tokens=1 << 30)
+        scheduler = self.start_scheduler(chat_mod)
+        request = scheduler.add_request("prompt")
+        self.assertEqual(await request.__anext__(), "x")
+        request.cancel()
+        await asyncio.wait_for(request.get_output(), timeout=10)
+        self.assertTrue(request.finished)
+        self.assertIn(request.seq_id, chat_mod.removed)
+        self.assertIn('mlc_chat_requests_total{status="cancelled"} 1', scheduler.metrics.render())
+
+    async def test_cancel_waiting_request(self):
+        chat_mod = FakeChatModule(num_tokens=1 << 30)
+        scheduler = self.start_scheduler(chat_mod, max_num_sequences=1)
+        running = scheduler.add_request("running")
+        waiting = scheduler.add_request("waiting")
+        await running.__anext__()
+        waiting.cancel()
+        self.assertEqual(await asyncio.wait_for(waiting.get_output(), timeout=10), "")
+        self.assertIsNone(waiting.seq_id)
+        running.cancel()
+        await asyncio.wait_for(running.get_output(), timeout=10)
+
+    async def test_follow_up_resumes_session(self):
+        chat_mod = FakeChatModule(num_tokens=2)
+        scheduler = self.start_scheduler(chat_mod, max_num_sessions=1)
+        first = scheduler.add_request("hello")
+        reply = await first.get_output()
+        history = [("user", "hello"), ("assistant", reply)]
+        second = scheduler.add_request("again", history)
+        self.assertEqual(await second.get_output(), "xx")
+        self.assertEqual(second.seq_id, first.seq_id)
+        self.assertEqual(chat_mod.added, [first.seq_id])
+        self.assertEqual(chat_mod.loaded_histories, [])
+
+        # a history that is not the transcript of the session starts a new sequence
+        third = scheduler.add_request("other", [("user", "unknown"), ("assistant", "x")])
+        await third.get_output()
+        self.assertNotEqual(third.seq_id, first.seq_id)
+        self.assertEqual(chat_mod.loaded_histories, [(("user", "unknown"), ("assistant", "x"))])
+
+    async def test_run_in_worker_uses_inference_thread(self):
+        chat_mod = FakeChatModule()
+        scheduler = self.start_scheduler(chat_mod)
+        await scheduler.add_request("prompt").get_output()
+        thread_id = await scheduler.run_in_worker(threading.get_ident)
+        self.assertEqual(chat_mod.thread_ids, {thread_id})
+        self.assertNotEqual(thread_id, threading.get_ident())
+
+
+if __name__ == "__main__":
+    unittest.main()